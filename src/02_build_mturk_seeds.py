@@ -1,15 +1,39 @@
-import pandas as pd
+import argparse
 import ast
 import json
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import turn_index
+from sharding import (add_shard_args, check_disjoint, fold_stores, in_shard, partition_path,
+                      read_partitions, stable_hash, store_partition, write_meta)
+from storage import BACKSTORY_STORE, output_path, write_frame
+from tabular import iter_csv_chunks
+from telemetry import add_profile_args, profiled
 
 IN_PATH = "data/raw/mturk_aggregate.csv"
-OUT_PATH = "data/processed/mturk_seeds.csv"
+OUT_PATH = "data/processed/mturk_seeds.csv"   # written as storage.PIPELINE_FORMAT
 
 N_PER_CONDITION = 20  # 최종 seed 개수(쌍 기준이면 20 ids = 40 rows)
 SEED = 42
 
+CHUNKSIZE = 50_000    # corpus rows per chunk; peak memory scales with this
+WORKERS = 0           # >1: parse chunks in a process pool
+
+# only these columns are ever read from the corpus
+KEY_COLS = ["id", "condition", "relationship_subtype"]
+SEED_COLS = KEY_COLS + [
+    "relationship_tag", "backstory", "positive_backstory", "negative_backstory",
+    "transformed_conversation", "turn_problematic_avg", "turn_vc_union",
+]
+
 def try_parse_list(x):
-    """Parse stringified python lists safely."""
+    """Parse stringified lists: json.loads fast path, ast.literal_eval for Python reprs."""
     if isinstance(x, list):
         return x
     if not isinstance(x, str):
@@ -17,6 +41,10 @@ def try_parse_list(x):
     s = x.strip()
     if not (s.startswith("[") and s.endswith("]")):
         return None
+    try:
+        return json.loads(s)
+    except ValueError:
+        pass
     try:
         return ast.literal_eval(s)
     except Exception:
@@ -70,69 +98,420 @@ def pick_best_turn(row, turns):
     # fallback: middle turn
     return n // 2, "fallback"
 
-def main():
-    m = pd.read_csv(IN_PATH)
+def seed_record(r, turns, ti, method, vcu):
+    seed_text, seed_speaker = turns[ti]
+
+    # VC label count from dataset annotation (ground truth for original)
+    vc_labels = []
+    if isinstance(vcu, list) and ti < len(vcu) and isinstance(vcu[ti], list):
+        vc_labels = vcu[ti]
+    orig_vc_count = len(vc_labels)
+    orig_vc_labels = "|".join(vc_labels) if vc_labels else ""
+
+    return {
+        "id": r.get("id"),
+        "condition": r.get("condition"),
+        "relationship_subtype": r.get("relationship_subtype"),
+        "relationship_tag": r.get("relationship_tag"),
+        "backstory_used_in_mturk": r.get("backstory"),
+        "positive_backstory": r.get("positive_backstory"),
+        "negative_backstory": r.get("negative_backstory"),
+        "seed_turn_index": ti,
+        "seed_selection_method": method,
+        "seed_speaker_guess": seed_speaker,
+        "seed_utterance": seed_text,
+        "orig_vc_count": orig_vc_count,
+        "orig_vc_labels": orig_vc_labels,
+    }
+
+def seed_row(r):
+    """One seed record for a corpus row, or None if it has no usable turns."""
+    turns = parse_turns(r)          # (text, speaker) tuples from transformed_conversation
+    ti, method = pick_best_turn(r, turns)
+    if ti is None:
+        return None
+    return seed_record(r, turns, ti, method, try_parse_list(r.get("turn_vc_union")))
+
+def seed_rows(chunk):
+    """Parse one chunk (runs in a worker process when WORKERS > 1)."""
+    out = []
+    for _, r in chunk.iterrows():
+        row = seed_row(r)
+        if row is not None:
+            out.append((r["_row"], row))
+    return out
 
-    # keep couples only
-    m = m[m["relationship_subtype"] == "couple"].copy()
+def map_bounded(fn, items, workers):
+    """Ordered map over an iterator; at most 2 * workers chunks in flight."""
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for it in items:
+            pending.append(pool.submit(fn, it))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-    # keep rows where condition exists
-    m = m[m["condition"].notna()].copy()
+METHODS = ["turn_problematic_avg", "turn_vc_union", "fallback"]
 
-    # sample ids that have both conditions (positive + negative)
-    id_cond_counts = m.groupby("id")["condition"].nunique()
-    paired_ids = id_cond_counts[id_cond_counts >= 2].index.tolist()
+def turn_matrices(chunk):
+    """
+    Parse a chunk into padded (rows x max_turns) arrays:
+      key      ranking key, same rules as pick_best_turn (NaN score -> -1e9,
+               label-count fallback, middle turn last); -inf = not selectable
+      score    turn_problematic_avg (NaN where missing)
+      n_labels VC labels per turn as counted for orig_vc_count
+    plus the per-row parsed turns / turn_vc_union and method codes.
+    This is a per-row Python loop: parsing the JSON lists dominates, so only the
+    ranking on these arrays (top_k) is vectorized.
+    """
+    parsed = []
+    for _, r in chunk.iterrows():
+        turns = parse_turns(r)
+        parsed.append((r, turns, try_parse_list(r.get("turn_problematic_avg")),
+                       try_parse_list(r.get("turn_vc_union"))))
+    width = max([len(p[1]) for p in parsed] + [1])
+    key = np.full((len(parsed), width), -np.inf)
+    score = np.full((len(parsed), width), np.nan)
+    n_labels = np.zeros((len(parsed), width), dtype=np.int32)
+    method = np.zeros(len(parsed), dtype=np.int8)
+    for i, (_, turns, tpa, vcu) in enumerate(parsed):
+        n = len(turns)
+        if isinstance(vcu, list):
+            for j, e in enumerate(vcu[:n]):
+                n_labels[i, j] = len(e) if isinstance(e, list) else 0
+        if isinstance(tpa, list) and len(tpa) == n:
+            for j, v in enumerate(tpa):
+                try:
+                    score[i, j] = float(v)
+                except Exception:
+                    pass
+            key[i, :n] = np.where(np.isnan(score[i, :n]), -1e9, score[i, :n])
+        elif isinstance(vcu, list) and len(vcu) == n:
+            method[i] = 1
+            key[i, :n] = [len(e) if isinstance(e, (list, tuple, set)) else 0 for e in vcu]
+        else:
+            method[i] = 2
+            if n:
+                key[i, n // 2] = 0
+    return parsed, key, score, n_labels, method
+
+def top_k(key, k):
+    """
+    (rows, k) turn indices of the k largest keys per row, ties broken towards the
+    lower turn index (what max() in pick_best_turn does). argpartition finds the
+    k-th largest value; ties at that value are filled lowest-index first.
+    """
+    rows, width = key.shape
+    k = min(k, width)
+    part = np.argpartition(-key, k - 1, axis=1)[:, :k]
+    kth = np.take_along_axis(key, part, 1).min(axis=1, keepdims=True)
+    above = key > kth
+    ties = key == kth
+    room = k - above.sum(axis=1, keepdims=True)
+    take = above | (ties & (np.cumsum(ties, axis=1) <= room))
+    cols = np.nonzero(take)[1].reshape(rows, k)          # exactly k per row, ascending
+    order = np.argsort(-np.take_along_axis(key, cols, 1), axis=1, kind="stable")
+    return np.take_along_axis(cols, order, 1)
+
+def ranked_seed_rows(chunk, k=1, min_score=None, min_vc=None):
+    """Full-corpus mode: top-k turns of every row in the chunk, with optional global thresholds."""
+    if chunk.empty:
+        return []
+    parsed, key, score, n_labels, method = turn_matrices(chunk)
+    if min_score is not None:
+        key[~(score >= min_score)] = -np.inf
+    if min_vc is not None:
+        key[n_labels < min_vc] = -np.inf
+    best = top_k(key, k)
+    ok = np.take_along_axis(key, best, 1) > -np.inf
+    out = []
+    for i, rank in zip(*np.nonzero(ok)):
+        r, turns, _, vcu = parsed[i]
+        rec = seed_record(r, turns, int(best[i, rank]), METHODS[method[i]], vcu)
+        rec["seed_rank"] = int(rank) + 1
+        out.append((r["_row"], rec))
+    return out
 
-    if len(paired_ids) == 0:
+def iter_couple_chunks(cols, chunksize, engine, shard=None):
+    """
+    Corpus chunks restricted to couples with a condition (and to the ids of `shard`),
+    tagged with the global row number.
+    """
+    offset = 0
+    for chunk in iter_csv_chunks(IN_PATH, usecols=cols, chunksize=chunksize, engine=engine):
+        chunk["_row"] = np.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+        # keep couples only, and rows where condition exists -- before any parsing
+        keep = (chunk["relationship_subtype"] == "couple") & chunk["condition"].notna()
+        if shard is not None:
+            keep &= in_shard(chunk["id"], shard)
+        yield chunk[keep]
+
+def sample(light, sampler="shuffle"):
+    """
+    (kind, picked, ranks): N_PER_CONDITION ids with both conditions ("paired"), or
+    2 * N_PER_CONDITION rows if no id is paired ("rows").
+
+    "shuffle" is the original sampler (random.shuffle of the paired ids, or
+    DataFrame.sample of the rows, seeded with SEED); it reproduces the committed
+    seed files. "hash" takes the smallest stable_hash(id or _row, SEED) instead,
+    so the sample does not depend on row order or on sharding: a shard's picks
+    contain every global pick in that shard. --shard / --merge need it.
+    """
+    id_cond_counts = light.groupby("id")["condition"].nunique()
+    paired = id_cond_counts.index[id_cond_counts >= 2].to_numpy(dtype=np.int64)
+    if len(paired):
+        kind, values, k = "paired", paired, N_PER_CONDITION
+    else:
+        kind, values, k = "rows", light["_row"].to_numpy(dtype=np.int64), N_PER_CONDITION * 2
+    if sampler == "shuffle":
+        if kind == "paired":
+            random.seed(SEED)
+            ids = values.tolist()
+            random.shuffle(ids)
+            picked = np.asarray(ids[:min(k, len(ids))], dtype=np.int64)
+        else:
+            picked = light.sample(n=min(k, len(light)), random_state=SEED)["_row"].to_numpy(dtype=np.int64)
+        return kind, picked, np.arange(len(picked))
+    ranks = stable_hash(values, SEED)
+    order = np.lexsort((values, ranks))[:k]
+    return kind, values[order], ranks[order]
+
+
+def select_rows(light, sampler="shuffle"):
+    """
+    Row numbers to build seeds from, their output order (None = file order) and the
+    sample() they come from. `light` holds only id / condition / _row for couple rows.
+    """
+    picks = sample(light, sampler)
+    kind, picked, _ = picks
+    if kind == "rows":
         print("No paired ids found. Sampling from available rows.")
-        candidates = m.sample(n=min(N_PER_CONDITION * 2, len(m)), random_state=SEED)
+        return set(picked.tolist()), picked.tolist(), picks
+    return set(light.loc[light["id"].isin(picked), "_row"]), None, picks
+
+def index_top_k(idx, turns, k):
+    """
+    Index turn ids -> (turn ids, 0-based rank) of the k best turns per dialogue by
+    turn_matrices' key, ties towards the lower turn index (as top_k), in file order.
+    """
+    turns = np.asarray(turns, dtype=np.int64)
+    key = idx.t["key"][turns]
+    turns, key = turns[key > -np.inf], key[key > -np.inf]
+    dia = idx.t["dialogue"][turns]
+    order = np.lexsort((turns, -key, dia))
+    turns, dia = turns[order], dia[order]
+    rank = np.arange(len(dia)) - np.searchsorted(dia, dia)
+    return turns[rank < k], rank[rank < k]
+
+def index_seed_frame(idx, turns):
+    """Seed records (seed_record's columns) for index turn ids, without touching the corpus."""
+    f = idx.frame(turns)
+    rows = f["row"].to_numpy()
+    return pd.DataFrame({
+        "id": f["id"],
+        "condition": f["condition"],
+        "relationship_subtype": f["relationship_subtype"],
+        "relationship_tag": f["relationship_tag"],
+        "backstory_used_in_mturk": idx.blobs["backstory"].take(rows),
+        "positive_backstory": idx.blobs["positive_backstory"].take(rows),
+        "negative_backstory": idx.blobs["negative_backstory"].take(rows),
+        "seed_turn_index": f["turn"],
+        "seed_selection_method": [METHODS[m] for m in idx.d["method"][rows]],
+        "seed_speaker_guess": f["speaker"],
+        "seed_utterance": f["text"],
+        "orig_vc_count": f["n_vc"],
+        "orig_vc_labels": idx.blobs["vc_labels"].take(turns),
+    })
+
+def run_from_index(args):
+    """
+    Same selection as run(), from the turn index. --vc / --nvc / --min-score / --min-vc
+    narrow the candidate turns; without --all, ids are then sampled among rows that
+    still have a candidate turn.
+    """
+    idx = turn_index.TurnIndex(args.from_index)
+    if idx.stale():
+        print(f"Warning: {idx.meta['source']['path']} changed since the index was built; rebuild it.")
+    conditions = idx.meta["conditions"]
+    if "subtype:couple" not in idx.keys or not conditions:
+        emit(args, [], [])
+        return
+    for kind, names in (("vc", args.vc), ("nvc", args.nvc)):
+        known = [k.split(":", 1)[1] for k in idx.keys if k.startswith(kind + ":")]
+        for name in names:
+            if name not in known:
+                raise SystemExit(f"--{kind} {name!r}: no turns with that label in {args.from_index} "
+                                 f"(known: {', '.join(known) or 'none'})")
+    cand = idx.query(args.vc, args.nvc, subtype="couple", condition=conditions,
+                     min_score=args.min_score, min_vc=args.min_vc)
+    cand = cand[in_shard(idx.d["id"][idx.t["dialogue"][cand]], args.shard)]
+    if args.all:
+        turns, rank = index_top_k(idx, cand, args.top_k)
+        out = index_seed_frame(idx, turns)
+        out["seed_rank"] = rank + 1
+        emit(args, out, idx.t["dialogue"][turns])
+        return
+
+    # sample among couple rows with a condition (or, when filtering, rows with a matching turn)
+    if args.vc or args.nvc or args.min_score is not None or args.min_vc is not None:
+        rows = np.unique(np.asarray(idx.t["dialogue"][cand], dtype=np.int64))
     else:
-        import random
-        random.seed(SEED)
-        sample_ids = paired_ids[:]
-        random.shuffle(sample_ids)
-        sample_ids = sample_ids[:min(N_PER_CONDITION, len(sample_ids))]
-        candidates = m[m["id"].isin(sample_ids)].copy()
-
-    rows = []
-    for _, r in candidates.iterrows():
-        turns = parse_turns(r)          # (text, speaker) tuples from transformed_conversation
-        ti, method = pick_best_turn(r, turns)
-        if ti is None:
-            continue
-        seed_text, seed_speaker = turns[ti]
-
-        # VC label count from dataset annotation (ground truth for original)
-        vcu = try_parse_list(r.get("turn_vc_union"))
-        vc_labels = []
-        if isinstance(vcu, list) and ti < len(vcu) and isinstance(vcu[ti], list):
-            vc_labels = vcu[ti]
-        orig_vc_count = len(vc_labels)
-        orig_vc_labels = "|".join(vc_labels) if vc_labels else ""
-
-        rows.append({
-            "id": r.get("id"),
-            "condition": r.get("condition"),
-            "relationship_subtype": r.get("relationship_subtype"),
-            "relationship_tag": r.get("relationship_tag"),
-            "backstory_used_in_mturk": r.get("backstory"),
-            "positive_backstory": r.get("positive_backstory"),
-            "negative_backstory": r.get("negative_backstory"),
-            "seed_turn_index": ti,
-            "seed_selection_method": method,
-            "seed_speaker_guess": seed_speaker,
-            "seed_utterance": seed_text,
-            "orig_vc_count": orig_vc_count,
-            "orig_vc_labels": orig_vc_labels,
-        })
-
-    out = pd.DataFrame(rows)
-    out.to_csv(OUT_PATH, index=False)
-
-    print("Saved ->", OUT_PATH)
+        rows = np.flatnonzero((np.asarray(idx.d["subtype"]) == idx.vocab["subtype"].code("couple"))
+                              & (np.asarray(idx.d["condition"]) >= 0))
+        rows = rows[in_shard(idx.d["id"][rows], args.shard)]
+    light = pd.DataFrame({"id": idx.d["id"][rows], "condition": idx.d["condition"][rows], "_row": rows})
+    keep, order, picks = select_rows(light, args.sampler)
+    cand = cand[np.isin(idx.t["dialogue"][cand], list(keep))]
+    turns, _ = index_top_k(idx, cand, 1)
+    if order is not None:
+        rank = {r: i for i, r in enumerate(order)}
+        turns = turns[np.argsort([rank[r] for r in idx.t["dialogue"][turns].tolist()], kind="stable")]
+    emit(args, index_seed_frame(idx, turns), idx.t["dialogue"][turns], picks)
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Select high-conflict seed utterances from the MTurk corpus.")
+    ap.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    ap.add_argument("--engine", choices=["c", "pyarrow"], default="c", help="CSV parser")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="processes for turn parsing")
+    ap.add_argument("--all", action="store_true",
+                    help="full-corpus mode: rank turns of every couple row instead of sampling ids")
+    ap.add_argument("--top-k", type=int, default=1,
+                    help="turns per dialogue in --all mode (>1 gives several seeds per id/condition)")
+    ap.add_argument("--min-score", type=float, help="--all or --from-index: keep turns with turn_problematic_avg >= x")
+    ap.add_argument("--min-vc", type=int, help="--all or --from-index: keep turns with >= y VC labels")
+    ap.add_argument("--out", default=OUT_PATH)
+    ap.add_argument("--from-index", nargs="?", const=turn_index.INDEX_DIR, metavar="DIR",
+                    help="select from the turn index (python src/turn_index.py build) instead of the raw CSV")
+    ap.add_argument("--vc", action="append", default=[],
+                    help="--from-index: only turns with this VC label (repeat for AND)")
+    ap.add_argument("--nvc", action="append", default=[],
+                    help="--from-index: only turns with this NVC label (repeat for AND)")
+    ap.add_argument("--sampler", choices=["shuffle", "hash"],
+                    help="id sampler without --all: shuffle (default; reproduces the committed seeds) "
+                         "or hash (default with --shard/--merge; a single run that matches a merge)")
+    add_shard_args(ap)
+    add_profile_args(ap)
+    args = ap.parse_args()
+    if args.top_k < 1:
+        ap.error("--top-k must be >= 1")
+    if (args.vc or args.nvc) and not args.from_index:
+        ap.error("--vc / --nvc need --from-index")
+    sharded = args.shard is not None or args.merge
+    if args.sampler is None:
+        args.sampler = "hash" if sharded else "shuffle"
+    elif args.sampler == "shuffle" and sharded:
+        ap.error("--shard/--merge sample by hash ranking; use --sampler hash")
+    return args
+
+def save(rows, path, store=BACKSTORY_STORE):
+    out = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+    path = output_path(path)
+    write_frame(out, path, store)
+
+    print("Saved ->", path)
     print("Rows saved:", len(out))
+    if out.empty:
+        return
     print("Conditions in seeds:", out["condition"].value_counts().to_dict())
     print(out[["id","condition","seed_turn_index","seed_selection_method"]].head(10))
 
+def shard_settings(args) -> dict:
+    """Everything that must be equal across the shards of one merged run."""
+    return {"corpus": IN_PATH, "all": args.all, "top_k": args.top_k, "min_score": args.min_score,
+            "min_vc": args.min_vc, "from_index": bool(args.from_index), "vc": args.vc, "nvc": args.nvc,
+            "n_per_condition": N_PER_CONDITION, "seed": SEED, "sampler": args.sampler}
+
+def emit(args, rows, corpus_rows, picks=None):
+    """
+    Save the seeds, or with --shard this shard's partition: the same records plus
+    their corpus row (_row) with backstories in the shard's own store, and the
+    sample() picks in the partition's meta.
+    """
+    if args.shard is None:
+        save(rows, args.out)
+        return
+    out = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+    out["_row"] = np.asarray(corpus_rows, dtype=np.int64)
+    part = partition_path(output_path(args.out), args.shard)
+    store = store_partition(args.shard)
+    save(out, part, store)
+    kind, picked, ranks = picks if picks is not None else (None, [], [])
+    write_meta(part, args.shard, shard_settings(args), rows=len(out), kind=kind,
+               candidates=[[int(r), int(v)] for r, v in zip(ranks, picked)],
+               backstories=store.name if store.exists() else None)
+
+def merge_sample(df, metas):
+    """The single-worker sample from the shards' picks: the globally smallest ranks."""
+    kind = "paired" if any(m["kind"] == "paired" for m in metas) else "rows"
+    picks = sorted((r, v) for m in metas if m["kind"] == kind for r, v in m["candidates"])
+    picked = [v for _, v in picks[:N_PER_CONDITION if kind == "paired" else 2 * N_PER_CONDITION]]
+    if df.empty:
+        return df
+    df = df[df["_shard"].isin([m["shard"][0] for m in metas if m["kind"] == kind])]
+    if kind == "paired":
+        return df[df["id"].astype("int64").isin(picked)].sort_values("_row", kind="stable")
+    pos = {v: i for i, v in enumerate(picked)}
+    df = df[df["_row"].isin(picked)]
+    return df.iloc[np.argsort(df["_row"].map(pos).to_numpy(), kind="stable")]
+
+def merge(args):
+    """Combine the --shard partitions into the output a single run writes."""
+    path = output_path(args.out)
+    df, metas = read_partitions(path, args.merge, "id")
+    print(f"Merging {args.merge} seed partitions ({sum(m['rows'] for m in metas)} rows)")
+    if not df.empty:
+        df["_row"] = df["_row"].astype("int64")
+        check_disjoint(df, ["_row", "seed_rank"] if metas[0]["settings"]["all"] else ["_row"], path)
+    fold_stores(metas, df)
+    if not metas[0]["settings"]["all"]:
+        df = merge_sample(df, metas)
+    elif not df.empty:
+        df = df.assign(_rank=df["seed_rank"].astype("int64")).sort_values(["_row", "_rank"], kind="stable")
+    save(df.drop(columns=[c for c in df.columns if c.startswith("_")]).reset_index(drop=True), args.out)
+
+def run(args):
+    if args.merge:
+        merge(args)
+        return
+    if args.from_index:
+        run_from_index(args)
+        return
+    if args.all:
+        select = partial(ranked_seed_rows, k=args.top_k, min_score=args.min_score, min_vc=args.min_vc)
+        chunks = iter_couple_chunks(SEED_COLS, args.chunksize, args.engine, args.shard)
+        found = [x for part in map_bounded(select, chunks, args.workers) for x in part]
+        emit(args, [row for _, row in found], [r for r, _ in found])
+        return
+
+    # pass 1: key columns only, to decide which rows become seeds
+    light = pd.concat([c[["id", "condition", "_row"]]
+                       for c in iter_couple_chunks(KEY_COLS, args.chunksize, args.engine, args.shard)],
+                      ignore_index=True)
+    keep, order, picks = select_rows(light, args.sampler)
+    del light
+
+    # pass 2: full seed columns, chunk by chunk, parsing only the selected rows
+    def selected():
+        for chunk in iter_couple_chunks(SEED_COLS, args.chunksize, args.engine, args.shard):
+            chunk = chunk[chunk["_row"].isin(keep)]
+            if len(chunk):
+                yield chunk
+
+    found = [x for part in map_bounded(seed_rows, selected(), args.workers) for x in part]
+    if order is not None:
+        rank = {r: i for i, r in enumerate(order)}
+        found.sort(key=lambda x: rank[x[0]])
+    emit(args, [row for _, row in found], [r for r, _ in found], picks)
+
+def main():
+    args = parse_args()
+    with profiled("seeds", args):    # --workers > 1: only the parent process is profiled
+        run(args)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
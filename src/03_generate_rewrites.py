@@ -1,128 +1,319 @@
-import os
+import argparse
+import asyncio
+import time
 import pandas as pd
-from google import genai
-from google.genai import types
 from dotenv import load_dotenv
 
+from async_llm import RateLimiter, estimate_tokens, gather_bounded, limited_call
+from backends import BACKENDS, add_fake_args, fake_options, get_backend
+from checkpoint import Journal, cell_key
+from llm_cache import CACHE_PATH, LLMCache, make_key
+from prompt_cache import schedule
+from prompts import LAYOUTS, SYSTEM, as_text, build_prompt
+from sharding import add_shard_args, in_shard, load_metas, partition_path, store_partition, write_meta
+from storage import BACKSTORY_STORE, exists, output_path, read_frame, write_frame
+from telemetry import METRICS_PATH, CallMeter, MetricsLog
+
 load_dotenv()
 
 IN_PATH = "data/processed/mturk_seeds.csv"
-OUT_PATH = "data/processed/rewrites.csv"
+OUT_PATH = "data/processed/rewrites.csv"          # compacted once at the end, as storage.PIPELINE_FORMAT
+JOURNAL_PATH = "data/processed/rewrites.journal.jsonl"
+FSYNC_EVERY = 32       # journal records per flush + fsync
 
+BACKEND = "gemini"     # see backends.py; "fake" runs offline
 MODEL = "gemini-2.0-flash"
 TEMPERATURE = 0.2
 MAX_TOKENS = 200
+PROMPT_LAYOUT = "classic"   # "prefix": cache-friendly order, see prompts.py / prompt_cache.py
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-
-SYSTEM = "You are a careful assistant that rewrites messages using Nonviolent Communication (NVC)."
-
-def make_prompt(backstory: str | None, utterance: str) -> str:
-    if backstory:
-        return f"""Task: Rewrite the message using Nonviolent Communication (NVC), considering the relationship backstory.
-
-Relationship backstory:
-{backstory}
-
-Original utterance:
-{utterance}
-
-Requirements:
-- Preserve the core intent.
-- Remove blame, moral judgment, absolutist language, and demands.
-- Express (when possible): (1) observation (2) feeling (3) need (4) request.
-- Keep it to 1–2 sentences.
-- Do NOT add new facts beyond what is in the utterance and backstory.
-Return only the rewritten text."""
-    else:
-        return f"""Task: Rewrite the message using Nonviolent Communication (NVC).
-
-Original utterance:
-{utterance}
-
-Requirements:
-- Preserve the core intent.
-- Remove blame, moral judgment, absolutist language, and demands.
-- Express (when possible): (1) observation (2) feeling (3) need (4) request.
-- Keep it to 1–2 sentences.
-Return only the rewritten text."""
-
-def call_gemini(prompt: str) -> str:
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            system_instruction=SYSTEM,
-            temperature=TEMPERATURE,
-            max_output_tokens=MAX_TOKENS,
-        ),
-    )
-    return response.text.strip()
+# async mode (--async)
+CONCURRENCY = 8        # calls in flight
+RPM = 1000             # requests / minute
+TPM = 1_000_000        # (prompt + max output) tokens / minute
+MAX_RETRIES = 5
+BASE_DELAY = 1.0       # retry backoff base (s), full jitter
 
-def main():
-    df = pd.read_csv(IN_PATH)
+# response cache (see llm_cache.py)
+CACHE_MAX_ENTRIES = 200_000
+CACHE_MAX_AGE_DAYS = 90
+
+BACKSTORY_CONDITIONS = ["none", "pos", "neg"]
+
+backend = None   # set in main()
+cache = None     # set in main()
+metrics = None   # set in main(); telemetry.MetricsLog, one record per call
+
+def _gen_kwargs():
+    return {"model": MODEL, "temperature": TEMPERATURE, "max_tokens": MAX_TOKENS}
+
+def _cache_key(prompt) -> str:
+    return make_key(backend.name, MODEL, TEMPERATURE, MAX_TOKENS, SYSTEM, as_text(prompt))
+
+def new_meter(r, c, prompt, queued=None) -> CallMeter:
+    return CallMeter(metrics, cell_key(r["id"], r["condition"], c), prompt, backend.name, MODEL, queued)
+
+def call_llm(prompt, meter: CallMeter) -> str:
+    key = _cache_key(prompt)
+    if cache is not None and (hit := cache.get(key)) is not None:
+        meter.cache_hit = True
+        return hit
+    with meter.attempt():
+        meter.completion = backend.complete(SYSTEM, prompt, **_gen_kwargs())
+    text = meter.completion.text
+    if cache is not None:
+        cache.put(key, text, MODEL)
+    return text
 
-    # output file exists? resume-friendly
-    if os.path.exists(OUT_PATH):
-        out = pd.read_csv(OUT_PATH)
-        done = set(zip(out["id"], out["condition"]))
-        print(f"Found existing {OUT_PATH} with {len(out)} rows. Will skip done rows.")
-    else:
-        out = pd.DataFrame()
-        done = set()
+async def call_llm_async(prompt, meter: CallMeter) -> str:
+    key = _cache_key(prompt)
+    if cache is not None and (hit := cache.get(key)) is not None:
+        meter.cache_hit = True
+        return hit
+    with meter.attempt():
+        meter.completion = await backend.acomplete(SYSTEM, prompt, **_gen_kwargs())
+    text = meter.completion.text
+    if cache is not None:
+        cache.put(key, text, MODEL)
+    return text
 
+def row_inputs(r):
+    utt = str(r["seed_utterance"]).strip()
+    pos_bs = str(r["positive_backstory"]).strip()
+    neg_bs = str(r["negative_backstory"]).strip()
+    return utt, pos_bs, neg_bs
+
+def row_prompts(r) -> dict:
+    """Prompts for the 3 conditions we want for EACH row: none / pos / neg."""
+    utt, pos_bs, neg_bs = row_inputs(r)
+    return {
+        "none": build_prompt(None, utt, PROMPT_LAYOUT),
+        "pos":  build_prompt(pos_bs, utt, PROMPT_LAYOUT),
+        "neg":  build_prompt(neg_bs, utt, PROMPT_LAYOUT),
+    }
+
+def build_row(r, rewrites: dict) -> dict:
+    utt, pos_bs, neg_bs = row_inputs(r)
+    return {
+        "id": r["id"],
+        "condition": r["condition"],  # MTurk condition for this row (positive/negative)
+        "seed_utterance": utt,
+        "positive_backstory": pos_bs,
+        "negative_backstory": neg_bs,
+        "rewrite_none": rewrites["none"],
+        "rewrite_pos": rewrites["pos"],
+        "rewrite_neg": rewrites["neg"],
+        "model": MODEL,
+        "temperature": TEMPERATURE,
+    }
+
+def cell_record(r, backstory_condition, rewrite) -> dict:
+    return {"id": r["id"], "condition": r["condition"],
+            "backstory_condition": backstory_condition, "rewrite": rewrite,
+            "model": MODEL, "temperature": TEMPERATURE}
+
+def pending_cells(df, journal):
+    """
+    (row, backstory_condition, prompt) for every cell not yet in the journal. With the
+    prefix layout, cells sharing a cacheable prefix are scheduled back to back.
+    """
+    cells = []
+    for _, r in df.iterrows():
+        for c, p in row_prompts(r).items():
+            if cell_key(r["id"], r["condition"], c) not in journal:
+                cells.append((r, c, p))
+    if PROMPT_LAYOUT != "classic":
+        cells = schedule(cells, segments_of=lambda cell: cell[2])
+    return cells
+
+def compact(df, journal, path=None, store=BACKSTORY_STORE):
+    """Write the wide rewrites table once, in seed order, from fully completed rows."""
     rows = []
     for _, r in df.iterrows():
-        key = (r["id"], r["condition"])
-        if key in done:
-            continue
-
-        utt = str(r["seed_utterance"]).strip()
-        pos_bs = str(r["positive_backstory"]).strip()
-        neg_bs = str(r["negative_backstory"]).strip()
-
-        # 3 conditions we want for EACH row:
-        # - none (no backstory)
-        # - pos
-        # - neg
-        prompt_none = make_prompt(None, utt)
-        prompt_pos  = make_prompt(pos_bs, utt)
-        prompt_neg  = make_prompt(neg_bs, utt)
-
-        rewrite_none = call_gemini(prompt_none)
-        rewrite_pos  = call_gemini(prompt_pos)
-        rewrite_neg  = call_gemini(prompt_neg)
-
-        rows.append({
-            "id": r["id"],
-            "condition": r["condition"],  # MTurk condition for this row (positive/negative)
-            "seed_utterance": utt,
-            "positive_backstory": pos_bs,
-            "negative_backstory": neg_bs,
-            "rewrite_none": rewrite_none,
-            "rewrite_pos": rewrite_pos,
-            "rewrite_neg": rewrite_neg,
-            "model": MODEL,
-            "temperature": TEMPERATURE,
-        })
-
-        # save incrementally (crash-safe)
-        tmp = pd.DataFrame(rows)
-        if not out.empty:
-            merged = pd.concat([out, tmp], ignore_index=True)
-        else:
-            merged = tmp
-        merged.to_csv(OUT_PATH, index=False)
-
-        print(f"✓ saved row id={r['id']} condition={r['condition']} -> {OUT_PATH}")
-
-    # final save
-    if rows:
-        final = pd.concat([out, pd.DataFrame(rows)], ignore_index=True) if not out.empty else pd.DataFrame(rows)
-        final.to_csv(OUT_PATH, index=False)
-        print(f"Done. Total rows in rewrites: {len(final)}")
-    else:
-        print("Nothing new to generate (all rows already done).")
+        keys = {c: cell_key(r["id"], r["condition"], c) for c in BACKSTORY_CONDITIONS}
+        if all(k in journal for k in keys.values()):
+            rows.append(build_row(r, {c: journal.records[k]["rewrite"] for c, k in keys.items()}))
+    write_frame(pd.DataFrame(rows), path or output_path(OUT_PATH), store)
+    return rows
+
+def shard_settings() -> dict:
+    """What must be equal across the shards of one merged run (compact() writes model / temperature)."""
+    return {"seeds": IN_PATH, "backend": backend.name, "model": MODEL, "temperature": TEMPERATURE,
+            "max_tokens": MAX_TOKENS}
+
+def merge(df, n):
+    """
+    Fold the journals of N --shard runs into JOURNAL_PATH, then compact the full seed
+    table from it: the same rewrites table one worker would have written.
+    """
+    global MODEL, TEMPERATURE
+    metas = load_metas(output_path(OUT_PATH), n)
+    MODEL, TEMPERATURE = metas[0]["settings"]["model"], metas[0]["settings"]["temperature"]
+    owner = {}
+    with Journal(JOURNAL_PATH, fsync_every=FSYNC_EVERY) as journal:
+        before = len(journal)
+        for i in range(n):
+            with Journal(partition_path(JOURNAL_PATH, (i, n))) as part:
+                keys = list(part.records)
+                wrong = [k for k, ok in zip(keys, in_shard([k[0] for k in keys], (i, n))) if not ok]
+                if wrong:
+                    raise SystemExit(f"{part.path}: {len(wrong)} cells of another shard, e.g. {wrong[0]}")
+                for k in keys:
+                    if k in owner:
+                        raise SystemExit(f"Cannot merge: cell {k} is in shards {owner[k]} and {i}")
+                    owner[k] = i
+                    if k not in journal:
+                        journal.append(part.records[k])
+        journal.sync()
+        print(f"Merged {len(owner)} cells from {n} shard journals "
+              f"({len(journal) - before} new) -> {JOURNAL_PATH}")
+        rows = compact(df, journal)
+    incomplete = len(df) - len(rows)
+    if incomplete:
+        print(f"{incomplete} seed rows still miss a backstory condition (not in the table).")
+    return rows
+
+def report(n_calls, elapsed, retries=None):
+    rate = n_calls / elapsed if elapsed > 0 else float("nan")
+    msg = f"Wall clock: {elapsed:.1f}s | {n_calls} calls | {rate:.2f} calls/s"
+    if retries is not None:
+        msg += f" | {retries} retries"
+    print(msg)
+
+def run_sequential(cells, journal):
+    t0 = time.perf_counter()
+    for r, c, prompt in cells:
+        meter = new_meter(r, c, prompt)
+        meter.started()
+        try:
+            rewrite = call_llm(prompt, meter)
+        except Exception as e:
+            meter.finish(e)
+            raise
+        meter.finish()
+        journal.append(cell_record(r, c, rewrite))
+        print(f"✓ id={r['id']} condition={r['condition']} backstory={c}")
+    journal.sync()
+    report(len(cells), time.perf_counter() - t0)
+
+async def _run_async(cells, journal, concurrency, rpm, tpm, max_retries, base_delay=BASE_DELAY):
+    limiter = RateLimiter(rpm, tpm)
+    retries = 0
+
+    def on_retry(attempt, exc, delay):
+        nonlocal retries
+        retries += 1
+        print(f"  retry #{attempt} in {delay:.1f}s: {type(exc).__name__}: {exc}")
+
+    async def one(r, c, prompt, queued):
+        meter = new_meter(r, c, prompt, queued)
+        meter.started()              # got a concurrency slot
+        try:
+            rewrite = await limited_call(lambda: call_llm_async(prompt, meter), limiter,
+                                         estimate_tokens(SYSTEM + as_text(prompt)) + MAX_TOKENS,
+                                         on_wait=meter.waited, max_retries=max_retries,
+                                         base_delay=base_delay, on_retry=on_retry)
+        except Exception as e:
+            meter.finish(e)
+            raise
+        meter.finish()
+        journal.append(cell_record(r, c, rewrite))   # single event loop: no lock needed
+
+    # every (id, condition, backstory_condition) cell is in flight at once, bounded by the semaphore
+    queued = time.perf_counter()
+    await gather_bounded([one(*cell, queued) for cell in cells], concurrency)
+    return retries
+
+def run_async(cells, journal, concurrency, rpm, tpm, max_retries, base_delay=BASE_DELAY):
+    t0 = time.perf_counter()
+    try:
+        retries = asyncio.run(_run_async(cells, journal, concurrency, rpm, tpm, max_retries, base_delay))
+    finally:
+        journal.sync()
+    report(len(cells), time.perf_counter() - t0, retries)
+    return retries
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Generate none/pos/neg NVC rewrites via an LLM backend.")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=BACKEND)
+    ap.add_argument("--model", default=MODEL)
+    ap.add_argument("--layout", choices=LAYOUTS, default=PROMPT_LAYOUT,
+                    help="prompt layout; 'prefix' puts shared content first for provider prompt caching")
+    ap.add_argument("--async", dest="use_async", action="store_true",
+                    help="issue calls concurrently (asyncio) instead of one at a time")
+    ap.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    ap.add_argument("--rpm", type=float, default=RPM, help="requests/min limit (0 = unlimited)")
+    ap.add_argument("--tpm", type=float, default=TPM, help="tokens/min limit (0 = unlimited)")
+    ap.add_argument("--max-retries", type=int, default=MAX_RETRIES)
+    ap.add_argument("--base-delay", type=float, default=BASE_DELAY, help="retry backoff base (s)")
+    ap.add_argument("--no-cache", action="store_true", help="always call the API")
+    ap.add_argument("--cache-only", action="store_true",
+                    help="serve from the response cache only; fail on the first miss")
+    ap.add_argument("--metrics", default=METRICS_PATH,
+                    help="per-call latency/token records (python src/telemetry.py summary)")
+    ap.add_argument("--no-metrics", action="store_true")
+    add_shard_args(ap)
+    add_fake_args(ap)
+    args = ap.parse_args()
+    if fake_options(args) and args.backend != "fake":
+        ap.error("--fake-* options need --backend fake")
+    return args
+
+def main():
+    global backend, cache, metrics, MODEL, PROMPT_LAYOUT
+    args = parse_args()
+    MODEL, PROMPT_LAYOUT = args.model, args.layout
+    df = read_frame(IN_PATH, columns=["id", "condition", "seed_utterance",
+                                      "positive_backstory", "negative_backstory"])
+    if args.merge:
+        rows = merge(df, args.merge)
+        print(f"Done. Total rows in rewrites: {len(rows)} -> {output_path(OUT_PATH)}")
+        return
+    backend = get_backend(args.backend, **fake_options(args))
+    journal_path, out_path = JOURNAL_PATH, output_path(OUT_PATH)
+    if args.shard:
+        # this worker's seed rows, journal and table; --merge combines them
+        df = df[in_shard(df["id"], args.shard)]
+        journal_path, out_path = partition_path(JOURNAL_PATH, args.shard), partition_path(out_path, args.shard)
+        args.metrics = partition_path(args.metrics, args.shard)
+    if not args.no_cache:
+        cache = LLMCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES,
+                         max_age_days=CACHE_MAX_AGE_DAYS, cache_only=args.cache_only)
+    if not args.no_metrics:
+        metrics = MetricsLog(args.metrics, "rewrites")
+
+    # resume from the journal; a legacy rewrites.csv without a journal is imported once
+    with Journal(journal_path, fsync_every=FSYNC_EVERY) as journal:
+        if len(journal) == 0 and not args.shard and exists(OUT_PATH):
+            journal.import_wide(read_frame(OUT_PATH), BACKSTORY_CONDITIONS)
+        if len(journal):
+            print(f"Found {len(journal)} completed cells in {journal_path}. Will skip them.")
+
+        cells = pending_cells(df, journal)
+        try:
+            if not cells:
+                print("Nothing new to generate (all rows already done).")
+            elif args.use_async:
+                run_async(cells, journal, args.concurrency, args.rpm, args.tpm, args.max_retries,
+                          args.base_delay)
+            else:
+                run_sequential(cells, journal)
+        finally:
+            if metrics is not None:
+                metrics.close()
+                if metrics.records:
+                    print(f"Call metrics: {metrics.records} records -> {metrics.path} "
+                          f"(python src/telemetry.py summary)")
+
+        # a shard keeps its partition's backstories in its own store; --merge
+        # rebuilds the table from the journals and the seeds, so needs none of them
+        rows = compact(df, journal, out_path, store_partition(args.shard) if args.shard else BACKSTORY_STORE)
+    if args.shard:
+        write_meta(out_path, args.shard, shard_settings(), rows=len(rows), cells=len(journal))
+    print(f"Done. Total rows in rewrites: {len(rows)} -> {out_path}")
+    if cache is not None:
+        print(f"Response cache: {cache.stats()} (evicted {cache.evict()})")
+        cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,109 +1,355 @@
 """
-Parses claude_outputs.jsonl (JSON array or concatenated objects) into a CSV,
-then counts harmful markers lexically.
+Parses claude_outputs.jsonl (JSON array, concatenated objects or JSONL) into a
+CSV, then counts harmful markers lexically (shared taxonomy in markers.py). The input is streamed, so
+multi-GB batch-result dumps parse in constant memory; malformed records are
+skipped and reported with their byte offsets.
 
 Run after saving Claude's response to data/processed/claude_outputs.jsonl.
+For a sharded batch (06 --shard), --shards merges the shard_NNN.jsonl
+responses instead and checks them against the shard manifests. Items that are
+missing, duplicated, or not asked for are reported. Duplicates keep their first
+occurrence; items not asked for are left out of the parsed table whenever a
+manifest gives the expected items.
+
+--batch-results ingests provider batch-API result files instead (exported by
+06 --batch-export, see batch_api.py). With --batch-requests, requests that
+got no usable result are reported as missing.
+
+Every object is checked against the output schema (output_schema.py) and is
+valid, repairable (used after a safe fix such as "12" -> 12) or invalid (skipped).
+Without --shards / --batch-results, the manifest 06 wrote next to the prompt
+gives the expected items. Items that are invalid or missing are written to
+RETRY_PATH; 06 --retry prompts for just those, and the response saved as
+claude_outputs_retry.jsonl is merged in on the next run (single-prompt mode
+only; 06 moves it aside when it writes a different single prompt).
+
+--nvc rules|model takes the nvc_* columns from the local detector (nvc.py)
+instead of the LLM's self-annotation; the "nvc" key is then optional, so
+rewrites requested without Task B (and cached ones) are labelled too.
+
+--shard i/N keeps only the objects whose row_id belongs to shard i (sharding.py;
+objects without one go to shard 0) and writes partitions of the parsed table
+and of the retry list; --merge N puts the partitions back in input order.
 """
+import argparse
 import json
-import re
-import pandas as pd
+from collections import Counter, defaultdict
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+from batch_api import iter_results, requested_keys
+from batch_shards import SHARD_DIR, load_manifest, load_manifests
+from checkpoint import cell_key
+from json_stream import iter_json_file, iter_json_text
+from markers import count_markers_frame
+from nvc import METHODS as NVC_METHODS, detector, nvc_frame
+from output_schema import INVALID, REPAIRABLE, VALID, validate, validate_cached, validate_unannotated
+from sharding import add_shard_args, check_disjoint, partition_path, read_partitions, shard_one, write_meta
+from storage import output_path
+from tabular import ChunkedTableWriter
+from telemetry import add_profile_args, profiled
+
 IN_PATH  = Path("data/processed/claude_outputs.jsonl")
-OUT_PATH = Path("data/processed/claude_outputs_parsed.csv")
+CACHED_PATH = Path("data/processed/claude_outputs_cached.jsonl")  # from 06 --from-cache
+MANIFEST_PATH = Path("data/processed/batch_prompt.manifest.json")    # from 06 (single prompt)
+RETRY_RESPONSE_PATH = Path("data/processed/claude_outputs_retry.jsonl")  # response to 06 --retry
+RETRY_PATH = Path("data/processed/retry_items.jsonl")              # items to re-request
+OUT_PATH = Path("data/processed/claude_outputs_parsed.csv")   # written as storage.PIPELINE_FORMAT
+BATCH_ROWS = 50_000   # rows buffered per write
 
-# Lexical taxonomy (from README)
-MARKERS = {
-    "absolutist":  re.compile(
-        r"\b(always|never|every time|all the time|constantly|forever|nothing|everything)\b",
-        re.IGNORECASE),
-    "blame":       re.compile(
-        r"\b(you did|you don'?t|you never|you always|your fault|you made|because of you)\b",
-        re.IGNORECASE),
-    "contempt":    re.compile(
-        r"\b(whatever|fine\.|i don'?t care|forget it|seriously\?|obviously|ridiculous)\b",
-        re.IGNORECASE),
-    "mind_reading": re.compile(
-        r"\b(you think|you just|you only|you want|you feel like|you don'?t care)\b",
-        re.IGNORECASE),
-}
+NVC_COMPONENTS = ["observation", "feeling", "need", "request", "empathy"]
+# nullable ints: 0/1 flags stay integers even when a batch has unannotated rows
+NVC_DTYPES = {f"nvc_{c}": "Int64" for c in NVC_COMPONENTS + ["total"]}
 
+def iter_json_objects(text: str):
+    """Parse a JSON array, concatenated objects or JSONL from a string (see json_stream.py)."""
+    yield from iter_json_text(text)
 
-def count_markers(text: str) -> dict:
-    return {k: len(pat.findall(text)) for k, pat in MARKERS.items()}
 
+def parse_row(obj: dict) -> dict:
+    """Row without marker columns; those are added per batch by score_batch()."""
+    nvc = obj.get("nvc")
+    if nvc is None:   # cache-filled rewrite: not annotated
+        nvc_row = {c: None for c in NVC_COMPONENTS}
+    else:
+        nvc_row = {c: int(bool(nvc.get(c, {}).get("present", False)))
+                   for c in NVC_COMPONENTS}
+    return {
+        "row_id":              obj.get("row_id"),
+        "mturk_condition":     obj.get("mturk_condition"),
+        "backstory_condition": obj.get("backstory_condition"),
+        "rewrite":             obj.get("rewrite", ""),
+        **{f"nvc_{c}": v for c, v in nvc_row.items()},
+        "nvc_total":           None if nvc is None else sum(nvc_row.values()),
+    }
 
-def iter_json_objects(text: str):
-    """Parse a JSON array or concatenated JSON objects robustly."""
-    text = text.strip()
-    # Case 1: it's a JSON array
-    if text.startswith("["):
-        try:
-            objs = json.loads(text)
-            yield from objs
-            return
-        except json.JSONDecodeError:
-            pass
-    # Case 2: concatenated / pretty-printed objects
-    buf, depth, in_str, esc = "", 0, False, False
-    for ch in text:
-        buf += ch
-        if in_str:
-            if esc:    esc = False
-            elif ch == "\\": esc = True
-            elif ch == '"':  in_str = False
-            continue
-        if ch == '"':  in_str = True; continue
-        if ch == "{":  depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                s = buf.strip(); buf = ""
-                if s:
-                    yield json.loads(s)
 
+def score_batch(rows: list, detect=None) -> pd.DataFrame:
+    """
+    Lexical harmful-marker counts for a batch of rows, one scan per batch (markers.py);
+    with `detect` (nvc.detector) the nvc_* columns are replaced by its labels.
+    """
+    df = pd.DataFrame(rows)
+    if detect is not None:
+        df[list(NVC_DTYPES)] = nvc_frame(detect(df["rewrite"]))
+    markers = count_markers_frame(df["rewrite"])
+    return pd.concat([df.iloc[:, :4], markers, df.iloc[:, 4:]], axis=1)
 
-def main():
-    if not IN_PATH.exists():
-        raise FileNotFoundError(
-            f"Missing {IN_PATH}.\n"
-            "Paste Claude's JSON response there, then re-run.")
-
-    text = IN_PATH.read_text(encoding="utf-8").strip()
-    if not text:
-        print("claude_outputs.jsonl is empty — paste Claude's response first.")
+
+def owner(obj, n: int) -> int:
+    """Shard of an object's row_id (0 when it has none usable)."""
+    try:
+        return shard_one(int(obj["row_id"]), n)
+    except (KeyError, TypeError, ValueError, IndexError):
+        return 0
+
+
+def row_key(obj: dict):
+    """(row_id, mturk_condition, backstory_condition), or None if the object lacks one."""
+    try:
+        return cell_key(obj["row_id"], obj["mturk_condition"], obj["backstory_condition"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def shard_sources(shard_dir: Path):
+    """([response files], {item key: shard}) from the manifests written by 06 --shard."""
+    manifests = load_manifests(shard_dir)
+    if not manifests:
+        raise FileNotFoundError(f"No shard manifests in {shard_dir}. Run 06 with --shard first.")
+    sources, expected = [], {}
+    for m in manifests:
+        if m["stale"]:
+            print(f"Warning: {m['prompt_file']} no longer matches its manifest checksum")
+        out = shard_dir / m["output_file"]
+        if out.exists() and out.stat().st_size > 0:
+            sources.append(out)
+        else:
+            print(f"Missing response: {out} ({len(m['items'])} items)")
+        for k in m["items"]:
+            expected[cell_key(*k)] = m["shard"]
+    print(f"Merging {len(sources)}/{len(manifests)} shard responses, {len(expected)} items expected")
+    return sources, expected
+
+
+def prompt_sources():
+    """([IN_PATH], {item key: prompt file}) with the 06 manifest, or ([IN_PATH], None) without."""
+    if not MANIFEST_PATH.exists():
+        return [IN_PATH], None
+    m = load_manifest(MANIFEST_PATH)
+    if m["stale"]:
+        print(f"Warning: {m['prompt_file']} no longer matches its manifest checksum")
+    return [IN_PATH], {cell_key(*k): m["prompt_file"] for k in m["items"]}
+
+
+def report_validation(counts, invalid, repaired):
+    print(f"Validated {sum(counts.values())} objects: {counts[VALID]} valid, "
+          f"{counts[REPAIRABLE]} repaired, {counts[INVALID]} invalid")
+    for label, rows in (("invalid", invalid), ("repaired", repaired)):
+        for where, key, notes in rows[:10]:
+            print(f"  {label}: {key or '(no item key)'} ({where}): {'; '.join(notes)}")
+        if len(rows) > 10:
+            print(f"  ... {len(rows) - 10} more {label}")
+
+
+def write_retry(failed: dict, path: Path = RETRY_PATH, order: dict | None = None):
+    """
+    Item keys to re-request (with the reason), or remove a stale retry file.
+    `order` (--shard) adds each item's position in the single-run list for --merge.
+    """
+    if not failed:
+        path.unlink(missing_ok=True)
         return
+    with open(path, "w", encoding="utf-8") as f:
+        for key, reason in failed.items():
+            row_id, mturk, cond = key
+            rec = {"row_id": row_id, "mturk_condition": mturk, "backstory_condition": cond, "reason": reason}
+            if order is not None:
+                rec["_order"] = order[key]
+            f.write(json.dumps(rec) + "\n")
+    print(f"Retry: {len(failed)} items -> {path} "
+          f"(python3 src/06_generate_batch_prompt.py --retry {path})")
 
-    objs = list(iter_json_objects(text))
-    if not objs:
-        print("No JSON objects found. Check the file contents.")
+
+def merge(n: int):
+    """Combine the --shard partitions in input order (the table a single run writes)."""
+    path = output_path(OUT_PATH)
+    df, metas = read_partitions(path, n, "row_id")
+    print(f"Merging {n} parsed partitions ({sum(m['rows'] for m in metas)} rows)")
+    if not df.empty:
+        check_disjoint(df, ["row_id", "mturk_condition", "backstory_condition"], path)
+        df = df.iloc[np.lexsort((df["_obj"].astype("int64"), df["_src"].astype("int64")))]
+    cols = [c for c in df.columns if not c.startswith("_")]
+    # same batch boundaries (and so Parquet row groups) as the single run
+    with ChunkedTableWriter(path, dtypes=NVC_DTYPES if path.suffix == ".parquet" else None) as writer:
+        for start in range(0, len(df), BATCH_ROWS):
+            writer.write(df.iloc[start:start + BATCH_ROWS][cols].reset_index(drop=True))
+    retry = sorted((json.loads(line) for i in range(n)
+                    if (p := partition_path(RETRY_PATH, (i, n))).exists()
+                    for line in p.read_text(encoding="utf-8").splitlines()), key=lambda r: r["_order"])
+    write_retry({(r["row_id"], r["mturk_condition"], r["backstory_condition"]): r["reason"] for r in retry})
+    if writer.rows == 0:
         return
+    print(f"Saved -> {writer.path} ({writer.rows} rows)")
+    print("\nMean harmful marker count by backstory condition:")
+    means = pd.to_numeric(df["marker_total"]).groupby(df["backstory_condition"]).mean()
+    print(means.rename("marker_total").rename_axis("backstory_condition").sort_index().round(2))
 
-    NVC_COMPONENTS = ["observation", "feeling", "need", "request", "empathy"]
 
-    rows = []
-    for obj in objs:
-        rewrite = obj.get("rewrite", "")
-        markers = count_markers(rewrite)
-        nvc = obj.get("nvc", {})
-        nvc_row = {c: int(bool(nvc.get(c, {}).get("present", False)))
-                   for c in NVC_COMPONENTS}
-        rows.append({
-            "row_id":              obj.get("row_id"),
-            "mturk_condition":     obj.get("mturk_condition"),
-            "backstory_condition": obj.get("backstory_condition"),
-            "rewrite":             rewrite,
-            **{f"marker_{k}": v for k, v in markers.items()},
-            "marker_total":        sum(markers.values()),
-            **{f"nvc_{c}": v for c, v in nvc_row.items()},
-            "nvc_total":           sum(nvc_row.values()),
-        })
+def report_merge(expected, seen, duplicates, unexpected):
+    missing = [k for k in expected if k not in seen]
+    print(f"Items: {len(missing)} missing, {len(duplicates)} duplicate, {len(unexpected)} unexpected")
+    for label, keys in (("missing", [(expected[k], k) for k in missing]),
+                        ("duplicate", duplicates), ("unexpected (not written)", unexpected)):
+        for where, key in keys[:20]:
+            src = f"shard_{where:03d}" if isinstance(where, int) else where
+            print(f"  {label}: {key} ({src})")
+        if len(keys) > 20:
+            print(f"  ... {len(keys) - 20} more {label}")
 
-    df = pd.DataFrame(rows)
-    df.to_csv(OUT_PATH, index=False)
-    print(f"Saved -> {OUT_PATH} ({len(df)} rows)")
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Parse LLM rewrite outputs and score markers.")
+    ap.add_argument("--shards", type=Path, nargs="?", const=SHARD_DIR, default=None,
+                    help=f"merge sharded responses from this directory (default {SHARD_DIR})")
+    ap.add_argument("--batch-results", type=Path, nargs="+", metavar="PATH",
+                    help="ingest provider batch-API result JSONL file(s)")
+    ap.add_argument("--batch-requests", type=Path, metavar="PATH",
+                    help="the exported request file, to report requests without a result")
+    ap.add_argument("--nvc", choices=("llm",) + NVC_METHODS, default="llm",
+                    help="nvc_* from the LLM's self-annotation or the local detector (nvc.py)")
+    add_shard_args(ap)
+    add_profile_args(ap)
+    return ap.parse_args()
+
+
+def run(args):
+    if args.merge:
+        merge(args.merge)
+        return
+    shard = args.shard
+    out_path, retry_path = output_path(OUT_PATH), RETRY_PATH
+    if shard:
+        out_path, retry_path = partition_path(out_path, shard), partition_path(RETRY_PATH, shard)
+    expected, batch_sources = None, set()
+    if args.shards:
+        sources, expected = shard_sources(args.shards)
+    elif args.batch_results:
+        sources = list(args.batch_results)
+        batch_sources = set(sources)
+        if args.batch_requests:
+            expected = {k: args.batch_requests.name for k in requested_keys(args.batch_requests)}
+    else:
+        if not IN_PATH.exists():
+            raise FileNotFoundError(
+                f"Missing {IN_PATH}.\n"
+                "Paste Claude's JSON response there, then re-run.")
+
+        if IN_PATH.stat().st_size == 0:
+            print("claude_outputs.jsonl is empty — paste Claude's response first.")
+            return
+        sources, expected = prompt_sources()
+        if RETRY_RESPONSE_PATH.exists():
+            sources.append(RETRY_RESPONSE_PATH)
+
+    if CACHED_PATH.exists() and CACHED_PATH not in sources:
+        sources.append(CACHED_PATH)
+    if shard and expected is not None:
+        expected_pos = {k: i for i, k in enumerate(expected)}
+        expected = {k: v for k, v in expected.items() if shard_one(k[0], shard[1]) == shard[0]}
+    errors = []                      # (path, byte offset, message)
+    seen, duplicates, unexpected = set(), [], []   # item keys; (path, key) lists
+    counts, invalid, repaired = Counter(), [], []  # validation; (path, key, notes) lists
+    order = {}                       # --shard: item key -> position in the single-run retry list
+    marker_sum, n_by_cond = defaultdict(int), defaultdict(int)
+    detect = None if args.nvc == "llm" else detector(args.nvc)
+    annotated = validate if detect is None else validate_unannotated
+
+    def flush(batch):
+        if batch:
+            df = score_batch(batch, detect)
+            for cond, g in df.groupby("backstory_condition", dropna=False)["marker_total"]:
+                marker_sum[cond] += g.sum()
+                n_by_cond[cond] += len(g)
+            writer.write(df)
+
+    # stream objects -> rows -> file in batches; nothing is held beyond one batch
+    with ChunkedTableWriter(out_path, dtypes=NVC_DTYPES) as writer:
+        batch = []
+        for src, path in enumerate(sources):
+            errs = []
+            n_before = writer.rows + len(batch)
+            objs = (iter_results(path, errs) if path in batch_sources
+                    else (obj for _, obj in iter_json_file(path, errs)))
+            check = validate_cached if path == CACHED_PATH else annotated
+            for ordinal, obj in enumerate(objs):
+                if shard and owner(obj, shard[1]) != shard[0]:
+                    continue
+                status, fixed, notes = check(obj)
+                counts[status] += 1
+                if status == INVALID:
+                    invalid.append((path.name, row_key(obj) if isinstance(obj, dict) else None, notes))
+                    order.setdefault(invalid[-1][1], (0, src, ordinal))
+                    continue
+                if status == REPAIRABLE:
+                    repaired.append((path.name, row_key(fixed), notes))
+                obj = fixed
+                key = row_key(obj)
+                if key is not None:
+                    if key in seen:
+                        duplicates.append((path.name, key))
+                        continue
+                    seen.add(key)
+                    if expected is not None and path != CACHED_PATH and key not in expected:
+                        unexpected.append((path.name, key))
+                        continue
+                row = parse_row(obj)
+                if shard:
+                    row["_src"], row["_obj"] = src, ordinal   # input order, for --merge
+                batch.append(row)
+                if len(batch) >= BATCH_ROWS:
+                    flush(batch)
+                    batch = []
+            if not shard or shard[0] == 0:        # keyless: reported once, by shard 0
+                errors += [(path, off, msg) for off, msg in errs]
+            if path == CACHED_PATH:
+                print(f"+ {writer.rows + len(batch) - n_before} cached rewrites from {CACHED_PATH}")
+        flush(batch)
+
+    if errors:
+        print(f"Skipped {len(errors)} failed or malformed record(s):")
+        for path, off, msg in errors[:20]:
+            print(f"  {path} @ byte {off}: {msg}")
+    report_validation(counts, invalid, repaired)
+    if expected is not None or duplicates:
+        report_merge(expected or {}, seen, duplicates, unexpected)
+    failed = {key: "; ".join(notes) for _, key, notes in invalid
+              if key is not None and key not in seen and (expected is None or key in expected)}
+    failed |= {k: "missing" for k in (expected or {}) if k not in seen and k not in failed}
+    if shard:
+        order |= {k: (1, expected_pos[k], 0) for k in failed if failed[k] == "missing" and k not in order}
+    write_retry(failed, retry_path, order if shard else None)
+    if shard:
+        write_meta(out_path, shard, {"sources": [[str(p), p.stat().st_size] for p in sources],
+                                     "expected": expected is not None, "nvc": args.nvc}, rows=writer.rows)
+    if errors and expected is None:
+        print("  (malformed records have no item key; a manifest from 06 lists them as missing)")
+    if writer.rows == 0:
+        print("No JSON objects found. Check the file contents.")
+        return
+
+    print(f"Saved -> {writer.path} ({writer.rows} rows)")
     print("\nMean harmful marker count by backstory condition:")
-    print(df.groupby("backstory_condition")["marker_total"].mean().round(2))
+    means = pd.Series({k: marker_sum[k] / n_by_cond[k] for k in n_by_cond}, name="marker_total")
+    print(means.rename_axis("backstory_condition").sort_index().round(2))
+
+
+def main():
+    args = parse_args()
+    with profiled("parse", args):
+        run(args)
 
 
 if __name__ == "__main__":
@@ -2,67 +2,67 @@
 Compares harmful markers: original (dataset VC labels) vs. rewrites (lexical).
 Requires: data/processed/claude_outputs_parsed.csv
 Run after: python3 src/04_parse_claude_outputs.py
+Writes: data/processed/stats_paired.csv (paired bootstrap CIs + sign-flip p-values)
+        data/processed/condition_summary.csv (count / mean / std per backstory condition)
+Caches: data/processed/intent_vocab.npz, intent_cache.parquet (see intent.py)
+
+Intent preservation is the char n-gram TF-IDF cosine between each rewrite and
+its seed utterance (intent.py). It is reported per backstory condition and goes
+through the same paired contrasts as the marker counts. The vocabulary is
+fitted once over the seeds + rewrites and cached; scores are cached per pair,
+so a re-run only vectorises new pairs (--refit-intent starts over).
+
+--stream reads the parsed rewrites in chunks instead of loading them. Each
+chunk is joined against an in-memory index of the seeds by
+(row_id, mturk_condition) and folded into online accumulators: per-condition
+count/mean/variance (Welford) and per-item condition means for the paired
+deltas. The printed tables are the same as the in-memory run's. Memory grows
+with the number of distinct items, not with the number of rewrites. The
+per-row detail keeps only the top --detail-limit rows by orig_vc_count
+(default 50, ties in file order); --detail-limit 0 keeps every row, which
+grows with the rewrites again.
+
+--shard i/N joins and scores only the rewrites of its dialogue ids and writes
+them to data/processed/analysis_rows.shard<i>of<N>.parquet (see sharding.py);
+intent scores go to a per-shard cache. --merge N concatenates the partitions in
+the parsed file's row order and prints/writes the same tables as one run.
 """
-import re
+import argparse
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 
+from intent import CACHE_PATH, IntentScorer, load_or_fit
+from markers import MARKER_COLS, count_markers_frame
+from sharding import add_shard_args, in_shard, partition_path, read_partitions, write_meta
+from stats import N_RESAMPLES, GroupedWelford, ItemMeans, contrast_table, item_means
+from storage import iter_frames, read_frame
+from tabular import write_table
+from telemetry import add_profile_args, profiled
+
 IN_PATH   = "data/processed/claude_outputs_parsed.csv"
 SEED_PATH = "data/processed/mturk_seeds_10ids.csv"
+STATS_PATH = "data/processed/stats_paired.csv"
+SUMMARY_PATH = "data/processed/condition_summary.csv"
+ROWS_PATH = "data/processed/analysis_rows.parquet"   # --shard partitions
+CHUNK_ROWS = 100_000    # --stream
+DETAIL_LIMIT = 50       # --stream: per-row detail lines kept (0 = all)
+INTENT_COL = "intent_cosine"
 
-# Expanded lexical taxonomy aligned with VC types in PersonaConflicts
-MARKERS = {
-    # Absolutist / Overgeneralization
-    "absolutist": re.compile(
-        r"\b(always|never|every time|all the time|constantly|forever|"
-        r"nothing|everything|everyone|nobody|no one)\b", re.I),
-    # Blame / Accusation
-    "blame": re.compile(
-        r"\b(you did|you don'?t|you never|you always|your fault|you made|"
-        r"because of you|you caused|you ruined|you broke|you lost)\b", re.I),
-    # Contempt / Dismissal
-    "contempt": re.compile(
-        r"\b(whatever|i don'?t care|forget it|seriously\?|obviously|ridiculous|"
-        r"how on earth|what on earth|good luck with that|as if|yeah right)\b"
-        r"|fine\.", re.I),
-    # Mind-reading / Assumption
-    "mind_reading": re.compile(
-        r"\b(you think|you just|you only|you want|you feel like|you don'?t care|"
-        r"you clearly|you obviously|you never care|you always think)\b", re.I),
-    # Moralistic judgment
-    "moralistic": re.compile(
-        r"\b(you should(n'?t)?|you need to|you must|you have to|"
-        r"you ought to|that'?s wrong|that'?s bad|irresponsible|selfish|"
-        r"makes you the expert|your fair share of)\b", re.I),
-    # Demands
-    "demands": re.compile(
-        r"\b(won'?t you|you better|you will|do it now|"
-        r"this won'?t sort itself|just do it)\b", re.I),
-    # Sarcasm markers
-    "sarcasm": re.compile(
-        r"\b(huh,|I guess (that|you)|magic thing|how do you manage|"
-        r"congratulations on|great job on)\b", re.I),
-}
-
-MARKER_COLS = [f"marker_{k}" for k in MARKERS] + ["marker_total"]
-
-
-def count_markers(text: str) -> dict:
-    counts = {k: len(pat.findall(str(text))) for k, pat in MARKERS.items()}
-    counts["total"] = sum(counts.values())
-    return counts
+NVC_COMPONENTS = ["observation", "feeling", "need", "request", "empathy"]
+NVC_COLS = [f"nvc_{c}" for c in NVC_COMPONENTS] + ["nvc_total"]
+SEED_COLS = ["row_id", "mturk_condition", "seed_utterance", "orig_vc_count", "orig_vc_labels"]
+BASE_COLS = ["row_id", "orig_vc_count", "orig_vc_labels", "marker_total"]
 
 
-def main():
-    df    = pd.read_csv(IN_PATH)
-    seeds = pd.read_csv(SEED_PATH)
-    seeds = seeds.rename(columns={"id": "row_id", "condition": "mturk_condition"})
+def load_seeds() -> pd.DataFrame:
+    seeds = read_frame(SEED_PATH, columns=["id", "condition", "seed_utterance",
+                                           "orig_vc_count", "orig_vc_labels"])
+    return seeds.rename(columns={"id": "row_id", "condition": "mturk_condition"})
 
-    merged = df.merge(
-        seeds[["row_id", "mturk_condition", "seed_utterance",
-               "orig_vc_count", "orig_vc_labels"]],
-        on=["row_id", "mturk_condition"], how="left"
-    )
 
+def print_original(seeds):
     print("=== Original utterances: VC label counts (dataset annotation) ===")
     orig = seeds.drop_duplicates("row_id")
     print(f"  mean VC count  = {orig['orig_vc_count'].mean():.3f}")
@@ -73,59 +73,290 @@ def main():
     label_counts = pd.Series(all_labels).value_counts()
     print(label_counts.to_string())
 
-    NVC_COMPONENTS = ["observation", "feeling", "need", "request", "empathy"]
-    nvc_cols = [f"nvc_{c}" for c in NVC_COMPONENTS] + ["nvc_total"]
 
+def detail_frame(rows: pd.DataFrame, nvc_show: list) -> pd.DataFrame:
+    """backstory=none rows for the per-row table, rewrite cut to 60 chars."""
+    none_rows = rows[rows["backstory_condition"] == "none"][
+        BASE_COLS + nvc_show + ["rewrite"]
+    ].copy()
+    none_rows["rewrite"] = none_rows["rewrite"].str[:60] + "…"
+    return none_rows
+
+
+def intent_scorer(seeds, rewrites, refit: bool = False, cache_path=CACHE_PATH) -> IntentScorer:
+    """
+    Scorer over the cached vocabulary, fitted first if needed on every seed
+    utterance + rewrite. `rewrites` is a callable returning an iterable of
+    texts, so --stream only makes the extra pass when there is no vocabulary.
+    """
+    def texts():
+        yield from seeds.drop_duplicates(["row_id", "mturk_condition"])["seed_utterance"].dropna()
+        yield from (t for t in rewrites() if isinstance(t, str))
+    return IntentScorer(load_or_fit(texts, refit=refit), cache_path)
+
+
+def analyze_in_memory(seeds, intent: bool = True, refit_intent: bool = False) -> dict:
+    df = read_frame(IN_PATH)
+    df[MARKER_COLS] = count_markers_frame(df["rewrite"])
+    scorer = intent_scorer(seeds, lambda: df["rewrite"], refit_intent) if intent else None
+    tables = aggregate(df, seeds, scorer)
+    if scorer:
+        scorer.save()
+    return tables
+
+
+def analyze_shard(seeds, shard, intent: bool = True, refit_intent: bool = False) -> Path:
+    """Joined + scored rows of one shard's dialogue ids -> partition of ROWS_PATH."""
+    df = read_frame(IN_PATH)
+    scorer = None
+    if intent:
+        # same vocabulary as a single run: fitted over every rewrite, not the shard's
+        scorer = intent_scorer(seeds, lambda: df["rewrite"], refit_intent,
+                               partition_path(CACHE_PATH, shard))
+    pos = np.flatnonzero(in_shard(df["row_id"].astype("int64"), shard))
+    df = df.iloc[pos].reset_index(drop=True)
+    df[MARKER_COLS] = count_markers_frame(df["rewrite"])
+    rows = join_seeds(df, seeds, scorer)
+    rows["_pos"] = pos
+    if scorer:
+        scorer.save()
+    part = partition_path(ROWS_PATH, shard)
+    part.parent.mkdir(parents=True, exist_ok=True)
+    write_table(rows, part)
+    write_meta(part, shard, {"input": IN_PATH, "seeds": SEED_PATH,
+                             "intent": scorer.vocab.fingerprint if scorer else None}, rows=len(rows))
+    print(f"Shard {shard[0]}/{shard[1]}: {len(rows):,} of the parsed rewrites -> {part}")
+    return part
+
+
+def merge_rows(n: int) -> dict:
+    """The tables of a single in-memory run, from the --shard partitions."""
+    rows, _ = read_partitions(ROWS_PATH, n, "row_id")
+    if rows.empty:
+        raise ValueError(f"{ROWS_PATH} partitions have no rows")
+    rows = rows.sort_values("_pos", kind="stable").drop(columns=["_pos", "_shard"]).reset_index(drop=True)
+    print(f"\nMerged {len(rows):,} rows from {n} partitions of {ROWS_PATH}")
+    return summarize(rows)
+
+
+def join_seeds(df: pd.DataFrame, seeds: pd.DataFrame, scorer: IntentScorer | None = None) -> pd.DataFrame:
+    """Rewrites with their seed columns (+ INTENT_COL when a scorer is given)."""
+    merged = df.merge(seeds[SEED_COLS], on=["row_id", "mturk_condition"], how="left")
+    if scorer:
+        merged[INTENT_COL] = scorer.score(merged["seed_utterance"], merged["rewrite"])
+    return merged
+
+
+def aggregate(df: pd.DataFrame, seeds: pd.DataFrame, scorer: IntentScorer | None = None) -> dict:
+    """Join scored rewrites to their seeds and build every table report() prints."""
+    return summarize(join_seeds(df, seeds, scorer))
+
+
+def summarize(merged: pd.DataFrame) -> dict:
+    """Tables of report() from rewrites already joined to their seeds."""
+    has_nvc = "nvc_total" in merged.columns
+    scored = INTENT_COL in merged.columns
+    nvc_show = [c for c in NVC_COLS if c in merged.columns]
+    metrics = nvc_show + MARKER_COLS + ([INTENT_COL] if scored else [])
+    by_cond = merged.groupby("backstory_condition")
+    summary_cols = metrics + ["orig_vc_count"]
+    return {
+        "markers": by_cond[MARKER_COLS].mean(),
+        "orig_vc_mean": by_cond["orig_vc_count"].mean(),
+        "marker_total_mean": by_cond["marker_total"].mean(),
+        "nvc": by_cond[NVC_COLS].mean() if has_nvc else None,
+        "intent": by_cond[INTENT_COL].agg(["count", "mean", "std"]) if scored else None,
+        "pivot_nvc": merged.pivot_table(index=["row_id", "mturk_condition"],
+                                        columns="backstory_condition",
+                                        values=NVC_COLS) if has_nvc else None,
+        "wide": item_means(merged, metrics),
+        "metrics": metrics,
+        "summary": {stat: by_cond[summary_cols].agg(stat) for stat in ("count", "mean", "std")},
+        "detail": detail_frame(merged, nvc_show),
+    }
+
+
+def top_rows(detail: pd.DataFrame, k: int) -> pd.DataFrame:
+    """The k rows with the highest orig_vc_count; ties keep their global row order."""
+    return detail.sort_index().sort_values("orig_vc_count", ascending=False, kind="stable").head(k)
+
+
+def analyze_streaming(seeds, chunk_rows: int = CHUNK_ROWS, detail_limit: int = DETAIL_LIMIT,
+                      intent: bool = True, refit_intent: bool = False) -> dict:
+    """Same tables as analyze_in_memory(), from chunks of the parsed rewrites."""
+    seeds = seeds.drop_duplicates(["row_id", "mturk_condition"])
+    seed_index = pd.MultiIndex.from_frame(seeds[["row_id", "mturk_condition"]].astype({"row_id": "int64"}))
+    seed_vc = seeds["orig_vc_count"].to_numpy(dtype=np.float64, na_value=np.nan)
+    seed_labels = seeds["orig_vc_labels"].to_numpy(dtype=object)
+    seed_texts = seeds["seed_utterance"].to_numpy(dtype=object)
+    scorer = None
+    if intent:
+        scorer = intent_scorer(seeds, lambda: (t for part in iter_frames(IN_PATH, columns=["rewrite"],
+                                                                         batch_rows=chunk_rows)
+                                               for t in part["rewrite"]), refit_intent)
+
+    cond_stats = items = metrics = None
+    detail, n_seen, unmatched = [], 0, False
+    for chunk in iter_frames(IN_PATH, batch_rows=chunk_rows):
+        chunk = chunk.reset_index(drop=True)
+        chunk[MARKER_COLS] = count_markers_frame(chunk["rewrite"])
+        if metrics is None:
+            has_nvc = "nvc_total" in chunk.columns
+            nvc_show = [c for c in NVC_COLS if c in chunk.columns]
+            metrics = nvc_show + MARKER_COLS + ([INTENT_COL] if scorer else [])
+            cond_stats = GroupedWelford(metrics + ["orig_vc_count"])
+            items = ItemMeans(metrics)
+        # join against the seed index: position of each row's seed, -1 if none
+        pos = seed_index.get_indexer(pd.MultiIndex.from_arrays(
+            [chunk["row_id"].astype("int64"), chunk["mturk_condition"]]))
+        chunk["orig_vc_count"] = np.where(pos >= 0, seed_vc[pos], np.nan)
+        unmatched |= bool((pos < 0).any())
+        chunk["orig_vc_labels"] = np.where(pos >= 0, seed_labels[pos], None)
+        if scorer:
+            chunk[INTENT_COL] = scorer.score(np.where(pos >= 0, seed_texts[pos], None), chunk["rewrite"])
+
+        valid = chunk["backstory_condition"].notna().to_numpy()
+        values = chunk[metrics].to_numpy(dtype=np.float64, na_value=np.nan)
+        conds = chunk["backstory_condition"].to_numpy(dtype=object)
+        vc = chunk[["orig_vc_count"]].to_numpy(dtype=np.float64)
+        cond_stats.update(conds[valid], np.hstack([values, vc])[valid])
+        keys = list(zip(chunk["row_id"].astype("int64").tolist(), chunk["mturk_condition"].tolist()))
+        items.update([k for k, v in zip(keys, valid) if v], conds[valid], values[valid])
+
+        part = detail_frame(chunk, nvc_show)
+        part.index = part.index + n_seen          # global row order for tie-breaking
+        if detail_limit:
+            # top-k of the chunk, then of it and the rows kept so far
+            part = top_rows(part, detail_limit)
+            detail = [top_rows(pd.concat(detail + [part]), detail_limit)]
+        else:
+            detail.append(part)
+        n_seen += len(chunk)
+
+    if metrics is None:
+        raise ValueError(f"{IN_PATH} has no rows")
+    if scorer:
+        scorer.save()
+    detail = pd.concat(detail) if detail else pd.DataFrame(columns=BASE_COLS + nvc_show + ["rewrite"])
+    if not unmatched:
+        # a left merge keeps the seed dtype when every row found its seed
+        detail["orig_vc_count"] = detail["orig_vc_count"].astype(seeds["orig_vc_count"].dtype)
+    means = cond_stats.frame("mean")
+    wide = items.wide()
+    pivot_nvc = None
+    if has_nvc:
+        pivot_nvc = wide[[c for c in wide.columns if c[0] in NVC_COLS]].dropna(axis=1, how="all")
+    return {
+        "markers": means[MARKER_COLS],
+        "orig_vc_mean": means["orig_vc_count"],
+        "marker_total_mean": means["marker_total"],
+        "nvc": means[NVC_COLS] if has_nvc else None,
+        "intent": pd.DataFrame({stat: cond_stats.frame(stat)[INTENT_COL]
+                                for stat in ("count", "mean", "std")}) if scorer else None,
+        "pivot_nvc": pivot_nvc,
+        "wide": wide,
+        "metrics": metrics,
+        "summary": {stat: cond_stats.frame(stat) for stat in ("count", "mean", "std")},
+        "detail": detail,
+    }
+
+
+def print_deltas(pivot_nvc):
+    for comp in ["nvc_empathy", "nvc_feeling", "nvc_need"]:
+        cols_flat = [c for c in pivot_nvc.columns if c[0] == comp]
+        if len(cols_flat) < 2:
+            continue
+        sub = pivot_nvc[[c for c in pivot_nvc.columns if c[0] == comp]]
+        sub.columns = [c[1] for c in sub.columns]
+        for cond in ["pos", "neg"]:
+            if cond in sub.columns and "none" in sub.columns:
+                delta = (sub[cond] - sub["none"]).mean()
+                print(f"  {comp:15s}  {cond} − none = {delta:+.3f}")
+
+
+def summary_table(summary: dict) -> pd.DataFrame:
+    """Tidy (backstory_condition, metric, n, mean, std)."""
+    parts = [summary[stat].rename_axis("backstory_condition").reset_index()
+             .melt(id_vars="backstory_condition", var_name="metric", value_name=name)
+             for stat, name in (("count", "n"), ("mean", "mean"), ("std", "std"))]
+    out = parts[0].merge(parts[1], on=["backstory_condition", "metric"]).merge(
+        parts[2], on=["backstory_condition", "metric"])
+    out["n"] = out["n"].astype("int64")
+    return out
+
+
+def report(t: dict):
     print("\n=== Rewrite: lexical harmful markers by backstory condition ===")
-    for k, pat in MARKERS.items():
-        df[f"marker_{k}"] = df["rewrite"].apply(lambda x: len(pat.findall(str(x))))
-    df["marker_total"] = df[[f"marker_{k}" for k in MARKERS]].sum(axis=1)
-    merged = df.merge(
-        seeds[["row_id", "mturk_condition", "seed_utterance",
-               "orig_vc_count", "orig_vc_labels"]],
-        on=["row_id", "mturk_condition"], how="left"
-    )
-    print(merged.groupby("backstory_condition")[MARKER_COLS].mean().round(3))
+    print(t["markers"].rename_axis("backstory_condition").round(3))
 
     print("\n=== Key comparison: orig VC count vs rewrite marker total ===")
-    summary = merged.groupby("backstory_condition").agg(
-        orig_vc_mean=("orig_vc_count", "mean"),
-        rewrite_marker_mean=("marker_total", "mean"),
-    ).round(3)
+    summary = pd.DataFrame({"orig_vc_mean": t["orig_vc_mean"],
+                            "rewrite_marker_mean": t["marker_total_mean"]}).round(3)
+    summary.index.name = "backstory_condition"
     summary["reduction"] = (summary["orig_vc_mean"] - summary["rewrite_marker_mean"]).round(3)
     print(summary)
 
+    if t["intent"] is not None:
+        print("\n=== Intent preservation: seed vs rewrite char n-gram TF-IDF cosine ===")
+        intent = t["intent"].rename_axis("backstory_condition").rename(columns={"count": "n"})
+        intent["n"] = intent["n"].astype("int64")
+        print(intent.round(3))
+
     # NVC component analysis (only if annotation data present)
-    if "nvc_total" in df.columns:
+    if t["nvc"] is not None:
         print("\n=== NVC component presence by backstory condition ===")
         print("(1 = present in rewrite, mean across items)")
-        print(merged.groupby("backstory_condition")[nvc_cols].mean().round(3))
+        print(t["nvc"].rename_axis("backstory_condition").round(3))
 
         print("\n=== Hypothesis: does backstory increase empathy/feeling/need? ===")
-        pivot_nvc = merged.pivot_table(
-            index=["row_id", "mturk_condition"],
-            columns="backstory_condition",
-            values=nvc_cols
-        )
-        for comp in ["nvc_empathy", "nvc_feeling", "nvc_need"]:
-            cols_flat = [c for c in pivot_nvc.columns if c[0] == comp]
-            if len(cols_flat) < 2:
-                continue
-            sub = pivot_nvc[[c for c in pivot_nvc.columns if c[0] == comp]]
-            sub.columns = [c[1] for c in sub.columns]
-            for cond in ["pos", "neg"]:
-                if cond in sub.columns and "none" in sub.columns:
-                    delta = (sub[cond] - sub["none"]).mean()
-                    print(f"  {comp:15s}  {cond} − none = {delta:+.3f}")
+        print_deltas(t["pivot_nvc"])
+
+    print(f"\n=== Paired contrasts vs none: bootstrap 95% CI, sign-flip p ({N_RESAMPLES:,} resamples) ===")
+    tests = contrast_table(t["wide"], t["metrics"])
+    write_table(tests, STATS_PATH)
+    with pd.option_context("display.width", 200):
+        print(tests.round(3).to_string(index=False))
+    print(f"  -> {STATS_PATH}")
+    write_table(summary_table(t["summary"]), SUMMARY_PATH)
 
     print("\n=== Per-row detail (backstory=none) ===")
-    base_cols = ["row_id", "orig_vc_count", "orig_vc_labels", "marker_total"]
-    nvc_show  = [c for c in nvc_cols if c in merged.columns]
-    none_rows = merged[merged["backstory_condition"] == "none"][
-        base_cols + nvc_show + ["rewrite"]
-    ].copy()
-    none_rows["rewrite"] = none_rows["rewrite"].str[:60] + "…"
-    print(none_rows.sort_values("orig_vc_count", ascending=False).to_string(index=False))
+    print(t["detail"].sort_values("orig_vc_count", ascending=False, kind="stable").to_string(index=False))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare harmful markers and NVC components by backstory.")
+    ap.add_argument("--stream", action="store_true",
+                    help="aggregate the parsed rewrites chunk by chunk (flat memory)")
+    ap.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    ap.add_argument("--detail-limit", type=int, default=DETAIL_LIMIT,
+                    help="--stream: keep only the top N per-row detail lines by orig VC count "
+                         f"(default {DETAIL_LIMIT}; 0 = all rows, memory grows with the rewrites)")
+    ap.add_argument("--no-intent", dest="intent", action="store_false",
+                    help="skip the seed -> rewrite intent-preservation scores")
+    ap.add_argument("--refit-intent", action="store_true",
+                    help="refit the cached intent vocabulary (re-scores every pair)")
+    add_shard_args(ap)
+    add_profile_args(ap)
+    args = ap.parse_args()
+    if args.stream and (args.shard or args.merge):
+        ap.error("--shard/--merge work on the in-memory path; drop --stream")
+    if args.detail_limit < 0:
+        ap.error("--detail-limit must be >= 0")
+
+    with profiled("analyze", args):
+        seeds = load_seeds()
+        if args.shard:
+            analyze_shard(seeds, args.shard, args.intent, args.refit_intent)
+            return
+        print_original(seeds)
+        if args.merge:
+            tables = merge_rows(args.merge)
+        elif args.stream:
+            tables = analyze_streaming(seeds, args.chunk_rows, args.detail_limit,
+                                       args.intent, args.refit_intent)
+        else:
+            tables = analyze_in_memory(seeds, args.intent, args.refit_intent)
+        report(tables)
 
 
 if __name__ == "__main__":
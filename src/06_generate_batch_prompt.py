@@ -3,40 +3,120 @@ Generates a single batch prompt file for all 20 rows × 3 conditions (60 rewrite
 Paste the output file into Claude.ai, save the response as
 data/processed/claude_outputs.jsonl, then run:
   python3 src/04_parse_claude_outputs.py
+
+For more seeds than fit in one context window, --shard splits the items into
+token-budgeted prompt files under data/processed/batch_shards/ (see
+batch_shards.py). Save each response next to its prompt, as shard_NNN.jsonl, then run
+  python3 src/04_parse_claude_outputs.py --shards
+
+--batch-export anthropic|gemini writes the same items as a provider batch-API
+request file instead (one request per item, see batch_api.py); its results go
+through 04 --batch-results.
+
+The single prompt gets a manifest (batch_prompt.manifest.json) listing its
+items, so 04 can report the ones that came back missing. 04 writes items that
+were missing or failed validation to data/processed/retry_items.jsonl, and
+--retry prompts for those items only:
+  python3 src/06_generate_batch_prompt.py --retry data/processed/retry_items.jsonl
+Save that response as data/processed/claude_outputs_retry.jsonl and re-run 04.
+The retry prompt's manifest records which single prompt it follows up; a later
+run that writes a different single prompt moves the retry response aside to
+claude_outputs_retry.jsonl.stale, since it answers items of the old prompt.
 """
+import argparse
+import hashlib
 import json
-import pandas as pd
+import os
 from pathlib import Path
 
+from async_llm import estimate_tokens
+from batch_api import BATCH_DIR, DEFAULT_MODELS, PROVIDERS, export_requests
+from batch_shards import (MAX_INPUT_TOKENS, MAX_OUTPUT_TOKENS, SHARD_DIR, backstory_table,
+                          clear_shards, item_key, pack, write_manifest, write_shard)
+from checkpoint import cell_key
+from json_stream import iter_json_file
+from llm_cache import CACHE_PATH, LLMCache, make_key
+from prompts import LAYOUTS, SYSTEM, as_text, build_prompt
+from storage import read_frame
+
 IN_PATH  = Path("data/processed/mturk_seeds_10ids.csv")
 OUT_PATH = Path("data/processed/batch_prompt.txt")
+MANIFEST_PATH = Path("data/processed/batch_prompt.manifest.json")
+RESPONSE_PATH = Path("data/processed/claude_outputs.jsonl")
+RETRY_OUT_PATH = Path("data/processed/batch_prompt_retry.txt")
+RETRY_MANIFEST_PATH = Path("data/processed/batch_prompt_retry.manifest.json")
+RETRY_RESPONSE_PATH = Path("data/processed/claude_outputs_retry.jsonl")
+CACHED_OUT_PATH = Path("data/processed/claude_outputs_cached.jsonl")
 
+# --from-cache looks up single-call rewrites produced by 03_generate_rewrites.py;
+# the defaults are 03's, and --cache-backend / --cache-model / --cache-layout
+# mirror its --backend / --model / --layout for rewrites made with other settings.
+CACHE_BACKEND     = "gemini"
+CACHE_MODEL       = "gemini-2.0-flash"
+CACHE_LAYOUT      = "classic"
+CACHE_TEMPERATURE = 0.2           # 03's TEMPERATURE / MAX_TOKENS (not flags there)
+CACHE_MAX_TOKENS  = 200
 
-def main():
-    df = pd.read_csv(IN_PATH)
 
-    items = []
-    for _, r in df.iterrows():
-        utt     = str(r["seed_utterance"]).strip()
-        pos_bs  = str(r["positive_backstory"]).strip()
-        neg_bs  = str(r["negative_backstory"]).strip()
-        row_id  = int(r["id"])
-        mturk_c = str(r["condition"])
+def set_aside_stale_retry(prompt: str):
+    """Move the retry response aside unless its retry prompt followed up this same prompt."""
+    if not RETRY_RESPONSE_PATH.exists():
+        return
+    follows = None
+    if RETRY_MANIFEST_PATH.exists():
+        follows = json.loads(RETRY_MANIFEST_PATH.read_text(encoding="utf-8")).get("follows")
+    if follows == hashlib.sha256(prompt.encode("utf-8")).hexdigest():
+        return
+    stale = RETRY_RESPONSE_PATH.with_name(RETRY_RESPONSE_PATH.name + ".stale")
+    os.replace(RETRY_RESPONSE_PATH, stale)
+    print(f"Moved {RETRY_RESPONSE_PATH} aside to {stale.name}: it answers a retry of another prompt")
 
-        items.append({"row_id": row_id, "mturk_condition": mturk_c,
-                      "backstory_condition": "none", "backstory": "", "utterance": utt})
-        items.append({"row_id": row_id, "mturk_condition": mturk_c,
-                      "backstory_condition": "pos",  "backstory": pos_bs, "utterance": utt})
-        items.append({"row_id": row_id, "mturk_condition": mturk_c,
-                      "backstory_condition": "neg",  "backstory": neg_bs, "utterance": utt})
 
-    prompt = f"""You are a careful assistant that rewrites conflict utterances using Nonviolent Communication (NVC) and annotates the result.
+def fill_from_cache(items, backend=CACHE_BACKEND, model=CACHE_MODEL, layout=CACHE_LAYOUT):
+    """Split items into (cached output objects, items still needing a rewrite)."""
+    cache = LLMCache(CACHE_PATH)
+    cached, todo = [], []
+    for it in items:
+        prompt = as_text(build_prompt(it["backstory"] or None, it["utterance"], layout))
+        key = make_key(backend, model, CACHE_TEMPERATURE, CACHE_MAX_TOKENS, SYSTEM, prompt)
+        hit = cache.get(key)
+        if hit is None:
+            todo.append(it)
+        else:
+            # no "nvc" key: cached single-call rewrites carry no self-annotation
+            cached.append({k: it[k] for k in ("row_id", "mturk_condition", "backstory_condition")}
+                          | {"rewrite": hit, "source": "cache"})
+    print(f"Response cache: {cache.stats()}")
+    if not cached and len(cache):
+        others = {m: n for m, n in cache.model_counts().items() if m != model}
+        print(f"Warning: no cached rewrite matches backend={backend} model={model} layout={layout}"
+              + (f"; the cache holds {others}" if others else "")
+              + ". Pass 03's --backend / --model / --layout as --cache-backend / --cache-model / --cache-layout.")
+    cache.close()
+    return cached, todo
+
+
+def render_prompt(items, backstories: dict | None = None) -> str:
+    """
+    The batch prompt for `items`. With `backstories` ({key: text}, shard mode) items
+    carry a backstory_key and each backstory text is stated once above the items.
+    """
+    if backstories is None:
+        backstory_line = "- backstory: relationship backstory (empty string if none)"
+        backstory_block = ""
+    else:
+        backstory_line = ("- backstory_key: key of the relationship backstory under "
+                          "\"Backstories\" below (null if none)")
+        backstory_block = ("Backstories (referenced by backstory_key):\n"
+                           f"{json.dumps(backstories, ensure_ascii=False, indent=2)}\n\n")
+
+    return f"""You are a careful assistant that rewrites conflict utterances using Nonviolent Communication (NVC) and annotates the result.
 
 Below are {len(items)} items. Each has:
 - row_id: integer ID
 - mturk_condition: the original MTurk experimental condition ("positive" or "negative")
 - backstory_condition: "none" | "pos" | "neg"
-- backstory: relationship backstory (empty string if none)
+{backstory_line}
 - utterance: the original conflict utterance to rewrite
 
 Task A — Rewrite:
@@ -72,11 +152,144 @@ Each object must have EXACTLY these keys:
   }}
 }}
 
-Items:
+{backstory_block}Items:
 {json.dumps(items, ensure_ascii=False, indent=2)}"""
 
-    OUT_PATH.write_text(prompt, encoding="utf-8")
-    print(f"Written: {OUT_PATH}")
+
+def write_shards(items, shard_dir, max_in, max_out):
+    base = estimate_tokens(render_prompt([], {}))
+    shards = pack(items, max_in, max_out, base_tokens=base)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    clear_shards(shard_dir)
+    total = 0
+    for i, shard in enumerate(shards):
+        backstories, shard_items = backstory_table(shard)
+        m = write_shard(shard_dir, i, len(shards), render_prompt(shard_items, backstories),
+                        shard, backstories)
+        total += m["input_tokens_est"]
+        print(f"  {m['prompt_file']}: {len(shard):>5} items, {len(backstories):>4} backstories, "
+              f"~{m['input_tokens_est']:,} in / ~{m['output_tokens_est']:,} out tokens")
+    single = estimate_tokens(render_prompt(items))
+    print(f"Written: {len(shards)} shards -> {shard_dir} "
+          f"(~{total:,} input tokens vs ~{single:,} as one prompt)")
+    print()
+    print("Next steps:")
+    print(f"  1. Send each {shard_dir}/shard_NNN.txt and save the JSON response as shard_NNN.jsonl")
+    print("  2. python3 src/04_parse_claude_outputs.py --shards")
+    print("  3. python3 src/05_analyze.py")
+
+
+def retry_keys(path) -> set:
+    """Item keys listed in a retry file written by 04."""
+    return {cell_key(r["row_id"], r["mturk_condition"], r["backstory_condition"])
+            for _, r in iter_json_file(path)}
+
+
+def write_batch_requests(items, provider, model, suffix: str = ""):
+    BATCH_DIR.mkdir(parents=True, exist_ok=True)
+    path = BATCH_DIR / f"requests_{provider}{suffix}.jsonl"
+    n = export_requests(items, path, provider, model)
+    print(f"Written: {path} ({n} requests, model {model or DEFAULT_MODELS[provider]})")
+    print()
+    print("Next steps:")
+    print(f"  1. Submit {path} to the {provider} batch API; save the results JSONL as")
+    print(f"     {BATCH_DIR}/results_{provider}{suffix}.jsonl")
+    print(f"     (offline: python3 src/batch_api.py fixture {path} {BATCH_DIR}/results_{provider}{suffix}.jsonl)")
+    if suffix:
+        print(f"  2. python3 src/04_parse_claude_outputs.py --batch-results {BATCH_DIR}/results_{provider}.jsonl "
+              f"{BATCH_DIR}/results_{provider}{suffix}.jsonl --batch-requests {BATCH_DIR}/requests_{provider}.jsonl")
+    else:
+        print(f"  2. python3 src/04_parse_claude_outputs.py --batch-results {BATCH_DIR}/results_{provider}.jsonl "
+              f"--batch-requests {path}")
+    print("  3. python3 src/05_analyze.py")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build the batch rewrite prompt.")
+    ap.add_argument("--from-cache", action="store_true",
+                    help=f"take rewrites already in {CACHE_PATH} and prompt only for the rest")
+    ap.add_argument("--cache-backend", default=CACHE_BACKEND,
+                    help="--from-cache: the --backend the rewrites were made with in 03")
+    ap.add_argument("--cache-model", default=CACHE_MODEL,
+                    help="--from-cache: the --model the rewrites were made with in 03")
+    ap.add_argument("--cache-layout", choices=LAYOUTS, default=CACHE_LAYOUT,
+                    help="--from-cache: the --layout the rewrites were made with in 03")
+    ap.add_argument("--batch-export", choices=PROVIDERS,
+                    help="write a provider batch-API request file instead of a prompt")
+    ap.add_argument("--model", help="model for --batch-export (default per provider)")
+    ap.add_argument("--shard", action="store_true",
+                    help="split into token-budgeted prompt files under --shard-dir")
+    ap.add_argument("--shard-dir", type=Path, default=SHARD_DIR)
+    ap.add_argument("--max-input-tokens", type=int, default=MAX_INPUT_TOKENS,
+                    help="estimated prompt tokens per shard")
+    ap.add_argument("--max-output-tokens", type=int, default=MAX_OUTPUT_TOKENS,
+                    help="estimated response tokens per shard")
+    ap.add_argument("--retry", type=Path, metavar="PATH",
+                    help="prompt only for the items in this retry file (written by 04)")
+    args = ap.parse_args()
+    if args.retry and (args.shard or args.from_cache):
+        ap.error("--retry cannot be combined with --shard or --from-cache")
+
+    df = read_frame(IN_PATH, columns=["id", "condition", "seed_utterance",
+                                      "positive_backstory", "negative_backstory"])
+
+    items = []
+    for _, r in df.iterrows():
+        utt     = str(r["seed_utterance"]).strip()
+        pos_bs  = str(r["positive_backstory"]).strip()
+        neg_bs  = str(r["negative_backstory"]).strip()
+        row_id  = int(r["id"])
+        mturk_c = str(r["condition"])
+
+        items.append({"row_id": row_id, "mturk_condition": mturk_c,
+                      "backstory_condition": "none", "backstory": "", "utterance": utt})
+        items.append({"row_id": row_id, "mturk_condition": mturk_c,
+                      "backstory_condition": "pos",  "backstory": pos_bs, "utterance": utt})
+        items.append({"row_id": row_id, "mturk_condition": mturk_c,
+                      "backstory_condition": "neg",  "backstory": neg_bs, "utterance": utt})
+
+    if args.retry:
+        keys = retry_keys(args.retry)
+        items = [it for it in items if item_key(it) in keys]
+        print(f"Retry: {len(items)} of {len(keys)} items from {args.retry}")
+        if not items:
+            print("Nothing to retry.")
+            return
+    elif args.from_cache:
+        cached, items = fill_from_cache(items, args.cache_backend, args.cache_model, args.cache_layout)
+        with open(CACHED_OUT_PATH, "w", encoding="utf-8") as f:
+            for obj in cached:
+                f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        print(f"Written: {CACHED_OUT_PATH} ({len(cached)} cached rewrites)")
+        if not items:
+            print("All items served from cache; no batch prompt needed.")
+            return
+    elif CACHED_OUT_PATH.exists():
+        CACHED_OUT_PATH.unlink()   # stale: every item is in this prompt again
+
+    if args.batch_export:
+        write_batch_requests(items, args.batch_export, args.model, "_retry" if args.retry else "")
+        return
+
+    if args.shard:
+        write_shards(items, args.shard_dir, args.max_input_tokens, args.max_output_tokens)
+        return
+
+    prompt = render_prompt(items)
+    if args.retry:
+        follows = json.loads(MANIFEST_PATH.read_text(encoding="utf-8")) if MANIFEST_PATH.exists() else {}
+        write_manifest(RETRY_MANIFEST_PATH, RETRY_OUT_PATH, RETRY_RESPONSE_PATH, prompt, items,
+                       follows=follows.get("prompt_sha256"))
+        print(f"Written: {RETRY_OUT_PATH} (+ {RETRY_MANIFEST_PATH.name})")
+        print(f"  {len(items)} items, {len(prompt):,} chars (~{len(prompt)//4:,} tokens)")
+        print()
+        print("Next steps:")
+        print(f"  1. Send {RETRY_OUT_PATH} and save the JSON response as {RETRY_RESPONSE_PATH}")
+        print("  2. python3 src/04_parse_claude_outputs.py   (merges it with the first response)")
+        return
+    set_aside_stale_retry(prompt)
+    write_manifest(MANIFEST_PATH, OUT_PATH, RESPONSE_PATH, prompt, items)
+    print(f"Written: {OUT_PATH} (+ {MANIFEST_PATH.name})")
     print(f"  {len(items)} items, {len(prompt):,} chars (~{len(prompt)//4:,} tokens)")
     print()
     print("Next steps:")
@@ -0,0 +1,120 @@
+"""
+Async helpers for high-throughput LLM calls.
+
+- TokenBucket / RateLimiter: requests/min + tokens/min budget shared by all tasks
+- call_with_retry: retries 429 / 5xx / timeouts with full-jitter exponential backoff
+- limited_call: call_with_retry that takes from the rate limiter on every attempt
+- gather_bounded: runs coroutines with a fixed concurrency limit, results in input order
+"""
+import asyncio
+import random
+import time
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 chars/token), same heuristic as 06_generate_batch_prompt.py."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units/min, holds at most `capacity` units."""
+
+    def __init__(self, per_minute: float | None, capacity: float | None = None):
+        self.rate = (per_minute or 0) / 60.0          # units per second; 0 = unlimited
+        self.capacity = capacity or per_minute or 0
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self, amount: float = 1.0):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)   # a single oversized request must not deadlock
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """Requests/min and tokens/min limits applied together."""
+
+    def __init__(self, rpm: float | None, tpm: float | None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    async def acquire(self, n_tokens: int):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(n_tokens)
+
+
+def status_of(exc: BaseException) -> int | None:
+    """HTTP status of an SDK exception (google-genai uses .code, anthropic/httpx .status_code)."""
+    for attr in ("code", "status_code", "status"):
+        v = getattr(exc, attr, None)
+        if isinstance(v, int):
+            return v
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    if getattr(exc, "retryable", False):
+        return True
+    return status_of(exc) in RETRYABLE_STATUS
+
+
+async def call_with_retry(fn, *, max_retries: int = 5, base_delay: float = 1.0,
+                          max_delay: float = 30.0, on_retry=None):
+    """
+    Await fn() and retry retryable failures with full-jitter backoff:
+    sleep ~ U(0, min(max_delay, base_delay * 2**attempt)).
+    on_retry(attempt, exc, delay) is called before each sleep.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if on_retry is not None:
+                on_retry(attempt + 1, e, delay)
+            await asyncio.sleep(delay)
+
+
+async def limited_call(fn, limiter: RateLimiter, n_tokens: int, on_wait=None, **retry_kwargs):
+    """
+    call_with_retry where every attempt (including retries) first takes from the limiter.
+    on_wait(seconds) is called with the time each attempt spent waiting for the limiter.
+    """
+    async def attempt():
+        t0 = time.perf_counter()
+        await limiter.acquire(n_tokens)
+        if on_wait is not None:
+            on_wait(time.perf_counter() - t0)
+        return await fn()
+
+    return await call_with_retry(attempt, **retry_kwargs)
+
+
+async def gather_bounded(coros, concurrency: int) -> list:
+    """Run coroutines with at most `concurrency` in flight; results keep input order."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(c):
+        async with sem:
+            return await c
+
+    return await asyncio.gather(*(run(c) for c in coros))
@@ -0,0 +1,277 @@
+"""
+Pluggable LLM backends for the rewrite pipeline.
+
+Every backend exposes the same calls:
+    generate(system, prompt, model=..., temperature=..., max_tokens=...)         -> str
+    await agenerate(system, prompt, model=..., temperature=..., max_tokens=...)  -> str
+    complete(...) / await acomplete(...)                                         -> Completion
+Completion carries the text plus the usage metadata the provider returned
+(prompt / completion / cached tokens, finish reason). Backends that report no
+usage fill in async_llm.estimate_tokens() counts, with estimated=True.
+`prompt` is text or prompt segments (prompts.prompt_segments). Backends with
+cache_breakpoints = True send the segments with explicit cache markers, and the
+others send the joined text.
+
+- GeminiBackend: google-genai client (created lazily, needs GEMINI_API_KEY)
+- AnthropicBackend: anthropic client with cache_control breakpoints (needs ANTHROPIC_API_KEY)
+- FakeBackend:   offline stand-in with deterministic NVC-style rewrites and
+                 configurable latency, 429s, 5xx, timeouts and malformed responses
+"""
+import abc
+import argparse
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+import time
+from typing import NamedTuple
+
+from async_llm import estimate_tokens
+from prompts import anthropic_blocks, as_text
+
+
+class BackendError(Exception):
+    """HTTP-style failure; .code is read by async_llm.is_retryable."""
+
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(f"{code} {message}".strip())
+        self.code = code
+
+
+class MalformedResponse(ValueError):
+    """Response came back without usable text (empty, blocked, truncated JSON, ...)."""
+    retryable = True
+
+
+class Completion(NamedTuple):
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int = 0        # prompt tokens served from the provider's prompt cache
+    finish_reason: str | None = None
+    estimated: bool = False       # token counts are estimates, not provider usage
+
+
+def estimated_completion(system: str, prompt, text: str, finish_reason: str | None = None) -> Completion:
+    return Completion(text, estimate_tokens(system + as_text(prompt)), estimate_tokens(text),
+                      finish_reason=finish_reason, estimated=True)
+
+
+class Backend(abc.ABC):
+    name = "base"
+    cache_breakpoints = False    # accepts explicit prompt-cache markers
+
+    @abc.abstractmethod
+    def complete(self, system: str, prompt: str, *, model: str, temperature: float,
+                 max_tokens: int) -> Completion:
+        """One blocking request; the other three calls are built on it."""
+
+    async def acomplete(self, system: str, prompt: str, *, model: str, temperature: float,
+                        max_tokens: int) -> Completion:
+        return await asyncio.to_thread(self.complete, system, prompt, model=model,
+                                       temperature=temperature, max_tokens=max_tokens)
+
+    def generate(self, system: str, prompt: str, *, model: str, temperature: float,
+                 max_tokens: int) -> str:
+        return self.complete(system, prompt, model=model, temperature=temperature,
+                             max_tokens=max_tokens).text
+
+    async def agenerate(self, system: str, prompt: str, *, model: str, temperature: float,
+                        max_tokens: int) -> str:
+        return (await self.acomplete(system, prompt, model=model, temperature=temperature,
+                                     max_tokens=max_tokens)).text
+
+
+class GeminiBackend(Backend):
+    name = "gemini"
+
+    def __init__(self, api_key: str | None = None):
+        from google import genai
+        from google.genai import types
+        self._types = types
+        self.client = genai.Client(api_key=api_key or os.getenv("GEMINI_API_KEY"))
+
+    def _config(self, system, temperature, max_tokens):
+        return self._types.GenerateContentConfig(
+            system_instruction=system,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+        )
+
+    @staticmethod
+    def _completion(response, system, prompt) -> Completion:
+        cands = response.candidates or []
+        reason = getattr(cands[0], "finish_reason", None) if cands else None
+        reason = getattr(reason, "name", reason)
+        if not response.text:
+            raise MalformedResponse(f"empty response (finish_reason={reason})")
+        text = response.text.strip()
+        usage = response.usage_metadata
+        if usage is None or usage.prompt_token_count is None:
+            return estimated_completion(system, prompt, text, reason)
+        return Completion(text, usage.prompt_token_count, usage.candidates_token_count or 0,
+                          usage.cached_content_token_count or 0, reason)
+
+    def complete(self, system, prompt, *, model, temperature, max_tokens):
+        response = self.client.models.generate_content(
+            model=model, contents=as_text(prompt), config=self._config(system, temperature, max_tokens))
+        return self._completion(response, system, prompt)
+
+    async def acomplete(self, system, prompt, *, model, temperature, max_tokens):
+        response = await self.client.aio.models.generate_content(
+            model=model, contents=as_text(prompt), config=self._config(system, temperature, max_tokens))
+        return self._completion(response, system, prompt)
+
+
+class AnthropicBackend(Backend):
+    name = "anthropic"
+    cache_breakpoints = True
+
+    def __init__(self, api_key: str | None = None):
+        import anthropic
+        api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+        self.client = anthropic.Anthropic(api_key=api_key)
+        self.aclient = anthropic.AsyncAnthropic(api_key=api_key)
+
+    @staticmethod
+    def _request(system, prompt, model, temperature, max_tokens) -> dict:
+        system_blocks, content = anthropic_blocks(system, prompt)
+        return {"model": model, "max_tokens": max_tokens, "temperature": temperature,
+                "system": system_blocks, "messages": [{"role": "user", "content": content}]}
+
+    @staticmethod
+    def _completion(message) -> Completion:
+        text = "".join(b.text for b in message.content if b.type == "text").strip()
+        if not text:
+            raise MalformedResponse(f"empty response (stop_reason={message.stop_reason})")
+        u = message.usage
+        cache_read = getattr(u, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(u, "cache_creation_input_tokens", None) or 0
+        # input_tokens excludes the cached and cache-writing parts of the prompt
+        return Completion(text, u.input_tokens + cache_read + cache_write, u.output_tokens,
+                          cache_read, message.stop_reason)
+
+    def complete(self, system, prompt, *, model, temperature, max_tokens):
+        return self._completion(self.client.messages.create(
+            **self._request(system, prompt, model, temperature, max_tokens)))
+
+    async def acomplete(self, system, prompt, *, model, temperature, max_tokens):
+        return self._completion(await self.aclient.messages.create(
+            **self._request(system, prompt, model, temperature, max_tokens)))
+
+
+_UTTERANCE_RE = re.compile(r"Original utterance:\s*\n(.*?)(?:\n\s*\n|\Z)", re.S)
+
+_FAKE_TEMPLATES = [
+    "When I heard \"{gist}\", I felt {feeling} because I need {need}. Would you be willing to talk about it with me?",
+    "I noticed \"{gist}\" and I'm feeling {feeling}; {need} matters a lot to me. Could we find a time to sort this out together?",
+    "I'm feeling {feeling} about \"{gist}\" because I value {need}. Would you be open to telling me how you see it?",
+]
+_FAKE_FEELINGS = ["hurt", "worried", "frustrated", "sad", "anxious", "disappointed"]
+_FAKE_NEEDS = ["connection", "respect", "support", "understanding", "fairness", "closeness"]
+
+
+class FakeBackend(Backend):
+    """
+    Offline backend. The rewrite text depends only on the prompt (sha256-seeded),
+    so it is identical across runs; failures and latency come from a separate
+    RNG seeded with `seed`.
+
+    latency_ms: median of a log-normal latency distribution, latency_sigma its shape
+    rate_429 / rate_5xx / rate_timeout / rate_malformed: per-call failure probabilities
+    """
+    name = "fake"
+
+    def __init__(self, latency_ms: float = 300.0, latency_sigma: float = 0.5,
+                 rate_429: float = 0.0, rate_5xx: float = 0.0, rate_timeout: float = 0.0,
+                 rate_malformed: float = 0.0, timeout_s: float = 10.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_timeout = rate_timeout
+        self.rate_malformed = rate_malformed
+        self.timeout_s = timeout_s
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    @staticmethod
+    def rewrite(prompt: str) -> str:
+        h = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(h)
+        m = _UTTERANCE_RE.search(prompt)
+        words = (m.group(1) if m else prompt).split()
+        gist = " ".join(words[:8]).rstrip(".,!?") + ("…" if len(words) > 8 else "")
+        return rng.choice(_FAKE_TEMPLATES).format(
+            gist=gist, feeling=rng.choice(_FAKE_FEELINGS), need=rng.choice(_FAKE_NEEDS))
+
+    def _plan(self):
+        """Draw (delay_s, outcome) for one call."""
+        self.calls += 1
+        delay = self.latency_ms / 1000.0 * math.exp(self.rng.gauss(0.0, self.latency_sigma))
+        u = self.rng.random()
+        for outcome, p in (("429", self.rate_429), ("5xx", self.rate_5xx),
+                           ("timeout", self.rate_timeout), ("malformed", self.rate_malformed)):
+            if u < p:
+                return (self.timeout_s if outcome == "timeout" else delay), outcome
+            u -= p
+        return delay, "ok"
+
+    def _finish(self, outcome, system, prompt):
+        if outcome == "429":
+            raise BackendError(429, "RESOURCE_EXHAUSTED (fake)")
+        if outcome == "5xx":
+            raise BackendError(503, "UNAVAILABLE (fake)")
+        if outcome == "timeout":
+            raise TimeoutError("fake backend timed out")
+        if outcome == "malformed":
+            raise MalformedResponse("fake malformed response")
+        return estimated_completion(system, prompt, self.rewrite(as_text(prompt)), "STOP")
+
+    def complete(self, system, prompt, *, model, temperature, max_tokens):
+        delay, outcome = self._plan()
+        time.sleep(delay)
+        return self._finish(outcome, system, prompt)
+
+    async def acomplete(self, system, prompt, *, model, temperature, max_tokens):
+        delay, outcome = self._plan()
+        await asyncio.sleep(delay)
+        return self._finish(outcome, system, prompt)
+
+
+BACKENDS = {"gemini": GeminiBackend, "anthropic": AnthropicBackend, "fake": FakeBackend}
+
+
+def get_backend(name: str, **kwargs) -> Backend:
+    try:
+        return BACKENDS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown backend {name!r}; choose from {sorted(BACKENDS)}") from None
+
+
+# FakeBackend settings exposed on the command line (03, loadtest.py)
+FAKE_OPTIONS = {
+    "latency_ms": "median latency (ms)",
+    "latency_sigma": "log-normal latency shape",
+    "rate_429": "share of calls failing with 429",
+    "rate_5xx": "share of calls failing with 503",
+    "rate_timeout": "share of calls timing out after timeout_s",
+    "rate_malformed": "share of calls returning a malformed response",
+    "timeout_s": "time until an injected timeout (s)",
+    "seed": "RNG seed for latency and failures",
+}
+
+
+def add_fake_args(ap: argparse.ArgumentParser, prefix: str = "--fake-"):
+    """FakeBackend flags (e.g. --fake-rate-429); unset flags keep the FakeBackend defaults."""
+    g = ap.add_argument_group("fake backend")
+    for opt, text in FAKE_OPTIONS.items():
+        g.add_argument(prefix + opt.replace("_", "-"), dest="fake_" + opt,
+                       type=int if opt == "seed" else float, help=text)
+
+
+def fake_options(args) -> dict:
+    """FakeBackend kwargs for the add_fake_args() flags that were given."""
+    return {opt: v for opt in FAKE_OPTIONS if (v := getattr(args, "fake_" + opt)) is not None}
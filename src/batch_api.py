@@ -0,0 +1,217 @@
+"""
+Offline export / ingest for provider batch APIs.
+
+export_requests() turns 06's items into a batch request JSONL with one
+self-contained request per item (prompts.make_annotated_prompt):
+  anthropic  Message Batches API   {"custom_id": ..., "params": {...}}
+  gemini     Batch Mode JSONL      {"key": ..., "request": {...}}
+The custom_id is derived from (row_id, mturk_condition, backstory_condition).
+Results can therefore be matched back with no local state, in any order and
+across resubmissions.
+
+iter_results() streams a provider result JSONL and yields objects in the
+shape 04 parses (row_id, mturk_condition, backstory_condition, rewrite, nvc).
+Failed requests, whether errored, expired or returning unusable text, are
+reported, not raised.
+
+  python src/batch_api.py fixture requests_anthropic.jsonl results_anthropic.jsonl
+writes a provider-shaped result file for a request file, with deterministic
+fake rewrites and optional injected failures, so the round trip runs offline.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+from pathlib import Path
+
+from backends import FakeBackend
+from checkpoint import cell_key
+from json_stream import iter_json_file, iter_json_text
+from prompts import NVC_COMPONENTS, SYSTEM, make_annotated_prompt
+
+BATCH_DIR = Path("data/processed/batch_api")
+PROVIDERS = ("anthropic", "gemini")
+DEFAULT_MODELS = {"anthropic": "claude-3-5-haiku-latest", "gemini": "gemini-2.0-flash"}
+TEMPERATURE = 0.2
+MAX_TOKENS = 300          # rewrite + the nvc object
+
+_ID_PART = re.compile(r"[A-Za-z0-9]+")
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def custom_id(row_id, mturk_condition, backstory_condition) -> str:
+    """Stable request id, e.g. "r130-negative-pos" (fits both providers' id rules)."""
+    row_id, mturk_condition, backstory_condition = cell_key(row_id, mturk_condition,
+                                                            backstory_condition)
+    for part in (mturk_condition, backstory_condition):
+        if not _ID_PART.fullmatch(part):
+            raise ValueError(f"condition {part!r} cannot be encoded in a custom_id")
+    return f"r{row_id}-{mturk_condition}-{backstory_condition}"
+
+
+def parse_custom_id(cid: str) -> tuple:
+    parts = cid.split("-")
+    if len(parts) != 3 or not parts[0].startswith("r"):
+        raise ValueError(f"not a rewrite custom_id: {cid!r}")
+    return cell_key(parts[0][1:], parts[1], parts[2])
+
+
+def build_request(it: dict, provider: str, model: str,
+                  temperature: float = TEMPERATURE, max_tokens: int = MAX_TOKENS) -> dict:
+    cid = custom_id(it["row_id"], it["mturk_condition"], it["backstory_condition"])
+    prompt = make_annotated_prompt(it["backstory"] or None, it["utterance"])
+    if provider == "anthropic":
+        return {"custom_id": cid, "params": {
+            "model": model, "max_tokens": max_tokens, "temperature": temperature,
+            "system": SYSTEM, "messages": [{"role": "user", "content": prompt}]}}
+    if provider == "gemini":
+        return {"key": cid, "request": {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "system_instruction": {"parts": [{"text": SYSTEM}]},
+            "generation_config": {"temperature": temperature, "max_output_tokens": max_tokens,
+                                  "response_mime_type": "application/json"}}}
+    raise ValueError(f"Unknown provider {provider!r}; choose from {PROVIDERS}")
+
+
+def export_requests(items, path, provider: str, model: str | None = None) -> int:
+    """Write one request per item to `path`; returns the number written."""
+    model = model or DEFAULT_MODELS[provider]
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for it in items:
+            f.write(json.dumps(build_request(it, provider, model), ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+def requested_keys(path) -> dict:
+    """{item key: custom_id} for a request file from export_requests()."""
+    keys = {}
+    for _, req in iter_json_file(path):
+        cid = req.get("custom_id") or req.get("key")
+        keys[parse_custom_id(cid)] = cid
+    return keys
+
+
+def _result_text(rec: dict) -> tuple:
+    """(custom_id, text or None, error message or None) for one result line of either provider."""
+    if "custom_id" in rec:                                   # anthropic
+        result = rec.get("result") or {}
+        if result.get("type") != "succeeded":
+            err = result.get("error") or {}
+            return rec["custom_id"], None, f"{result.get('type')}: {err.get('type', '')}".rstrip(": ")
+        blocks = result.get("message", {}).get("content") or []
+        return rec["custom_id"], "".join(b.get("text", "") for b in blocks if b.get("type") == "text"), None
+    if "key" in rec:                                         # gemini
+        if rec.get("error") or rec.get("status"):
+            err = rec.get("error") or rec.get("status")
+            return rec["key"], None, f"error: {err.get('message', err) if isinstance(err, dict) else err}"
+        cands = (rec.get("response") or {}).get("candidates") or []
+        parts = cands[0].get("content", {}).get("parts", []) if cands else []
+        return rec["key"], "".join(p.get("text", "") for p in parts), None
+    return None, None, "no custom_id/key"
+
+
+def parse_output(text: str) -> dict:
+    """The {"rewrite", "nvc"} object from a response text (tolerates ``` fences)."""
+    obj = next(iter_json_text(_FENCE.sub("", text.strip())), None)
+    if obj is None or not isinstance(obj.get("rewrite"), str) or not obj["rewrite"].strip():
+        raise ValueError("response is not a JSON object with a rewrite")
+    return obj
+
+
+def iter_results(path, errors: list | None = None):
+    """
+    Yield 04-shaped objects from a provider result JSONL. Failures are appended to
+    `errors` as (byte_offset, message) when a list is given.
+    """
+    def fail(off, msg):
+        if errors is not None:
+            errors.append((off, msg))
+
+    stream_errors = []
+    for off, rec in iter_json_file(path, stream_errors):
+        cid, text, err = _result_text(rec)
+        try:
+            key = parse_custom_id(cid) if cid else None
+        except ValueError as e:
+            fail(off, str(e))
+            continue
+        if err:
+            fail(off, f"{cid}: {err}")
+            continue
+        try:
+            out = parse_output(text)
+        except ValueError as e:
+            fail(off, f"{cid}: {e}")
+            continue
+        row = {"row_id": key[0], "mturk_condition": key[1], "backstory_condition": key[2],
+               "rewrite": out["rewrite"].strip()}
+        if isinstance(out.get("nvc"), dict):
+            row["nvc"] = out["nvc"]
+        yield row
+    for off, msg in stream_errors:
+        fail(off, msg)
+
+
+def _request_prompt(req: dict) -> str:
+    if "params" in req:
+        return req["params"]["messages"][-1]["content"]
+    return req["request"]["contents"][-1]["parts"][0]["text"]
+
+
+def fake_result(req: dict, outcome: str = "ok") -> dict:
+    """Provider-shaped result for one request (deterministic rewrite + annotation)."""
+    prompt = _request_prompt(req)
+    rewrite = FakeBackend.rewrite(prompt)
+    bits = hashlib.sha256(rewrite.encode("utf-8")).digest()[0]
+    text = json.dumps({"rewrite": rewrite,
+                       "nvc": {c: {"present": bool(bits >> i & 1)} for i, c in enumerate(NVC_COMPONENTS)}},
+                      ensure_ascii=False)
+    if outcome == "malformed":
+        text = text[: len(text) // 2]
+    if "custom_id" in req:
+        if outcome == "errored":
+            return {"custom_id": req["custom_id"],
+                    "result": {"type": "errored", "error": {"type": "overloaded_error"}}}
+        return {"custom_id": req["custom_id"], "result": {"type": "succeeded", "message": {
+            "role": "assistant", "content": [{"type": "text", "text": text}]}}}
+    if outcome == "errored":
+        return {"key": req["key"], "error": {"code": 8, "message": "RESOURCE_EXHAUSTED"}}
+    return {"key": req["key"], "response": {"candidates": [{
+        "content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}}
+
+
+def write_fixture(requests_path, out_path, rate_errored: float = 0.0,
+                  rate_malformed: float = 0.0, seed: int = 0) -> int:
+    """Results for every request in shuffled order, as a batch endpoint returns them."""
+    rng = random.Random(seed)
+    reqs = [req for _, req in iter_json_file(requests_path)]
+    rng.shuffle(reqs)
+    with open(out_path, "w", encoding="utf-8") as f:
+        for req in reqs:
+            u = rng.random()
+            outcome = "errored" if u < rate_errored else (
+                "malformed" if u < rate_errored + rate_malformed else "ok")
+            f.write(json.dumps(fake_result(req, outcome), ensure_ascii=False) + "\n")
+    return len(reqs)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Batch-API request/result utilities.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    fx = sub.add_parser("fixture", help="write a fake provider result file for a request file")
+    fx.add_argument("requests")
+    fx.add_argument("out")
+    fx.add_argument("--rate-errored", type=float, default=0.0)
+    fx.add_argument("--rate-malformed", type=float, default=0.0)
+    fx.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    if args.cmd == "fixture":
+        n = write_fixture(args.requests, args.out, args.rate_errored, args.rate_malformed, args.seed)
+        print(f"Written: {args.out} ({n} results)")
+
+
+if __name__ == "__main__":
+    main()
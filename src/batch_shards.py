@@ -0,0 +1,174 @@
+"""
+Token-budgeted sharding of the batch rewrite prompt (06) and reassembly of the
+shard outputs (04).
+
+Items that share a backstory are packed into the same shard where the budget
+allows. Each shard states every backstory it needs once, and items point at it
+by key. Every shard gets a manifest (item keys, prompt sha256, token
+estimates), so 04 can tell exactly which items came back missing or twice.
+06 writes the same kind of manifest for an unsharded prompt.
+
+  shard_003.txt            prompt to send
+  shard_003.manifest.json  what it asks for
+  shard_003.jsonl          save the response here
+"""
+import hashlib
+import json
+from pathlib import Path
+
+from async_llm import estimate_tokens
+from checkpoint import cell_key
+from storage import text_hash
+
+SHARD_DIR = Path("data/processed/batch_shards")
+MAX_INPUT_TOKENS  = 100_000    # per shard prompt
+MAX_OUTPUT_TOKENS = 16_000     # per shard response
+REWRITE_TOKENS = 60            # a 1–2 sentence rewrite
+FIT_WINDOW = 8                 # open shards tried per unit (first-fit over a window)
+
+# one response object without its rewrite text, for the output estimate
+_OUTPUT_SKELETON = {
+    "row_id": 0, "mturk_condition": "negative", "backstory_condition": "none", "rewrite": "",
+    "nvc": {c: {"present": False} for c in ("observation", "feeling", "need", "request", "empathy")},
+}
+OUTPUT_TOKENS_PER_ITEM = estimate_tokens(json.dumps(_OUTPUT_SKELETON, indent=2)) + REWRITE_TOKENS
+
+
+def item_key(it: dict) -> tuple:
+    return cell_key(it["row_id"], it["mturk_condition"], it["backstory_condition"])
+
+
+def shard_item(it: dict, backstory_key: str | None) -> dict:
+    """An item as it appears in a shard prompt: backstory text replaced by its key."""
+    return {"row_id": it["row_id"], "mturk_condition": it["mturk_condition"],
+            "backstory_condition": it["backstory_condition"],
+            "backstory_key": backstory_key, "utterance": it["utterance"]}
+
+
+def _input_tokens(obj) -> int:
+    return estimate_tokens(json.dumps(obj, ensure_ascii=False, indent=2))
+
+
+def _units(items: list, max_in: int, max_out: int) -> list:
+    """
+    Split items into packing units [(backstory hash | None, items, in_tokens, out_tokens)]:
+    one per backstory (its text counted once), one per item without a backstory.
+    A backstory group too large for one shard is cut into several units.
+    """
+    groups = {}
+    for it in items:
+        groups.setdefault(text_hash(it["backstory"] or None), []).append(it)
+    units = []
+    for h, group in groups.items():
+        if h is None:
+            units += [(None, [it], _input_tokens(shard_item(it, "B0")), OUTPUT_TOKENS_PER_ITEM)
+                      for it in group]
+            continue
+        bs_tokens = _input_tokens({"B0": group[0]["backstory"]})
+        cur, cur_in = [], bs_tokens
+        for it in group:
+            t = _input_tokens(shard_item(it, "B0"))
+            if cur and (cur_in + t > max_in or (len(cur) + 1) * OUTPUT_TOKENS_PER_ITEM > max_out):
+                units.append((h, cur, cur_in, len(cur) * OUTPUT_TOKENS_PER_ITEM))
+                cur, cur_in = [], bs_tokens
+            cur.append(it)
+            cur_in += t
+        units.append((h, cur, cur_in, len(cur) * OUTPUT_TOKENS_PER_ITEM))
+    return units
+
+
+def pack(items: list, max_in: int = MAX_INPUT_TOKENS, max_out: int = MAX_OUTPUT_TOKENS,
+         base_tokens: int = 0) -> list:
+    """
+    Group items into shards whose estimated prompt (base_tokens for the instructions
+    + backstories + items) and response stay within max_in / max_out tokens.
+    First-fit decreasing over backstory units, so shared backstories are not split
+    unless a single group exceeds the budget. Deterministic for a given item order.
+    Returns [[item, ...], ...].
+    """
+    max_in = max_in - base_tokens
+    if max_in <= 0 or max_out < OUTPUT_TOKENS_PER_ITEM:
+        raise ValueError(f"token budget too small: {max_in + base_tokens} in / {max_out} out "
+                         f"(instructions alone ~{base_tokens}, one response ~{OUTPUT_TOKENS_PER_ITEM})")
+    units = sorted(_units(items, max_in, max_out), key=lambda u: -u[2])   # stable: ties keep item order
+    shards = []              # [in_used, out_used, items]
+    open_ = []               # indices of shards that may still take a unit
+    for _, its, t_in, t_out in units:
+        for j in open_[-FIT_WINDOW:]:
+            s = shards[j]
+            if s[0] + t_in <= max_in and s[1] + t_out <= max_out:
+                s[0] += t_in
+                s[1] += t_out
+                s[2] += its
+                break
+        else:
+            # oversized single items still get a shard of their own
+            shards.append([t_in, t_out, list(its)])
+            open_.append(len(shards) - 1)
+    order = {item_key(it): i for i, it in enumerate(items)}
+    return [sorted(s[2], key=lambda it: order[item_key(it)]) for s in shards]
+
+
+def backstory_table(items: list) -> tuple:
+    """({key: text}, [shard items]) with keys B1, B2, ... in order of first use."""
+    keys, table, out = {}, {}, []
+    for it in items:
+        key = None
+        if it["backstory"]:
+            key = keys.setdefault(it["backstory"], f"B{len(keys) + 1}")
+            table[key] = it["backstory"]
+        out.append(shard_item(it, key))
+    return table, out
+
+
+def shard_paths(shard_dir, i: int) -> dict:
+    stem = Path(shard_dir) / f"shard_{i:03d}"
+    return {"prompt": stem.with_suffix(".txt"),
+            "manifest": stem.with_suffix(".manifest.json"),
+            "output": stem.with_suffix(".jsonl")}
+
+
+def clear_shards(shard_dir):
+    """Remove prompts + manifests of an earlier sharding (responses are left in place)."""
+    for p in Path(shard_dir).glob("shard_*.txt"):
+        p.unlink()
+    for p in Path(shard_dir).glob("shard_*.manifest.json"):
+        p.unlink()
+
+
+def write_manifest(path, prompt_path, output_path, prompt: str, items: list, **fields) -> dict:
+    """Write a prompt file and the manifest of what it asks for (item keys + checksum)."""
+    Path(prompt_path).write_text(prompt, encoding="utf-8")
+    manifest = {
+        **fields,
+        "prompt_file": Path(prompt_path).name,
+        "output_file": Path(output_path).name,
+        "prompt_sha256": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        "input_tokens_est": estimate_tokens(prompt),
+        "output_tokens_est": len(items) * OUTPUT_TOKENS_PER_ITEM,
+        "items": [list(item_key(it)) for it in items],
+    }
+    Path(path).write_text(json.dumps(manifest) + "\n", encoding="utf-8")
+    return manifest
+
+
+def load_manifest(path) -> dict:
+    """A manifest, with "stale": True if its prompt file (same directory) was edited since."""
+    path = Path(path)
+    m = json.loads(path.read_text(encoding="utf-8"))
+    prompt = path.parent / m["prompt_file"]
+    m["stale"] = prompt.exists() and (
+        hashlib.sha256(prompt.read_bytes()).hexdigest() != m["prompt_sha256"])
+    return m
+
+
+def write_shard(shard_dir, i: int, n_shards: int, prompt: str, items: list, backstories: dict):
+    paths = shard_paths(shard_dir, i)
+    return write_manifest(paths["manifest"], paths["prompt"], paths["output"], prompt, items,
+                          shard=i, n_shards=n_shards,
+                          backstories={k: text_hash(v) for k, v in backstories.items()})
+
+
+def load_manifests(shard_dir) -> list:
+    """Shard manifests in shard order (see load_manifest)."""
+    return [load_manifest(p) for p in sorted(Path(shard_dir).glob("shard_*.manifest.json"))]
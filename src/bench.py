@@ -0,0 +1,391 @@
+"""
+Benchmarks for the pipeline's hot paths, on synthetic data (synth.py), offline.
+
+  02.read_corpus          column-projected CSV chunks of mturk_aggregate.csv
+  02.seed_rows            + parse_turns / pick_best_turn per couple row (default mode)
+  02.ranked_seed_rows     + per-row parsing into padded turn arrays, then a vectorized top-3 (--all mode)
+  04.iter_json_objects    JSON objects from an in-memory dump
+  04.iter_json_file       the same, streamed from the file
+  04.validate             output_schema.validate over in-memory objects (target >= 100k/s)
+  04.parse_score          stream + parse_row + score_batch, as 04 runs it
+  markers.count_markers   count_markers_frame over the rewrite texts
+  nvc.rule_flags          local NVC component detector (lexicons + phrase patterns) over the rewrites
+  05.aggregate            seed merge, group means and item pivot of scored rewrites
+  intent.pair_cosine      seed -> rewrite TF-IDF cosine (vocabulary fitted outside the timing)
+  turn_index.query        label / tag / score slices of the turn index (built once, kept in BENCH_DIR)
+  turn_index.query_nvc    NVC label slices (the nvc: posting lists), alone and with VC / subtype filters
+
+Sizes are corpus dialogues (the output dump has 3 rewrites per dialogue).
+Generated inputs are kept in BENCH_DIR and reused. Each case runs `repeat`
+times and reports the median and best time and the items/s and MB/s at the
+median. Peak memory is taken in one more run under tracemalloc, which counts
+Python and numpy allocations but not the CSV/Parquet readers' own buffers.
+
+  python src/bench.py run --sizes 1000 10000 100000
+  python src/bench.py run --only 04. --compare data/bench/results/baseline.json
+  python src/bench.py compare data/bench/results/baseline.json data/bench/results/bench-....json
+
+Results are written as JSON (RESULTS_DIR/bench-<time>.json, or --out). compare
+exits with status 1 when any case shared with the baseline lost more than
+--threshold of its throughput, or grew its peak memory by more than
+--mem-threshold, so a CI job can fail on regressions.
+"""
+import argparse
+import importlib
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from intent import Vocabulary, pair_cosine
+from json_stream import iter_json_file
+from markers import count_markers_frame
+from nvc import rule_flags
+from output_schema import validate
+from synth import NVC_LABELS, VC_LABELS, sample_messages, write_corpus, write_outputs
+from tabular import iter_csv_chunks
+from turn_index import TurnIndex, build as build_turn_index
+
+BENCH_DIR = Path("data/bench")
+RESULTS_DIR = BENCH_DIR / "results"
+SIZES = [1_000, 10_000]
+REPEAT = 3
+THRESHOLD = 0.20          # throughput loss vs. the baseline that counts as a regression
+MEM_THRESHOLD = 0.25      # peak memory growth that counts as a regression
+MEM_FLOOR_MIB = 8.0       # peaks below this are noise and never regress
+MAX_IN_MEMORY_TEXT = 300_000   # dialogues; 04.iter_json_objects holds the whole dump
+
+seeds_stage = importlib.import_module("02_build_mturk_seeds")
+parse_stage = importlib.import_module("04_parse_claude_outputs")
+analyze_stage = importlib.import_module("05_analyze")
+
+
+def corpus_path(size: int) -> Path:
+    return BENCH_DIR / f"mturk_aggregate_{size}.csv"
+
+
+def outputs_path(size: int) -> Path:
+    return BENCH_DIR / f"claude_outputs_{size}.jsonl"
+
+
+def _outdated(path: Path) -> bool:
+    """A corpus generated before synth.py wrote turn_nvc_union."""
+    with open(path, encoding="utf-8") as f:
+        return "turn_nvc_union" not in f.readline()
+
+
+def ensure_data(size: int):
+    for path, write in ((corpus_path(size), write_corpus), (outputs_path(size), write_outputs)):
+        if not path.exists() or (write is write_corpus and _outdated(path)):
+            t0 = time.perf_counter()
+            write(path, size)
+            print(f"  generated {path} ({path.stat().st_size / 2**20:.1f} MiB, {time.perf_counter() - t0:.1f}s)")
+
+
+# ---- cases: setup(size) -> {"run": callable, "items": n, "unit": str, "bytes": n} -------
+
+def _couple_chunks(size: int):
+    """02's chunk loop: projected columns, couples with a condition, global row numbers."""
+    offset = 0
+    for chunk in iter_csv_chunks(corpus_path(size), usecols=seeds_stage.SEED_COLS,
+                                 chunksize=seeds_stage.CHUNKSIZE):
+        chunk["_row"] = np.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk[(chunk["relationship_subtype"] == "couple") & chunk["condition"].notna()]
+
+
+def _corpus_case(size: int, fn) -> dict:
+    def run():
+        for chunk in _couple_chunks(size):
+            fn(chunk)
+    return {"run": run, "items": size, "unit": "dialogues", "bytes": corpus_path(size).stat().st_size}
+
+
+def case_read_corpus(size):
+    return _corpus_case(size, lambda chunk: None)
+
+
+def case_seed_rows(size):
+    return _corpus_case(size, seeds_stage.seed_rows)
+
+
+def case_ranked_seed_rows(size):
+    return _corpus_case(size, lambda chunk: seeds_stage.ranked_seed_rows(chunk, k=3))
+
+
+def case_iter_json_objects(size):
+    if size > MAX_IN_MEMORY_TEXT:
+        return None
+    text = outputs_path(size).read_text(encoding="utf-8")
+    return {"run": lambda: sum(1 for _ in parse_stage.iter_json_objects(text)),
+            "items": 3 * size, "unit": "objects", "bytes": len(text.encode("utf-8"))}
+
+
+def case_iter_json_file(size):
+    path = outputs_path(size)
+    return {"run": lambda: sum(1 for _ in iter_json_file(path)),
+            "items": 3 * size, "unit": "objects", "bytes": path.stat().st_size}
+
+
+def case_validate(size):
+    objs = [obj for _, obj in iter_json_file(outputs_path(size))]
+
+    def run():
+        for obj in objs:
+            validate(obj)
+    return {"run": run, "items": len(objs), "unit": "objects", "bytes": None}
+
+
+def case_parse_score(size):
+    path = outputs_path(size)
+
+    def run():
+        batch = []
+        for _, obj in iter_json_file(path):
+            batch.append(parse_stage.parse_row(obj))
+            if len(batch) >= parse_stage.BATCH_ROWS:
+                parse_stage.score_batch(batch)
+                batch = []
+        if batch:
+            parse_stage.score_batch(batch)
+    return {"run": run, "items": 3 * size, "unit": "objects", "bytes": path.stat().st_size}
+
+
+def _rewrites(size: int) -> pd.DataFrame:
+    return pd.DataFrame([parse_stage.parse_row(obj) for _, obj in iter_json_file(outputs_path(size))])
+
+
+def case_count_markers(size):
+    texts = _rewrites(size)["rewrite"]
+    return {"run": lambda: count_markers_frame(texts), "items": len(texts), "unit": "texts",
+            "bytes": int(texts.str.len().sum())}
+
+
+def case_nvc_rules(size):
+    texts = _rewrites(size)["rewrite"]
+    return {"run": lambda: rule_flags(texts), "items": len(texts), "unit": "texts",
+            "bytes": int(texts.str.len().sum())}
+
+
+def synthetic_seeds(df: pd.DataFrame, seed: int = 0) -> pd.DataFrame:
+    """A 05 seed table (row_id, mturk_condition, ...) for every item of a rewrite table."""
+    rng = np.random.default_rng(seed)
+    seeds = df[["row_id", "mturk_condition"]].drop_duplicates().reset_index(drop=True)
+    counts = rng.binomial(len(VC_LABELS), 0.2, len(seeds))
+    seeds["seed_utterance"] = "You never listen to me."
+    seeds["orig_vc_count"] = counts
+    seeds["orig_vc_labels"] = ["|".join(VC_LABELS[:c]) for c in counts]
+    return seeds
+
+
+def case_aggregate(size):
+    df = _rewrites(size)
+    df[analyze_stage.MARKER_COLS] = count_markers_frame(df["rewrite"])
+    for c in analyze_stage.NVC_COLS:
+        df[c] = df[c].astype("Int64")
+    seeds = synthetic_seeds(df)
+    return {"run": lambda: analyze_stage.aggregate(df, seeds), "items": len(df), "unit": "rewrites",
+            "bytes": None}
+
+
+def case_pair_cosine(size):
+    rewrites = _rewrites(size)["rewrite"]
+    seeds = pd.Series(sample_messages(size), dtype=object).repeat(3).reset_index(drop=True)[:len(rewrites)]
+    vocab = Vocabulary.fit(pd.concat([seeds, rewrites]))
+    return {"run": lambda: pair_cosine(vocab, seeds, rewrites), "items": len(rewrites), "unit": "pairs",
+            "bytes": int(seeds.str.len().sum() + rewrites.str.len().sum())}
+
+
+def _turn_index(size: int) -> TurnIndex:
+    path = BENCH_DIR / f"turn_index_{size}"
+    try:
+        idx = TurnIndex(path)
+        stale = idx.stale()
+    except (FileNotFoundError, ValueError):
+        stale = True
+    if stale:
+        build_turn_index(corpus_path(size), path)
+    return TurnIndex(path)
+
+
+def _query_case(idx: TurnIndex, queries: list) -> dict:
+    def run():
+        for q in queries:
+            idx.query(**q)
+    return {"run": run, "items": len(queries), "unit": "queries", "bytes": None}
+
+
+def case_turn_query(size):
+    queries = [{"vc": [label], "tag": "romantic partners", "min_score": 3.0} for label in VC_LABELS]
+    queries += [{"vc": VC_LABELS[:2]}, {"subtype": "couple", "condition": "positive", "min_vc": 2},
+                {"min_score": 3.0}]
+    return _query_case(_turn_index(size), queries)
+
+
+def case_turn_query_nvc(size):
+    queries = [{"nvc": [label]} for label in NVC_LABELS]
+    queries += [{"nvc": NVC_LABELS[:2]}, {"nvc": ["Request"], "vc": ["Demand"]},
+                {"nvc": ["Empathy"], "subtype": "couple", "condition": "negative", "min_score": 2.0}]
+    return _query_case(_turn_index(size), queries)
+
+
+CASES = {
+    "02.read_corpus": case_read_corpus,
+    "02.seed_rows": case_seed_rows,
+    "02.ranked_seed_rows": case_ranked_seed_rows,
+    "04.iter_json_objects": case_iter_json_objects,
+    "04.iter_json_file": case_iter_json_file,
+    "04.validate": case_validate,
+    "04.parse_score": case_parse_score,
+    "markers.count_markers": case_count_markers,
+    "nvc.rule_flags": case_nvc_rules,
+    "05.aggregate": case_aggregate,
+    "intent.pair_cosine": case_pair_cosine,
+    "turn_index.query": case_turn_query,
+    "turn_index.query_nvc": case_turn_query_nvc,
+}
+
+
+# ---- running ---------------------------------------------------------------
+
+def measure(case: dict, repeat: int = REPEAT, memory: bool = True) -> dict:
+    times = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        case["run"]()
+        times.append(time.perf_counter() - t0)
+    median = statistics.median(times)
+    res = {"items": case["items"], "unit": case["unit"], "seconds": round(median, 6),
+           "seconds_min": round(min(times), 6),
+           "items_per_s": round(case["items"] / median, 2) if median > 0 else None,
+           "mb_per_s": round(case["bytes"] / 2**20 / median, 2) if case["bytes"] and median > 0 else None,
+           "peak_mib": None}
+    if memory:
+        tracemalloc.start()
+        try:
+            case["run"]()
+            res["peak_mib"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return res
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for mod in ("numpy", "pandas", "pyarrow"):
+        try:
+            versions[mod] = importlib.import_module(mod).__version__
+        except ImportError:
+            versions[mod] = None
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": sys.version.split()[0], "platform": platform.platform(),
+            "machine": platform.machine(), "versions": versions}
+
+
+def run_suite(sizes, only=None, repeat: int = REPEAT, memory: bool = True) -> dict:
+    names = [n for n in CASES if not only or any(o in n for o in only)]
+    if not names:
+        raise SystemExit(f"No benchmark matches {only}; choose from {', '.join(CASES)}")
+    results = []
+    for size in sizes:
+        print(f"== {size:,} dialogues ==")
+        ensure_data(size)
+        for name in names:
+            case = CASES[name](size)
+            if case is None:
+                print(f"  {name:<24} skipped at this size")
+                continue
+            res = {"name": name, "size": size, **measure(case, repeat, memory)}
+            del case
+            results.append(res)
+            mb = f" {res['mb_per_s']:8.1f} MB/s" if res["mb_per_s"] else " " * 14
+            peak = f" peak {res['peak_mib']:8.1f} MiB" if res["peak_mib"] is not None else ""
+            print(f"  {name:<24} {res['seconds']:8.3f}s {res['items_per_s']:>12,.0f} {res['unit']}/s{mb}{peak}")
+    return {**environment(), "repeat": repeat, "results": results}
+
+
+def compare(base: dict, cur: dict, threshold: float = THRESHOLD,
+            mem_threshold: float = MEM_THRESHOLD) -> pd.DataFrame:
+    """One row per (name, size) in both runs: throughput / memory change and a regression flag."""
+    cols = ["name", "size", "items_per_s", "peak_mib"]
+    b = pd.DataFrame(base["results"], columns=cols)
+    c = pd.DataFrame(cur["results"], columns=cols)
+    t = b.merge(c, on=["name", "size"], suffixes=("_base", "_cur"))
+    t["speed_change"] = t["items_per_s_cur"] / t["items_per_s_base"] - 1
+    t["mem_change"] = t["peak_mib_cur"] / t["peak_mib_base"] - 1
+    slow = t["speed_change"] < -threshold
+    fat = (t["mem_change"] > mem_threshold) & (t["peak_mib_cur"] > MEM_FLOOR_MIB)
+    t["status"] = np.select([slow & fat, slow, fat], ["SLOWER+MEMORY", "SLOWER", "MEMORY"], "ok")
+    return t
+
+
+def print_comparison(t: pd.DataFrame, base_label: str, threshold: float = THRESHOLD,
+                     mem_threshold: float = MEM_THRESHOLD) -> bool:
+    """Print the table; True if anything regressed."""
+    if t.empty:
+        print(f"\nNo benchmark in common with {base_label}.")
+        return False
+    print(f"\n=== vs. {base_label} ===")
+    out = t[["name", "size", "items_per_s_base", "items_per_s_cur", "speed_change",
+             "peak_mib_base", "peak_mib_cur", "mem_change", "status"]].copy()
+    for col in ("speed_change", "mem_change"):
+        out[col] = out[col].map(lambda v: "" if pd.isna(v) else f"{v:+.1%}")
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(out.round(1).to_string(index=False))
+    bad = t[t["status"] != "ok"]
+    if len(bad):
+        print(f"\n{len(bad)} regression(s) beyond -{threshold:.0%} throughput / +{mem_threshold:.0%} memory")
+    return len(bad) > 0
+
+
+def load_results(path) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the pipeline's hot paths on synthetic data.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="run the suite and write a results JSON")
+    r.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="corpus dialogues (1k .. 1M)")
+    r.add_argument("--only", nargs="+", help="run cases whose name contains one of these")
+    r.add_argument("--repeat", type=int, default=REPEAT)
+    r.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    r.add_argument("--out", type=Path, help=f"results file (default {RESULTS_DIR}/bench-<time>.json)")
+    r.add_argument("--compare", type=Path, metavar="BASELINE", help="fail on regressions vs. this results file")
+    c = sub.add_parser("compare", help="compare two results files")
+    c.add_argument("baseline", type=Path)
+    c.add_argument("current", type=Path)
+    for p in (r, c):
+        p.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed throughput loss")
+        p.add_argument("--mem-threshold", type=float, default=MEM_THRESHOLD, help="allowed peak memory growth")
+    args = ap.parse_args()
+
+    if args.cmd == "run":
+        cur = run_suite(args.sizes, args.only, args.repeat, not args.no_memory)
+        out = args.out or RESULTS_DIR / f"bench-{time.strftime('%Y%m%dT%H%M%S')}.json"
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(cur, indent=1) + "\n", encoding="utf-8")
+        print(f"Results -> {out}")
+        baseline = args.compare
+    else:
+        cur, baseline = load_results(args.current), args.baseline
+    if baseline is not None:
+        table = compare(load_results(baseline), cur, args.threshold, args.mem_threshold)
+        if print_comparison(table, str(baseline), args.threshold, args.mem_threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
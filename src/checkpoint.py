@@ -0,0 +1,86 @@
+"""
+Append-only JSONL checkpoint journal for rewrite generation.
+
+One line per completed (id, condition, backstory_condition) cell. Lines are
+flushed + fsynced in batches, so a crash loses at most the last unsynced batch
+and never corrupts earlier records (a torn trailing line is dropped on load).
+Resume only needs the set of keys; the wide rewrites table is written once at
+the end by compact().
+"""
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+def cell_key(row_id, condition, backstory_condition) -> tuple:
+    return (int(row_id), str(condition), str(backstory_condition))
+
+
+class Journal:
+    def __init__(self, path, fsync_every: int = 32):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.records = {}            # key -> record
+        self._pending = 0
+        self._load()
+        self._fh = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        good_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    break            # torn write from a crash: keep everything before it
+                if not line.endswith(b"\n"):
+                    break
+                good_bytes += len(line)
+                self.records[cell_key(rec["id"], rec["condition"], rec["backstory_condition"])] = rec
+        if good_bytes < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(good_bytes)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def append(self, rec: dict):
+        key = cell_key(rec["id"], rec["condition"], rec["backstory_condition"])
+        rec = {**rec, "id": key[0], "condition": key[1]}
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.records[key] = rec
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._fh.closed:
+            self.sync()
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def import_wide(self, out: pd.DataFrame, conditions):
+        """Seed an empty journal from a legacy wide rewrites.csv (rewrite_<cond> columns)."""
+        for _, r in out.iterrows():
+            for c in conditions:
+                self.append({"id": r["id"], "condition": r["condition"], "backstory_condition": c,
+                             "rewrite": r[f"rewrite_{c}"], "model": r.get("model"),
+                             "temperature": r.get("temperature")})
+        self.sync()
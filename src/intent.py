@@ -0,0 +1,279 @@
+"""
+Intent preservation: character n-gram TF-IDF cosine between each seed utterance
+and its rewrite (the rewrite prompt asks to "preserve the core intent").
+
+Texts are lowercased, whitespace-collapsed and padded with one space, then cut
+into character n-grams (NGRAM_RANGE). N-grams are hashed with a 64-bit
+polynomial hash computed over the whole batch at once (one numpy pass per n,
+no per-text loop), so the vocabulary is a sorted array of n-gram hashes with
+their smoothed idf, ln((1 + N) / (1 + df)) + 1. Rows are tf * idf, L2-normalised,
+and held as CSR arrays (indptr, columns, weights).
+
+Cosine for aligned rows is a sparse row-wise dot product: the entries of the
+sparser side are expanded per pair, looked up by row * n_features + column in
+the other matrix's (already sorted) CSR keys with one searchsorted, and the
+weight products summed per pair with bincount. Pairs are scored CHUNK_PAIRS at
+a time, and each distinct text in a chunk is vectorised once however many
+pairs it appears in.
+
+The fitted vocabulary is cached in VOCAB_PATH and scores in CACHE_PATH, keyed
+by a hash of (vocabulary fingerprint, seed, rewrite): later runs only transform
+pairs they have not scored before. Refitting changes the fingerprint, which
+invalidates the old scores.
+
+  python src/intent.py                # fit the vocabulary if missing and score every pair
+  python src/intent.py --refit        # refit on the current seeds + rewrites
+"""
+import argparse
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+VOCAB_PATH = Path("data/processed/intent_vocab.npz")
+CACHE_PATH = Path("data/processed/intent_cache.parquet")
+NGRAM_RANGE = (3, 5)
+MAX_FEATURES = 1_000_000    # most frequent n-grams kept (by document frequency)
+CHUNK_TEXTS = 50_000        # texts hashed per numpy pass
+CHUNK_PAIRS = 20_000        # pairs per row-wise dot product (bounds peak memory)
+_PRIME = np.uint64(1_000_003)
+
+
+def normalize(text) -> str:
+    return " " + " ".join(str(text).lower().split()) + " "
+
+
+def ngram_hashes(texts, ngram_range=NGRAM_RANGE) -> tuple:
+    """(doc, hash) for every character n-gram of every text; docs index `texts`."""
+    padded = [normalize(t) for t in texts]
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    codes = np.frombuffer("".join(padded).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    doc_of = np.repeat(np.arange(len(padded)), lengths)
+    ends = np.cumsum(lengths)
+    docs, hashes = [], []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        m = len(codes) - n + 1
+        if m <= 0:
+            continue
+        h = np.full(m, n, dtype=np.uint64)          # seeded with n so lengths never collide
+        for k in range(n):
+            h = h * _PRIME + codes[k:k + m]         # wraps mod 2**64
+        inside = np.arange(m) + n <= ends[doc_of[:m]]
+        docs.append(doc_of[:m][inside])
+        hashes.append(h[inside])
+    if not docs:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+    return np.concatenate(docs), np.concatenate(hashes)
+
+
+def _reduce(hashes: np.ndarray, counts: np.ndarray) -> tuple:
+    """Sum counts per distinct hash (sorted output)."""
+    order = np.argsort(hashes, kind="stable")
+    hashes, counts = hashes[order], counts[order]
+    start = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]]) if len(hashes) else np.empty(0, int)
+    return hashes[start], np.add.reduceat(counts, start) if len(start) else counts[:0]
+
+
+class Vocabulary:
+    """Sorted n-gram hashes + idf weights of a fitted TF-IDF vectoriser."""
+
+    def __init__(self, hashes: np.ndarray, idf: np.ndarray, n_docs: int, ngram_range=NGRAM_RANGE):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.n_docs = int(n_docs)
+        self.ngram_range = tuple(int(n) for n in ngram_range)
+        h = hashlib.sha1(repr(self.ngram_range).encode())
+        h.update(self.hashes.tobytes())
+        h.update(self.idf.astype(np.float32).tobytes())
+        self.fingerprint = h.hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def fit(cls, texts, max_features: int = MAX_FEATURES, ngram_range=NGRAM_RANGE,
+            chunk: int = CHUNK_TEXTS) -> "Vocabulary":
+        """Document frequencies over an iterable of texts, accumulated chunk by chunk."""
+        hashes, df, n_docs = np.empty(0, np.uint64), np.empty(0, np.int64), 0
+        it = iter(texts)
+        while batch := [t for _, t in zip(range(chunk), it)]:
+            docs, h = ngram_hashes(batch, ngram_range)
+            # one count per (n-gram, document)
+            order = np.lexsort((docs, h))
+            docs, h = docs[order], h[order]
+            first = np.r_[True, (h[1:] != h[:-1]) | (docs[1:] != docs[:-1])] if len(h) else h.astype(bool)
+            hashes, df = _reduce(np.concatenate([hashes, h[first]]),
+                                 np.concatenate([df, np.ones(int(first.sum()), np.int64)]))
+            n_docs += len(batch)
+        if len(hashes) > max_features:
+            keep = np.sort(np.argsort(-df, kind="stable")[:max_features])
+            hashes, df = hashes[keep], df[keep]
+        idf = np.log((1 + n_docs) / (1 + df)) + 1
+        return cls(hashes, idf, n_docs, ngram_range)
+
+    def transform(self, texts) -> tuple:
+        """CSR (indptr, columns, weights) of L2-normalised tf-idf rows, columns sorted per row."""
+        texts = list(texts)
+        docs, h = ngram_hashes(texts, self.ngram_range)
+        cols = np.searchsorted(self.hashes, h)
+        known = cols < len(self.hashes)
+        known[known] = self.hashes[cols[known]] == h[known]
+        keys, tf = np.unique(docs[known] * len(self.hashes) + cols[known], return_counts=True)
+        rows, cols = np.divmod(keys, max(len(self.hashes), 1))
+        weights = tf * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights ** 2, minlength=len(texts)))
+        weights = weights / norms[rows]
+        indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=len(texts)))]
+        return indptr, cols, weights
+
+    def save(self, path=VOCAB_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp.npz")   # sharded workers may save at once
+        np.savez(tmp, hashes=self.hashes, idf=self.idf, n_docs=self.n_docs,
+                 ngram_range=np.array(self.ngram_range))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=VOCAB_PATH) -> "Vocabulary":
+        with np.load(path) as z:
+            return cls(z["hashes"], z["idf"], int(z["n_docs"]), tuple(z["ngram_range"]))
+
+
+def _gather(csr: tuple, rows: np.ndarray) -> tuple:
+    """(pair, column, weight) entries of csr rows `rows`, pair = position in `rows`."""
+    indptr, cols, weights = csr
+    lengths = indptr[rows + 1] - indptr[rows]
+    pair = np.repeat(np.arange(len(rows)), lengths)
+    first = np.repeat(indptr[rows] - (np.cumsum(lengths) - lengths), lengths)
+    at = first + np.arange(len(pair))
+    return pair, cols[at], weights[at]
+
+
+def row_cosine(a: tuple, a_rows: np.ndarray, b: tuple, b_rows: np.ndarray, n_features: int) -> np.ndarray:
+    """cos(a[a_rows[i]], b[b_rows[i]]) for every i; rows are L2-normalised, so a dot product."""
+    if np.diff(a[0])[a_rows].sum() > np.diff(b[0])[b_rows].sum():
+        a, a_rows, b, b_rows = b, b_rows, a, a_rows
+    # expand the sparser side per pair and look its entries up in the other matrix
+    pair, cols, weights = _gather(a, a_rows)
+    b_indptr, b_cols, b_weights = b
+    b_keys = np.repeat(np.arange(len(b_indptr) - 1), np.diff(b_indptr)) * n_features + b_cols
+    want = b_rows[pair] * n_features + cols
+    at = np.minimum(np.searchsorted(b_keys, want), max(len(b_keys) - 1, 0))
+    hit = b_keys[at] == want if len(b_keys) else np.zeros(len(want), bool)
+    return np.bincount(pair[hit], weights[hit] * b_weights[at[hit]], minlength=len(a_rows))
+
+
+def pair_cosine(vocab: Vocabulary, seeds, rewrites, chunk: int = CHUNK_PAIRS) -> np.ndarray:
+    """Intent-preservation cosine per (seed, rewrite) pair; NaN where either text is missing."""
+    seeds = pd.Series(seeds, dtype=object).reset_index(drop=True)
+    rewrites = pd.Series(rewrites, dtype=object).reset_index(drop=True)
+    out = np.full(len(seeds), np.nan)
+    ok = np.flatnonzero((seeds.notna() & rewrites.notna()).to_numpy())
+    n_features = max(len(vocab), 1)
+    for lo in range(0, len(ok), chunk):
+        at = ok[lo:lo + chunk]
+        s_codes, s_texts = pd.factorize(seeds.iloc[at])
+        r_codes, r_texts = pd.factorize(rewrites.iloc[at])
+        out[at] = row_cosine(vocab.transform(s_texts), s_codes,
+                             vocab.transform(r_texts), r_codes, n_features)
+    return out
+
+
+def pair_keys(fingerprint: str, seeds, rewrites) -> np.ndarray:
+    """Signed 64-bit cache key per pair (vocabulary, seed, rewrite)."""
+    prefix = fingerprint.encode() + b"\0"
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(prefix + f"{s}\x1f{r}".encode(), digest_size=8).digest(),
+                        "little", signed=True) for s, r in zip(seeds, rewrites)),
+        dtype=np.int64, count=len(seeds))
+
+
+class IntentScorer:
+    """pair_cosine() behind the score cache; only pairs not scored before are transformed."""
+
+    def __init__(self, vocab: Vocabulary, cache_path=CACHE_PATH):
+        self.vocab = vocab
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.cache = pd.Series(dtype=np.float64)
+        if self.cache_path and self.cache_path.exists():
+            df = pd.read_parquet(self.cache_path)
+            df = df[df["vocab"] == vocab.fingerprint]
+            self.cache = pd.Series(df["cosine"].to_numpy(np.float64), index=df["key"].to_numpy())
+        self._new = []
+        self.hits = self.misses = 0
+
+    def score(self, seeds, rewrites) -> np.ndarray:
+        seeds = pd.Series(seeds, dtype=object).reset_index(drop=True)
+        rewrites = pd.Series(rewrites, dtype=object).reset_index(drop=True)
+        out = np.full(len(seeds), np.nan)
+        ok = np.flatnonzero((seeds.notna() & rewrites.notna()).to_numpy())
+        keys = pair_keys(self.vocab.fingerprint, seeds.iloc[ok].astype(str), rewrites.iloc[ok].astype(str))
+        hit = self.cache.index.get_indexer(keys) if len(self.cache) else np.full(len(keys), -1)
+        out[ok[hit >= 0]] = self.cache.to_numpy()[hit[hit >= 0]]
+        miss = ok[hit < 0]
+        if len(miss):
+            out[miss] = pair_cosine(self.vocab, seeds.iloc[miss], rewrites.iloc[miss])
+            self._new.append(pd.Series(out[miss], index=keys[hit < 0]))
+        self.hits += int((hit >= 0).sum())
+        self.misses += len(miss)
+        return out
+
+    def save(self):
+        """Add the newly scored pairs to the cache file."""
+        if not self.cache_path or not self._new:
+            return
+        # an empty cache has a RangeIndex, and concatenating it to hash keys
+        # makes pandas test whether they are a range (int64 overflow warning)
+        self.cache = pd.concat([self.cache, *self._new] if len(self.cache) else self._new)
+        self.cache = self.cache[~self.cache.index.duplicated()]
+        self._new = []
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_name(self.cache_path.name + ".tmp")
+        pd.DataFrame({"key": self.cache.index.to_numpy(np.int64), "cosine": self.cache.to_numpy(),
+                      "vocab": self.vocab.fingerprint}).to_parquet(tmp, index=False)
+        os.replace(tmp, self.cache_path)
+
+
+def load_or_fit(texts, path=VOCAB_PATH, refit: bool = False) -> Vocabulary:
+    """
+    The cached vocabulary, or one fitted on `texts` (an iterable or a callable
+    returning one, so a streaming caller only reads its corpus when needed).
+    """
+    path = Path(path)
+    if path.exists() and not refit:
+        return Vocabulary.load(path)
+    vocab = Vocabulary.fit(texts() if callable(texts) else texts)
+    vocab.save(path)
+    print(f"Intent vocabulary: {len(vocab):,} n-grams from {vocab.n_docs:,} texts -> {path}")
+    return vocab
+
+
+def main():
+    from storage import read_frame
+
+    ap = argparse.ArgumentParser(description="Score seed -> rewrite intent preservation (char n-gram TF-IDF cosine).")
+    ap.add_argument("--parsed", default="data/processed/claude_outputs_parsed.csv")
+    ap.add_argument("--seeds", default="data/processed/mturk_seeds_10ids.csv")
+    ap.add_argument("--refit", action="store_true", help="refit the vocabulary (invalidates cached scores)")
+    args = ap.parse_args()
+
+    seeds = read_frame(args.seeds, columns=["id", "condition", "seed_utterance"]).rename(
+        columns={"id": "row_id", "condition": "mturk_condition"})
+    seeds = seeds.drop_duplicates(["row_id", "mturk_condition"])
+    df = read_frame(args.parsed, columns=["row_id", "mturk_condition", "backstory_condition", "rewrite"])
+    df = df.merge(seeds, on=["row_id", "mturk_condition"], how="left")
+    # same corpus as 05_analyze.intent_scorer(): every seed row, then every rewrite
+    vocab = load_or_fit(lambda: pd.concat([seeds["seed_utterance"], df["rewrite"]]).dropna(),
+                        refit=args.refit)
+    scorer = IntentScorer(vocab)
+    df["intent_cosine"] = scorer.score(df["seed_utterance"], df["rewrite"])
+    scorer.save()
+    print(f"Scored {len(df):,} pairs ({scorer.hits:,} cached, {scorer.misses:,} new)")
+    print(df.groupby("backstory_condition")["intent_cosine"].describe().round(3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Streaming JSON object reader for LLM output dumps.
+
+Handles a JSON array of objects, concatenated / pretty-printed objects and
+true JSONL with one loop: the file is read in chunks, objects are decoded with
+repeated JSONDecoder.raw_decode over a sliding window, and consumed text is
+dropped, so memory stays at ~chunk_size + the largest single object and
+parsing is linear in file size.
+
+Malformed records do not raise: they are reported as (byte_offset, message)
+and the reader resynchronises at the next object start.
+"""
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 1 << 20
+MAX_RECORD = 64 << 20     # an unfinished object larger than this is reported as malformed
+
+_decoder = json.JSONDecoder()
+_SKIP = re.compile(r"[\s,\[\]]*")            # separators and the top-level array wrapper
+_RESYNC = re.compile(r"(?:\n|,|\}|\])\s*\{")  # next plausible top-level object start
+
+
+def _is_truncated(err: json.JSONDecodeError, buf_len: int) -> bool:
+    """Could decoding have failed only because the object runs past the end of the buffer?"""
+    return err.pos >= buf_len - 16 or err.msg.startswith("Unterminated string")
+
+
+def iter_json_stream(chunks, errors: list | None = None):
+    """
+    Yield (offset, obj) for every top-level JSON object in an iterable of byte chunks.
+    offset is the byte offset of the object start. Malformed records are appended
+    to `errors` as (offset, message) when a list is given.
+    """
+    dec = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    it = iter(chunks)
+    buf, pos = "", 0
+    cur_i, cur_off = 0, 0               # byte offset cur_off corresponds to buf[cur_i]
+    eof = False
+
+    def offset(i):
+        # offsets are requested in increasing order, so only encode the new stretch
+        nonlocal cur_i, cur_off
+        cur_off += len(buf[cur_i:i].encode("utf-8"))
+        cur_i = i
+        return cur_off
+
+    def more() -> bool:
+        # drop consumed text first so the window never grows with the file
+        nonlocal buf, pos, cur_i, eof
+        if eof:
+            return False
+        if pos:
+            offset(pos)
+            buf, pos, cur_i = buf[pos:], 0, 0
+        chunk = next(it, None)
+        if chunk is None:
+            eof = True
+            buf += dec.decode(b"", final=True)
+        else:
+            buf += dec.decode(chunk)
+        return True
+
+    while True:
+        pos = _SKIP.match(buf, pos).end()
+        if pos >= len(buf):
+            if not more():
+                return
+            continue
+        try:
+            obj, end = _decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if not eof and _is_truncated(e, len(buf)) and len(buf) - pos < MAX_RECORD:
+                more()
+                continue
+            if errors is not None:
+                errors.append((offset(pos), e.msg))
+            pos += 1
+            m = _RESYNC.search(buf, pos)
+            while m is None and more():
+                m = _RESYNC.search(buf, pos)
+            if m is None:
+                return
+            pos = m.end() - 1
+            continue
+        if isinstance(obj, dict):
+            yield offset(pos), obj
+        elif errors is not None:
+            errors.append((offset(pos), f"top-level {type(obj).__name__}, expected object"))
+        pos = end
+
+
+def read_chunks(path, chunk_size: int = CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def iter_json_file(path, errors: list | None = None, chunk_size: int = CHUNK_SIZE):
+    """Stream objects from a file; see iter_json_stream."""
+    yield from iter_json_stream(read_chunks(path, chunk_size), errors)
+
+
+def iter_json_text(text: str, errors: list | None = None):
+    """Same reader over an in-memory string; yields objects only."""
+    for _, obj in iter_json_stream([text.encode("utf-8")], errors):
+        yield obj
@@ -0,0 +1,115 @@
+"""
+Content-addressed on-disk cache for LLM responses (SQLite, WAL mode).
+
+Key = sha256 over (backend, model, temperature, max_tokens, system, prompt), so a
+call is only paid for once no matter which script or MTurk condition row asks
+for it. Eviction is by age (max_age_days) and size (max_entries, least recently
+used first). cache_only=True turns every miss into a CacheMiss error instead of
+a network call. A hit only notes its key; the last_used updates are written in
+one transaction with the next put(), every TOUCH_BATCH hits, and on evict() /
+close(), so a run served from the cache does not commit once per lookup.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+CACHE_PATH = Path("data/cache/llm_cache.sqlite")
+TOUCH_BATCH = 1000      # pending last_used updates before they are written
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+def make_key(backend: str, model: str, temperature: float, max_tokens: int,
+             system: str, prompt: str) -> str:
+    payload = json.dumps([backend, model, float(temperature), int(max_tokens), system, prompt],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=CACHE_PATH, max_entries: int | None = None,
+                 max_age_days: float | None = None, cache_only: bool = False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+        self._touched = {}      # key -> last_used not yet written
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, response TEXT NOT NULL, model TEXT,
+            created REAL NOT NULL, last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self.db.commit()
+
+    def get(self, key: str) -> str | None:
+        row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.max_age_days is not None \
+                and time.time() - row[1] > self.max_age_days * 86400:
+            row = None
+        if row is None:
+            self.misses += 1
+            if self.cache_only:
+                raise CacheMiss(key)
+            return None
+        self.hits += 1
+        self._touched[key] = time.time()
+        if len(self._touched) >= TOUCH_BATCH:
+            self.flush()
+        return row[0]
+
+    def _write_touches(self):
+        if self._touched:
+            self.db.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+
+    def flush(self):
+        """Write the pending last_used updates of cache hits."""
+        self._write_touches()
+        self.db.commit()
+
+    def put(self, key: str, response: str, model: str | None = None):
+        now = time.time()
+        self._write_touches()
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                        (key, response, model, now, now))
+        self.db.commit()
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones beyond max_entries."""
+        self._write_touches()
+        n = 0
+        if self.max_age_days is not None:
+            n += self.db.execute("DELETE FROM responses WHERE created < ?",
+                                 (time.time() - self.max_age_days * 86400,)).rowcount
+        if self.max_entries is not None:
+            n += self.db.execute("""DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                                 (self.max_entries,)).rowcount
+        self.db.commit()
+        return n
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def model_counts(self) -> dict:
+        """model -> number of cached responses."""
+        return dict(self.db.execute("SELECT model, COUNT(*) FROM responses GROUP BY model").fetchall())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,131 @@
+"""
+Offline load test for the rewrite pipeline.
+
+Runs 03_generate_rewrites.py's async path (journal, response cache, rate limiter,
+retry, compaction) over a seed file against a fake backend with injected latency
+and failures. Load is shaped as in 03: at most --concurrency calls in flight,
+under the --rpm / --tpm token buckets (each holds one minute's worth, so short
+runs are bounded by concurrency and latency). --repeat copies the seed rows
+under new ids for longer runs.
+
+The journal, cache, metrics and rewrites table go to a scratch directory (or
+--work-dir; rerunning on the same one resumes from its journal and cache).
+Reports p50/p95/p99 latency, throughput, retries and failures from 03's
+per-call metrics.
+
+  python src/loadtest.py --repeat 70 --concurrency 64 --rpm 3000 --rate-429 0.05
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backends import FakeBackend, add_fake_args, fake_options
+from checkpoint import Journal
+from llm_cache import LLMCache
+from storage import read_frame
+from telemetry import MetricsLog, call_summary, load_records
+
+gen = importlib.import_module("03_generate_rewrites")
+
+IN_PATH = "data/processed/mturk_seeds_10ids.csv"
+MODEL = "fake-nvc"
+SEED_COLUMNS = ["id", "condition", "seed_utterance", "positive_backstory", "negative_backstory"]
+
+
+def load_seeds(path, repeat: int = 1) -> pd.DataFrame:
+    """
+    Seed rows, copied `repeat` times under ids that do not collide. Copies get a
+    numbered utterance, so their prompts miss the response cache like new seeds.
+    """
+    df = read_frame(path, columns=SEED_COLUMNS)
+    step = int(df["id"].max()) + 1
+    copies = [df.assign(id=df["id"] + k * step, seed_utterance=df["seed_utterance"].astype(str) + f" ({k})")
+              for k in range(1, repeat)]
+    return pd.concat([df, *copies], ignore_index=True)
+
+
+def run(df, work: Path, args) -> dict:
+    """One 03 async run in `work`; returns what happened, for the report."""
+    gen.backend = FakeBackend(**fake_options(args))
+    gen.MODEL = MODEL
+    gen.cache = None if args.no_cache else LLMCache(work / "llm_cache.sqlite")
+    gen.metrics = MetricsLog(work / "calls.jsonl", "loadtest")
+    failure = None
+    t0 = time.perf_counter()
+    with Journal(work / "rewrites.journal.jsonl", fsync_every=gen.FSYNC_EVERY) as journal:
+        done = len(journal)
+        cells = gen.pending_cells(df, journal)
+        try:
+            # 03 prints every retry; --verbose shows them
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+                if cells:
+                    gen.run_async(cells, journal, args.concurrency, args.rpm, args.tpm,
+                                  args.max_retries, args.base_delay)
+        except Exception as e:   # 03 stops at the first call that exhausts its retries
+            failure = f"{type(e).__name__}: {e}"
+        finally:
+            gen.metrics.close()
+        elapsed = time.perf_counter() - t0
+        rows = gen.compact(df, journal, work / "rewrites.csv")
+        cells_done = len(journal) - done
+    if gen.cache is not None:
+        gen.cache.close()
+    return {"cells": len(cells), "cells_done": cells_done, "rows": len(rows), "elapsed": elapsed,
+            "failure": failure, "calls": gen.backend.calls, "run": gen.metrics.run}
+
+
+def report(res: dict, df, work: Path, args):
+    print(f"Cells:       {res['cells']} pending of {3 * len(df)} ({len(df)} seed rows), "
+          f"concurrency {args.concurrency}, rpm {args.rpm:g}, tpm {args.tpm:g}")
+    print(f"Completed:   {res['cells_done']} cells, {res['rows']} complete rows -> {work / 'rewrites.csv'}")
+    if res["failure"]:
+        print(f"Aborted:     {res['failure']} ({res['cells'] - res['cells_done']} cells not generated)")
+    rate = res["cells_done"] / res["elapsed"] if res["elapsed"] > 0 else float("nan")
+    print(f"Wall clock:  {res['elapsed']:.2f}s | throughput {rate:.1f} cells/s")
+    calls = load_records(work / "calls.jsonl", "call", res["run"])
+    if calls.empty:
+        return
+    s = call_summary(calls)
+    print(f"Backend:     {res['calls']} calls, {s['retries']:.0f} retries, {s['cache_hits']:.0f} cache hits, "
+          f"{s['errors']:.0f} failed")
+    for label, col in (("Latency ms", "latency_s"), ("Wall ms", "wall_s"), ("Queue ms", "queue_wait_s")):
+        ms = calls.loc[calls["status"] == "ok", col].dropna().to_numpy(dtype=float) * 1000
+        if len(ms):
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            print(f"{label + ':':<12} p50 {p50:.0f} | p95 {p95:.0f} | p99 {p99:.0f} | max {ms.max():.0f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--seeds", default=IN_PATH)
+    ap.add_argument("--repeat", type=int, default=1, help="copies of the seed rows (3 cells each)")
+    ap.add_argument("--concurrency", type=int, default=gen.CONCURRENCY)
+    ap.add_argument("--rpm", type=float, default=gen.RPM, help="requests/min limit (0 = unlimited)")
+    ap.add_argument("--tpm", type=float, default=gen.TPM, help="tokens/min limit (0 = unlimited)")
+    ap.add_argument("--max-retries", type=int, default=gen.MAX_RETRIES)
+    ap.add_argument("--base-delay", type=float, default=0.5, help="retry backoff base (s)")
+    ap.add_argument("--no-cache", action="store_true", help="run without 03's response cache")
+    ap.add_argument("--verbose", action="store_true", help="show 03's output (every retry)")
+    ap.add_argument("--work-dir", type=Path,
+                    help="keep journal, cache, metrics and table here (default: a temporary directory)")
+    add_fake_args(ap, prefix="--")
+    args = ap.parse_args()
+
+    df = load_seeds(args.seeds, args.repeat)
+    if args.work_dir:
+        args.work_dir.mkdir(parents=True, exist_ok=True)
+        report(run(df, args.work_dir, args), df, args.work_dir, args)
+        return
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as tmp:
+        report(run(df, Path(tmp), args), df, Path(tmp), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Harmful-marker taxonomy and single-pass scanner shared by 04 and 05.
+
+Counts are defined as re.findall once per category (MARKERS below): matches may
+overlap across categories, never within one. The scanner produces the same
+counts from a single pass over the text:
+
+- with pyahocorasick installed, every category pattern is expanded into its
+  literal phrases ("don'?t" -> "don't", "dont") and loaded into one
+  Aho-Corasick automaton run over the lowercased text; \b boundaries and
+  leftmost-first alternative priority are then checked per hit.
+- otherwise all categories are compiled into one regex: a lookahead over the
+  union finds candidate positions, and one named lookahead group per category
+  reports which categories match there.
+
+count_markers_frame() scans a whole Series at once by joining the texts with
+newlines (no pattern can match across one) and mapping hits back to rows, so
+the per-text Python overhead disappears; large corpora can be split over a
+process pool.
+"""
+import itertools
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import ahocorasick
+except ImportError:      # optional: falls back to the combined regex
+    ahocorasick = None
+
+import numpy as np
+import pandas as pd
+
+TAXONOMY_VERSION = "2"
+
+# Expanded lexical taxonomy aligned with VC types in PersonaConflicts
+CATEGORIES = {
+    # Absolutist / Overgeneralization
+    "absolutist":
+        r"\b(always|never|every time|all the time|constantly|forever|"
+        r"nothing|everything|everyone|nobody|no one)\b",
+    # Blame / Accusation
+    "blame":
+        r"\b(you did|you don'?t|you never|you always|your fault|you made|"
+        r"because of you|you caused|you ruined|you broke|you lost)\b",
+    # Contempt / Dismissal
+    "contempt":
+        r"\b(whatever|i don'?t care|forget it|seriously\?|obviously|ridiculous|"
+        r"how on earth|what on earth|good luck with that|as if|yeah right)\b"
+        r"|fine\.",
+    # Mind-reading / Assumption
+    "mind_reading":
+        r"\b(you think|you just|you only|you want|you feel like|you don'?t care|"
+        r"you clearly|you obviously|you never care|you always think)\b",
+    # Moralistic judgment
+    "moralistic":
+        r"\b(you should(n'?t)?|you need to|you must|you have to|"
+        r"you ought to|that'?s wrong|that'?s bad|irresponsible|selfish|"
+        r"makes you the expert|your fair share of)\b",
+    # Demands
+    "demands":
+        r"\b(won'?t you|you better|you will|do it now|"
+        r"this won'?t sort itself|just do it)\b",
+    # Sarcasm markers
+    "sarcasm":
+        r"\b(huh,|I guess (that|you)|magic thing|how do you manage|"
+        r"congratulations on|great job on)\b",
+}
+
+# per-category patterns (reference implementation; the scanner must agree with these)
+MARKERS = {k: re.compile(p, re.I) for k, p in CATEGORIES.items()}
+
+MARKER_COLS = [f"marker_{k}" for k in CATEGORIES] + ["marker_total"]
+
+_SEP = "\n"   # no category pattern can match across a newline
+_WB = "\0"    # stands for \b while expanding patterns
+
+
+def _expand(pattern: str) -> list:
+    """
+    Expand a taxonomy pattern (literals, \\x escapes, \\b, (a|b) groups, ? on a
+    char or group) into [(literal, left_boundary, right_boundary)] in the order a
+    backtracking regex would try them (so index = alternative priority).
+    """
+    def alts(i):
+        options, i = seq(i)
+        while i < len(pattern) and pattern[i] == "|":
+            more, i = seq(i + 1)
+            options += more
+        return options, i
+
+    def seq(i):
+        parts = []
+        while i < len(pattern) and pattern[i] not in "|)":
+            if pattern[i] == "(":
+                opts, i = alts(i + 1)
+                i += 1                                   # ")"
+            elif pattern[i] == "\\":
+                opts, i = [_WB if pattern[i + 1] == "b" else pattern[i + 1]], i + 2
+            else:
+                opts, i = [pattern[i]], i + 1
+            if i < len(pattern) and pattern[i] == "?":
+                opts, i = opts + [""], i + 1             # greedy: present first
+            parts.append(opts)
+        return ["".join(p) for p in itertools.product(*parts)], i
+
+    out = []
+    for lit in alts(0)[0]:
+        lb, rb = lit.startswith(_WB), lit.endswith(_WB)
+        lit = lit.strip(_WB)
+        if _WB in lit or not lit:
+            raise ValueError(f"unsupported marker pattern: {pattern!r}")
+        out.append((lit.lower(), lb, rb))
+    return out
+
+
+def _is_word(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+def _boundary(text: str, i: int) -> bool:
+    """re's \\b at position i."""
+    before = i > 0 and _is_word(text[i - 1])
+    after = i < len(text) and _is_word(text[i])
+    return before != after
+
+
+class MarkerScanner:
+    def __init__(self, categories: dict = CATEGORIES, use_automaton: bool = True):
+        self.names = list(categories)
+        union = "|".join(f"(?:{p})" for p in categories.values())
+        probes = "".join(f"(?:(?=(?P<c{i}>{p})))?" for i, p in enumerate(categories.values()))
+        self.regex = re.compile(f"(?=(?:{union})){probes}", re.I)
+        self.automaton = None
+        if use_automaton and ahocorasick is not None:
+            entries = {}
+            for ci, p in enumerate(categories.values()):
+                for prio, (lit, lb, rb) in enumerate(_expand(p)):
+                    entries.setdefault(lit, []).append((ci, prio, len(lit), lb, rb))
+            self.automaton = ahocorasick.Automaton()
+            for lit, v in entries.items():
+                self.automaton.add_word(lit, tuple(v))
+            self.automaton.make_automaton()
+
+    def _hits(self, text: str):
+        """Yield (category index, start, end) in text order, findall semantics per category."""
+        low = text.lower()
+        if self.automaton is not None and len(low) == len(text):
+            yield from self._hits_automaton(text, low)
+            return
+        last_end = [0] * len(self.names)
+        for m in self.regex.finditer(text):
+            for i in range(len(self.names)):
+                s = m.start(f"c{i}")
+                if s >= 0 and s >= last_end[i]:
+                    last_end[i] = m.end(f"c{i}")
+                    yield i, s, last_end[i]
+
+    def _hits_automaton(self, text: str, low: str):
+        cands = []
+        for end, entries in self.automaton.iter(low):
+            for ci, prio, n, lb, rb in entries:
+                s, e = end + 1 - n, end + 1
+                if (not lb or _boundary(text, s)) and (not rb or _boundary(text, e)):
+                    cands.append((s, ci, prio, e))
+        # per category: leftmost start, then highest-priority alternative, no overlaps
+        cands.sort()
+        last_end = [0] * len(self.names)
+        for s, ci, _, e in cands:
+            if s >= last_end[ci]:
+                last_end[ci] = e
+                yield ci, s, e
+
+    def scan(self, text, spans: bool = False) -> dict:
+        """Per-category counts (+ "total"); with spans=True also {"spans": {cat: [(s, e), ...]}}."""
+        counts = [0] * len(self.names)
+        found = {k: [] for k in self.names} if spans else None
+        for i, s, e in self._hits(str(text)):
+            counts[i] += 1
+            if spans:
+                found[self.names[i]].append((s, e))
+        out = dict(zip(self.names, counts))
+        out["total"] = sum(counts)
+        if spans:
+            out["spans"] = found
+        return out
+
+    def count_matrix(self, texts) -> np.ndarray:
+        """(n_texts, n_categories) int32 counts from one scan over the joined texts."""
+        texts = ["" if t is None else str(t) for t in texts]
+        counts = np.zeros((len(texts), len(self.names)), dtype=np.int32)
+        if not texts:
+            return counts
+        lengths = np.fromiter((len(t) + len(_SEP) for t in texts), dtype=np.int64, count=len(texts))
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        joined = _SEP.join(texts)
+        # per-category non-overlap resets naturally: rows are disjoint spans of `joined`
+        hits = [(i, s) for i, s, _ in self._hits(joined)]
+        if hits:
+            cat, pos = np.array(hits, dtype=np.int64).T
+            row = np.searchsorted(starts, pos, side="right") - 1
+            np.add.at(counts, (row, cat), 1)
+        return counts
+
+
+SCANNER = MarkerScanner()
+
+
+def count_markers(text) -> dict:
+    return SCANNER.scan(text)
+
+
+def _count_chunk(texts):
+    return SCANNER.count_matrix(texts)
+
+
+def count_markers_frame(texts, processes: int | None = None, chunk_size: int = 50_000) -> pd.DataFrame:
+    """
+    marker_<category> + marker_total columns for a Series / iterable of texts.
+    processes > 1 spreads chunks of `chunk_size` texts over a process pool.
+    """
+    index = texts.index if isinstance(texts, pd.Series) else None
+    texts = list(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if processes and processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            parts = list(pool.map(_count_chunk, chunks))
+    else:
+        parts = [_count_chunk(c) for c in chunks]
+    counts = np.vstack(parts) if parts else np.zeros((0, len(SCANNER.names)), dtype=np.int32)
+    df = pd.DataFrame(counts.astype(np.int64), columns=[f"marker_{k}" for k in SCANNER.names],
+                      index=index)
+    df["marker_total"] = df.sum(axis=1)
+    return df
@@ -0,0 +1,382 @@
+"""
+Near-duplicate rewrites: MinHash signatures over word shingles + LSH banding.
+
+If the none / pos / neg rewrites of an item are nearly word-for-word the same,
+the backstory did not change the text, which matters for RQ2. This stage reports
+  - within each item (row_id, mturk_condition): the estimated Jaccard similarity
+    of every pair of backstory conditions, and which pairs are near duplicates;
+  - per condition: distinctness = 1 - mean Jaccard to the item's other rewrites;
+  - across the corpus: near-duplicate pairs and clusters of rewrites, found with
+    LSH (BANDS bands of ROWS signature values) instead of comparing all pairs.
+
+Texts are lowercased word sequences cut into SHINGLE-word shingles (texts with
+fewer words give one shingle of all of them). Words are hashed once per distinct
+word, shingles by a rolling hash over the word hashes, and the NUM_PERM MinHash
+values are min((a * x + b) >> 32) per text: all numpy, no per-text loop.
+Identical texts share one signature, so a corpus of copies stays cheap. In a
+bucket of more than MAX_BUCKET texts only neighbours are compared (a chain),
+which still links them into one cluster but keeps the work linear.
+
+Signatures (uint32, NUM_PERM per distinct text) are stored in SIG_PATH keyed by
+a 64-bit text hash; a run only hashes texts not in the store and appends them.
+
+  python src/near_dups.py                       # report + data/processed/near_dups.csv
+  python src/near_dups.py --threshold 0.9 --top 20
+"""
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from storage import iter_frames
+from tabular import write_table
+
+IN_PATH = "data/processed/claude_outputs_parsed.csv"
+SIG_PATH = Path("data/processed/minhash_signatures.npz")
+PAIRS_PATH = "data/processed/near_dups.csv"
+DISTINCT_PATH = "data/processed/condition_distinctness.csv"
+CONDITIONS = ["none", "pos", "neg"]
+ITEM_KEYS = ["row_id", "mturk_condition"]
+
+SEED = 0
+NUM_PERM = 64
+BANDS, ROWS = 16, 4          # candidate probability 1 - (1 - J**ROWS)**BANDS: 0.99 at J = 0.8
+SHINGLE = 3                  # words per shingle
+THRESHOLD = 0.8              # estimated Jaccard that counts as a near duplicate
+MAX_BUCKET = 32              # larger LSH buckets are chained instead of compared pairwise
+CHUNK_TEXTS = 20_000
+EMPTY = np.uint32(0xFFFFFFFF)
+_PRIME = np.uint64(1_000_003)
+_WORD = r"\w+(?:'\w+)?"
+
+assert BANDS * ROWS == NUM_PERM
+
+
+def text_keys(texts: pd.Series) -> np.ndarray:
+    """Stable 64-bit hash per text (the signature store's key)."""
+    return pd.util.hash_pandas_object(texts.astype(str), index=False).to_numpy(np.uint64)
+
+
+def _permutations(num_perm: int = NUM_PERM, seed: int = SEED) -> tuple:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)    # odd multipliers
+    b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(texts, k: int = SHINGLE) -> tuple:
+    """(doc, hash) per word shingle; texts shorter than k words give one shingle of all their words."""
+    words = pd.Series(list(texts), dtype=object).str.lower().str.findall(_WORD).explode().dropna()
+    doc = words.index.to_numpy(np.int64)
+    h = text_keys(words) if len(words) else np.empty(0, np.uint64)
+    n_words = np.bincount(doc, minlength=len(texts))
+    end = np.cumsum(n_words)[doc]              # one past each word's last sibling
+    docs, hashes = [], []
+    for n in range(1, k + 1):
+        m = len(h) - n + 1
+        if m <= 0:
+            continue
+        x = np.full(m, n, dtype=np.uint64)
+        for j in range(n):
+            x = x * _PRIME + h[j:j + m]
+        pos = np.arange(m)
+        # full k-shingles, plus the single whole-text shingle of texts shorter than k words
+        keep = pos + n <= end[:m]
+        if n < k:
+            keep &= (n_words[doc[:m]] == n) & (pos == end[:m] - n)
+        docs.append(doc[:m][keep])
+        hashes.append(x[keep])
+    if not docs:
+        return np.empty(0, np.int64), np.empty(0, np.uint64)
+    docs, hashes = np.concatenate(docs), np.concatenate(hashes)
+    order = np.argsort(docs, kind="stable")
+    return docs[order], hashes[order]
+
+
+def minhash(texts, num_perm: int = NUM_PERM, k: int = SHINGLE, seed: int = SEED) -> np.ndarray:
+    """(len(texts), num_perm) uint32 signatures; texts without words get all-EMPTY rows."""
+    texts = list(texts)
+    sig = np.full((len(texts), num_perm), EMPTY, dtype=np.uint32)
+    a, b = _permutations(num_perm, seed)
+    for lo in range(0, len(texts), CHUNK_TEXTS):
+        docs, x = shingle_hashes(texts[lo:lo + CHUNK_TEXTS], k)
+        if not len(x):
+            continue
+        starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+        rows = lo + docs[starts]
+        for p in range(num_perm):
+            sig[rows, p] = np.minimum.reduceat((a[p] * x + b[p]) >> np.uint64(32), starts)
+    return sig
+
+
+def jaccard(sig_a: np.ndarray, sig_b: np.ndarray) -> np.ndarray:
+    """Estimated Jaccard per row pair (share of equal MinHash values); NaN if either text is empty."""
+    j = (sig_a == sig_b).mean(axis=1)
+    empty = (sig_a == EMPTY).all(axis=1) | (sig_b == EMPTY).all(axis=1)
+    return np.where(empty, np.nan, j)
+
+
+class SignatureStore:
+    """text hash -> MinHash signature, kept sorted by key in one npz file."""
+
+    def __init__(self, path=SIG_PATH, num_perm: int = NUM_PERM, k: int = SHINGLE, seed: int = SEED):
+        self.path = Path(path) if path else None
+        self.params = np.array([num_perm, k, seed], dtype=np.int64)
+        self.keys = np.empty(0, np.uint64)
+        self.sigs = np.empty((0, num_perm), np.uint32)
+        self.added = 0
+        if self.path and self.path.exists():
+            with np.load(self.path) as z:
+                if np.array_equal(z["params"], self.params):     # else: rebuilt from scratch
+                    self.keys, self.sigs = z["keys"], z["sigs"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Row in self.sigs per key, -1 if missing."""
+        at = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = self.keys[at] == keys if len(self.keys) else np.zeros(len(keys), bool)
+        return np.where(found, at, -1)
+
+    def signatures(self, texts: pd.Series) -> np.ndarray:
+        """Signatures for `texts`, computing (and storing) only the ones not seen before."""
+        keys = text_keys(texts)
+        missing = self.lookup(keys) < 0
+        if missing.any():
+            new_keys, first = np.unique(keys[missing], return_index=True)
+            new_sigs = minhash(texts[missing].iloc[first].astype(str), *self.params)
+            keys_all = np.concatenate([self.keys, new_keys])
+            order = np.argsort(keys_all, kind="stable")
+            self.keys, self.sigs = keys_all[order], np.concatenate([self.sigs, new_sigs])[order]
+            self.added += len(new_keys)
+        return self.sigs[self.lookup(keys)]
+
+    def save(self):
+        if not self.path or not self.added:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp.npz")
+        np.savez(tmp, keys=self.keys, sigs=self.sigs, params=self.params)
+        os.replace(tmp, self.path)
+        self.added = 0
+
+
+# ---- LSH ---------------------------------------------------------------------
+
+def band_keys(sig: np.ndarray, bands: int = BANDS, rows: int = ROWS) -> np.ndarray:
+    """(n, bands) uint64 bucket keys: each band's `rows` signature values hashed together."""
+    keys = np.empty((len(sig), bands), dtype=np.uint64)
+    for j in range(bands):
+        h = np.full(len(sig), j, dtype=np.uint64)
+        for v in sig[:, j * rows:(j + 1) * rows].T:
+            h = h * _PRIME + v
+        keys[:, j] = h
+    return keys
+
+
+def candidate_pairs(sig: np.ndarray, bands: int = BANDS, rows: int = ROWS,
+                    max_bucket: int = MAX_BUCKET) -> np.ndarray:
+    """
+    (m, 2) distinct index pairs (i < j) sharing at least one LSH bucket. Buckets
+    of up to max_bucket texts give all their pairs, larger ones consecutive pairs.
+    """
+    n = len(sig)
+    nonempty = ~(sig == EMPTY).all(axis=1)
+    found = []
+    for keys in band_keys(sig, bands, rows).T:
+        idx = np.flatnonzero(nonempty)
+        order = idx[np.argsort(keys[idx], kind="stable")]
+        k = keys[order]
+        start = np.r_[True, k[1:] != k[:-1]]
+        bucket = np.cumsum(start) - 1
+        size = np.bincount(bucket)[bucket]
+        # d-th neighbour in the sorted order: all pairs for small buckets, d = 1 for big ones
+        for d in range(1, min(max_bucket, int(size.max(initial=0)))):
+            same = bucket[d:] == bucket[:-d]
+            if d > 1:
+                same &= size[d:] <= max_bucket
+            if not same.any():
+                break
+            found.append(np.stack([order[:-d][same], order[d:][same]], axis=1))
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(found), axis=1)
+    keys = np.sort(pairs[:, 0] * n + pairs[:, 1])
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+    return np.stack(np.divmod(keys, n), axis=1)
+
+
+def components(n: int, pairs: np.ndarray) -> np.ndarray:
+    """Connected-component label (smallest member) per node, by hooking + pointer jumping."""
+    labels = np.arange(n)
+    if not len(pairs):
+        return labels
+    a, b = pairs[:, 0], pairs[:, 1]
+    while True:
+        la, lb = labels[a], labels[b]
+        if (la == lb).all():
+            return labels
+        low = np.minimum(la, lb)
+        np.minimum.at(labels, la, low)
+        np.minimum.at(labels, lb, low)
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+
+
+def corpus_pairs(sig: np.ndarray, threshold: float = THRESHOLD) -> tuple:
+    """(LSH candidate count, verified (m, 2) pairs, their Jaccard) among distinct signatures."""
+    cand = candidate_pairs(sig)
+    j = np.empty(len(cand))
+    for lo in range(0, len(cand), CHUNK_TEXTS):
+        c = cand[lo:lo + CHUNK_TEXTS]
+        j[lo:lo + CHUNK_TEXTS] = jaccard(sig[c[:, 0]], sig[c[:, 1]])
+    keep = j >= threshold
+    return len(cand), cand[keep], j[keep]
+
+
+# ---- report ------------------------------------------------------------------
+
+def load_signatures(store: SignatureStore, path=IN_PATH) -> tuple:
+    """(meta, sig): row keys + text hash per parsed rewrite, and their signatures, read chunk by chunk."""
+    meta, sigs = [], []
+    for chunk in iter_frames(path, columns=ITEM_KEYS + ["backstory_condition", "rewrite"]):
+        chunk = chunk[chunk["rewrite"].notna()].reset_index(drop=True)
+        sigs.append(store.signatures(chunk["rewrite"]))
+        meta.append(chunk[ITEM_KEYS + ["backstory_condition"]].assign(
+            text_key=text_keys(chunk["rewrite"])))
+    if not meta:
+        raise ValueError(f"{path} has no rewrites")
+    return pd.concat(meta, ignore_index=True), np.concatenate(sigs)
+
+
+def within_items(meta: pd.DataFrame, sig: np.ndarray) -> pd.DataFrame:
+    """Jaccard of every pair of backstory conditions within each item (long format)."""
+    at = (meta.reset_index().drop_duplicates(ITEM_KEYS + ["backstory_condition"])
+          .pivot(index=ITEM_KEYS, columns="backstory_condition", values="index"))
+    parts = []
+    for i, a in enumerate(CONDITIONS):
+        for b in CONDITIONS[i + 1:]:
+            if a not in at.columns or b not in at.columns:
+                continue
+            both = at[[a, b]].dropna().astype("int64")
+            parts.append(pd.DataFrame({
+                **{k: both.index.get_level_values(k) for k in ITEM_KEYS},
+                "cond_a": a, "cond_b": b,
+                "jaccard": jaccard(sig[both[a].to_numpy()], sig[both[b].to_numpy()])}))
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(
+        columns=ITEM_KEYS + ["cond_a", "cond_b", "jaccard"])
+
+
+def pair_summary(pairs: pd.DataFrame, threshold: float = THRESHOLD) -> pd.DataFrame:
+    g = pairs.assign(near_dup=pairs["jaccard"] >= threshold).groupby(["cond_a", "cond_b"], sort=False)
+    return pd.DataFrame({"n": g["jaccard"].count(), "mean_jaccard": g["jaccard"].mean(),
+                         "near_dup_share": g["near_dup"].mean()})
+
+
+def distinctness(pairs: pd.DataFrame, threshold: float = THRESHOLD) -> pd.DataFrame:
+    """Per condition: 1 - mean Jaccard to the item's other rewrites, and the share with a near duplicate."""
+    both = pd.concat([pairs.rename(columns={"cond_a": "condition"}),
+                      pairs.rename(columns={"cond_b": "condition"})], ignore_index=True)
+    per_item = both.groupby(ITEM_KEYS + ["condition"])["jaccard"].agg(["mean", "max"])
+    g = per_item.groupby("condition")
+    out = pd.DataFrame({"n": g["mean"].count(), "distinctness": 1 - g["mean"].mean(),
+                        "near_dup_share": (per_item["max"] >= threshold).groupby("condition").mean()})
+    return out.reindex([c for c in CONDITIONS if c in out.index]).rename_axis("backstory_condition")
+
+
+def clusters(meta: pd.DataFrame, sig: np.ndarray, threshold: float = THRESHOLD) -> tuple:
+    """
+    Corpus-wide near duplicates. Returns (stats dict, verified pairs between distinct
+    texts as example rows, per-row cluster label).
+    """
+    keys, first, inverse = np.unique(meta["text_key"].to_numpy(), return_index=True, return_inverse=True)
+    n_cand, pairs, j = corpus_pairs(sig[first], threshold)
+    label = components(len(keys), pairs)[inverse]
+    ex = meta.iloc[first]
+    a, b = ex.iloc[pairs[:, 0]].reset_index(drop=True), ex.iloc[pairs[:, 1]].reset_index(drop=True)
+    cols = ITEM_KEYS + ["backstory_condition"]
+    found = pd.concat([a[cols].add_suffix("_a"), b[cols].add_suffix("_b")], axis=1).assign(jaccard=j)
+    return {"texts": len(keys), "candidates": n_cand, "pairs": len(pairs)}, found, label
+
+
+def cluster_table(meta: pd.DataFrame, label: np.ndarray) -> pd.DataFrame:
+    """Clusters of near-duplicate rewrites that span more than one item, largest first."""
+    df = meta.assign(cluster=label)
+    g = df.groupby("cluster")
+    conds = df.groupby(["cluster", "backstory_condition"]).size().unstack(fill_value=0)
+    out = pd.DataFrame({"rows": g.size(), "texts": g["text_key"].nunique(),
+                        "items": df.drop_duplicates(["cluster"] + ITEM_KEYS).groupby("cluster").size()})
+    out = out.join(conds.reindex(columns=[c for c in CONDITIONS if c in conds.columns]))
+    return out[out["items"] > 1].sort_values(["items", "rows"], ascending=False)
+
+
+def examples(keys: set, path=IN_PATH) -> dict:
+    """text hash -> rewrite for `keys` (a second, projected pass over the parsed table)."""
+    out = {}
+    for chunk in iter_frames(path, columns=["rewrite"]):
+        chunk = chunk["rewrite"].dropna()
+        hit = np.isin(text_keys(chunk), np.fromiter(keys, np.uint64, len(keys)))
+        out.update(zip(text_keys(chunk[hit]).tolist(), chunk[hit]))
+    return out
+
+
+def report(meta, sig, threshold: float = THRESHOLD, top: int = 10):
+    print(f"=== Within-item similarity of backstory conditions "
+          f"(MinHash Jaccard, {NUM_PERM} permutations, {SHINGLE}-word shingles) ===")
+    pairs = within_items(meta, sig)
+    print(pair_summary(pairs, threshold).round(3).to_string())
+
+    print(f"\n=== Distinctness by backstory condition (1 - mean Jaccard to the item's other rewrites; "
+          f"near_dup_share: J >= {threshold}) ===")
+    dist = distinctness(pairs, threshold)
+    print(dist.round(3).to_string())
+    write_table(dist.reset_index(), DISTINCT_PATH)
+
+    stats, corpus, label = clusters(meta, sig, threshold)
+    print(f"\n=== Corpus-wide near duplicates (LSH {BANDS} bands x {ROWS} rows, J >= {threshold}) ===")
+    print(f"  {len(meta):,} rewrites, {stats['texts']:,} distinct texts, "
+          f"{stats['candidates']:,} candidate pairs, {stats['pairs']:,} near-duplicate pairs")
+    table = cluster_table(meta, label)
+    print(f"  {len(table):,} clusters span more than one item "
+          f"({table['rows'].sum() if len(table) else 0:,} rewrites)")
+    if len(table):
+        head = table.head(top)
+        first = meta.assign(cluster=label).drop_duplicates("cluster").set_index("cluster")["text_key"]
+        text = examples(set(first[head.index].tolist()))
+        head = head.assign(example=[text.get(k, "")[:60] + "…" for k in first[head.index]])
+        with pd.option_context("display.width", 200, "display.max_colwidth", 70):
+            print(head.to_string())
+
+    within = pairs[pairs["jaccard"] >= threshold].rename(
+        columns={"cond_a": "backstory_condition_a", "cond_b": "backstory_condition_b"})
+    within = within.assign(**{f"{k}_{s}": within[k] for k in ITEM_KEYS for s in "ab"})
+    cols = [f"{k}_{s}" for s in "ab" for k in ITEM_KEYS + ["backstory_condition"]] + ["jaccard"]
+    out = pd.concat([within[cols].assign(scope="row"), corpus[cols].assign(scope="corpus")],
+                    ignore_index=True)
+    write_table(out[["scope"] + cols], PAIRS_PATH)
+    print(f"\n  -> {PAIRS_PATH} ({(out['scope'] == 'row').sum():,} within-item, "
+          f"{(out['scope'] == 'corpus').sum():,} corpus pairs), {DISTINCT_PATH}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Near-duplicate rewrites within items and across the corpus.")
+    ap.add_argument("--threshold", type=float, default=THRESHOLD, help="estimated Jaccard for a near duplicate")
+    ap.add_argument("--top", type=int, default=10, help="clusters to print")
+    args = ap.parse_args()
+
+    store = SignatureStore()
+    meta, sig = load_signatures(store)
+    new = store.added
+    store.save()
+    print(f"Signatures: {len(meta):,} rewrites, {new:,} new texts hashed, {len(store):,} stored -> {SIG_PATH}\n")
+    report(meta, sig, args.threshold, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Local NVC component detector: flags observation / feeling / need / request /
+empathy in a rewrite without the LLM annotating its own output (Task B of the
+06 prompt), as the same nvc_* columns 04 writes.
+
+Two methods:
+  rules  feeling and need lexicons plus observation / request / empathy phrase
+         patterns (COMPONENTS below), scanned in one pass over the joined texts
+         by markers.MarkerScanner; a component is present if any pattern hits.
+  model  one logistic regression per component on the char n-gram TF-IDF rows
+         of intent.py, trained offline on rewrites that carry LLM labels
+         (`train`) and stored in MODEL_PATH. Scoring a batch is one sparse
+         product; training is full-batch Nesterov gradient descent in numpy.
+
+`agree` compares a method with the LLM labels wherever both exist: per
+component, overall and per backstory condition, the two rates, raw agreement,
+Cohen's kappa and precision / recall / F1 with the LLM as reference, plus the
+mean nvc_total. Rewrites the method was shaped on are reported apart as
+"in-sample": the LEXICON_DEV_IDS items for rules, the training items for the
+model. Only the "unseen" numbers say how well a method generalises. `train`
+holds out the items with stable_hash(row_id) % HOLDOUT == 0 (all conditions of
+an item on the same side) and reports the model on them, and the rules on the
+held-out items outside LEXICON_DEV_IDS. The labels compared must be the LLM's,
+i.e. from a 04 run without --nvc.
+
+  python src/nvc.py scan "When I saw the dishes I felt tired. Could we take turns?"
+  python src/nvc.py agree                   # rules vs LLM -> data/processed/nvc_agreement.csv
+  python src/nvc.py train && python src/nvc.py agree --method model
+  python src/04_parse_claude_outputs.py --nvc rules     # nvc_* from the detector
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from intent import MAX_FEATURES, NGRAM_RANGE, Vocabulary
+from markers import MarkerScanner
+from prompts import NVC_COMPONENTS
+from sharding import stable_hash
+from storage import read_frame
+from tabular import write_table
+
+IN_PATH = "data/processed/claude_outputs_parsed.csv"
+AGREEMENT_PATH = "data/processed/nvc_agreement.csv"
+MODEL_PATH = Path("data/processed/nvc_model.npz")
+METHODS = ("rules", "model")
+NVC_COLS = [f"nvc_{c}" for c in NVC_COMPONENTS]
+CONDITIONS = ["none", "pos", "neg"]
+CHUNK_TEXTS = 50_000        # texts per scan / transform
+EPOCHS = 100                # ~2 s each per 70k rewrites
+L2 = 1e-4
+HOLDOUT = 5                 # train: 1 in HOLDOUT items held out for the report
+SALT = 7
+
+# Generic NVC forms and the short feelings / needs lists of the NVC literature;
+# nothing is taken from this corpus's rewrites. They were checked against the
+# rewrites of LEXICON_DEV_IDS (the committed 10-item sample), so rule agreement
+# on those items is in-sample and `agree` / `train` report it apart.
+# Patterns use the subset markers._expand understands (literals, \b, groups, ?).
+LEXICON_DEV_IDS = frozenset({8, 21, 125, 130, 140, 149, 150, 154, 164, 165})
+COMPONENTS = {
+    # Observation: a concrete event or time anchor instead of an evaluation
+    "observation":
+        r"\b(when i (see|saw|hear|heard|notice|noticed)|when (you|we)|"
+        r"i notice|i noticed|i'?ve noticed|i saw|i heard|"
+        r"yesterday|last (night|week|weekend|month|time)|this (morning|evening|week)|"
+        r"earlier today|tonight)\b",
+    # Feeling: "I feel" forms and a feelings lexicon (NVC feelings list, short)
+    "feeling":
+        r"\b(i feel|i felt|i'?m feeling|i'?ve been feeling|i am feeling|"
+        r"afraid|angry|annoyed|anxious|ashamed|confused|curious|disappointed|"
+        r"discouraged|embarrassed|exhausted|frustrated|glad|grateful|happy|helpless|hopeful|"
+        r"hurt|insecure|irritated|lonely|nervous|overwhelmed|relieved|resentful|sad|"
+        r"scared|stressed|tired|torn|uncomfortable|uneasy|upset|vulnerable|worried)\b",
+    # Need: need statements and a needs lexicon (values the speaker holds)
+    "need":
+        r"\b(i need|i really need|need to feel|my need|my needs|our needs|"
+        r"important to me|matters to me|i value|"
+        r"acceptance|appreciation|autonomy|clarity|closeness|connection|consideration|"
+        r"consistency|cooperation|fairness|honesty|openness|reassurance|reliability|"
+        r"respect|safety|security|support|trust|understanding)\b",
+    # Request: a concrete, doable ask phrased as a question or invitation
+    "request":
+        r"\b(could you|would you|can you|will you|could we|would we|can we|shall we|let'?s|"
+        r"would it be (ok|okay|alright|possible)|is it (ok|okay|alright)|"
+        r"are you (open|willing)|how about|what if we|please|"
+        r"i'?d (like|appreciate) it if|i would (like|appreciate) it if)\b",
+    # Empathy: acknowledging the other person's feelings or perspective
+    "empathy":
+        r"\b(i understand|i can (see|hear|imagine|understand)|i hear (you|that)|"
+        r"it sounds like|sounds like you|you (must|might) (feel|be)|"
+        r"are you feeling|you'?re feeling|how you feel|how you'?re feeling|"
+        r"that must (be|have been|feel)|your (feelings|perspective))\b",
+}
+
+SCANNER = MarkerScanner(COMPONENTS)
+assert SCANNER.names == NVC_COMPONENTS
+
+
+def _texts(texts) -> list:
+    """Texts as the scanner and vectoriser take them (typographic apostrophes folded)."""
+    return [t.replace("’", "'") if isinstance(t, str) else "" for t in texts]
+
+
+def rule_flags(texts) -> np.ndarray:
+    """(n_texts, len(NVC_COMPONENTS)) bool: any pattern of the component in the text."""
+    texts = _texts(texts)
+    parts = [SCANNER.count_matrix(texts[i:i + CHUNK_TEXTS]) > 0
+             for i in range(0, len(texts), CHUNK_TEXTS)]
+    return np.vstack(parts) if parts else np.zeros((0, len(NVC_COMPONENTS)), dtype=bool)
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+class Design:
+    """CSR rows of a Vocabulary transform, with the two products a linear model needs."""
+
+    def __init__(self, csr: tuple, n_features: int):
+        indptr, self.cols, self.vals = csr
+        self.n, self.d = len(indptr) - 1, n_features
+        self.rows = np.repeat(np.arange(self.n), np.diff(indptr))
+
+    def dot(self, w: np.ndarray) -> np.ndarray:
+        """X @ w for w of shape (d, k)."""
+        return np.stack([np.bincount(self.rows, self.vals * w[self.cols, k], minlength=self.n)
+                         for k in range(w.shape[1])], axis=1)
+
+    def tdot(self, r: np.ndarray) -> np.ndarray:
+        """X.T @ r for r of shape (n, k)."""
+        return np.stack([np.bincount(self.cols, self.vals * r[self.rows, k], minlength=self.d)
+                         for k in range(r.shape[1])], axis=1)
+
+
+class NvcModel:
+    """One logistic regression per NVC component over intent.Vocabulary TF-IDF rows."""
+
+    def __init__(self, vocab: Vocabulary, weights: np.ndarray, bias: np.ndarray, holdout: int = 0):
+        self.vocab, self.weights, self.bias = vocab, weights, bias
+        self.holdout = holdout      # items with held_out(row_id, holdout) were not trained on
+
+    @classmethod
+    def fit(cls, texts, labels: np.ndarray, epochs: int = EPOCHS, l2: float = L2) -> "NvcModel":
+        """
+        Minimise the mean log loss + l2/2 |W|^2. Rows are L2-normalised, so with the
+        bias the gradient is (0.5 + l2)-Lipschitz and 1 / (0.5 + l2) is a safe step.
+        """
+        texts = _texts(texts)
+        vocab = Vocabulary.fit(texts, MAX_FEATURES, NGRAM_RANGE)
+        X = Design(vocab.transform(texts), len(vocab))
+        y = np.asarray(labels, dtype=np.float64)
+        step = 1.0 / (0.5 + l2)
+        w = w_prev = np.zeros((len(vocab), y.shape[1]))
+        b = b_prev = np.zeros(y.shape[1])
+        for t in range(1, epochs + 1):
+            mom = (t - 1) / (t + 2)
+            yw, yb = w + mom * (w - w_prev), b + mom * (b - b_prev)
+            r = (_sigmoid(X.dot(yw) + yb) - y) / X.n
+            w_prev, b_prev = w, b
+            w = yw - step * (X.tdot(r) + l2 * yw)
+            b = yb - step * r.sum(axis=0)
+        return cls(vocab, w, b)
+
+    def decision(self, texts) -> np.ndarray:
+        texts = _texts(texts)
+        parts = [Design(self.vocab.transform(texts[i:i + CHUNK_TEXTS]), len(self.vocab)).dot(self.weights)
+                 for i in range(0, len(texts), CHUNK_TEXTS)]
+        return (np.vstack(parts) if parts else np.zeros((0, len(self.bias)))) + self.bias
+
+    def predict(self, texts) -> np.ndarray:
+        return self.decision(texts) > 0
+
+    def save(self, path=MODEL_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        v = self.vocab
+        np.savez(path, hashes=v.hashes, idf=v.idf, n_docs=v.n_docs, ngram_range=np.array(v.ngram_range),
+                 weights=self.weights.astype(np.float32), bias=self.bias,
+                 components=np.array(NVC_COMPONENTS), holdout=self.holdout)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH) -> "NvcModel":
+        with np.load(path) as z:
+            if list(z["components"]) != NVC_COMPONENTS:
+                raise ValueError(f"{path} was trained for {list(z['components'])}; retrain it")
+            vocab = Vocabulary(z["hashes"], z["idf"], int(z["n_docs"]), tuple(z["ngram_range"]))
+            holdout = int(z["holdout"]) if "holdout" in z.files else 0
+            return cls(vocab, z["weights"].astype(np.float64), z["bias"], holdout)
+
+
+def detector(method: str = "rules", model_path=MODEL_PATH):
+    """texts -> (n, len(NVC_COMPONENTS)) bool matrix for `method`."""
+    if method == "rules":
+        return rule_flags
+    if method == "model":
+        if not Path(model_path).exists():
+            raise SystemExit(f"No NVC model at {model_path}; run: python src/nvc.py train")
+        return NvcModel.load(model_path).predict
+    raise ValueError(f"Unknown NVC method {method!r}; choose from {METHODS}")
+
+
+def held_out(row_ids, holdout: int) -> np.ndarray:
+    """Items `train` keeps out of the fit: stable_hash(row_id) % holdout == 0."""
+    row_ids = pd.Series(row_ids).astype("int64")
+    if holdout <= 1:
+        return np.zeros(len(row_ids), dtype=bool)
+    return stable_hash(row_ids, SALT) % np.uint64(holdout) == 0
+
+
+def in_sample(df: pd.DataFrame, method: str, model: "NvcModel | None" = None) -> np.ndarray:
+    """Rewrites `method` was shaped on: the lexicon's dev items, or the model's training items."""
+    if method == "rules":
+        return df["row_id"].astype("int64").isin(LEXICON_DEV_IDS).to_numpy()
+    return ~held_out(df["row_id"], model.holdout)
+
+
+def nvc_frame(flags: np.ndarray, index=None) -> pd.DataFrame:
+    """nvc_<component> + nvc_total as 04 writes them (Int64) from a flag matrix."""
+    df = pd.DataFrame(flags.astype(np.int64), columns=NVC_COLS, index=index).astype("Int64")
+    df["nvc_total"] = df.sum(axis=1)
+    return df
+
+
+def _rates(ref: np.ndarray, got: np.ndarray) -> dict:
+    """Agreement statistics of two aligned bool vectors (ref = the LLM labels)."""
+    n = len(ref)
+    tp = int((ref & got).sum())
+    fp = int((~ref & got).sum())
+    fn = int((ref & ~got).sum())
+    p_ref, p_got = ref.mean(), got.mean()
+    po = (ref == got).mean()
+    pe = p_ref * p_got + (1 - p_ref) * (1 - p_got)
+    precision = tp / (tp + fp) if tp + fp else np.nan
+    recall = tp / (tp + fn) if tp + fn else np.nan
+    return {"n": n, "llm_rate": p_ref, "local_rate": p_got, "agreement": po,
+            "kappa": (po - pe) / (1 - pe) if pe < 1 else np.nan,
+            "precision": precision, "recall": recall,
+            "f1": 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else np.nan}
+
+
+def agreement(llm: np.ndarray, local: np.ndarray, conditions) -> pd.DataFrame:
+    """
+    Tidy (backstory_condition, component, n, llm_rate, local_rate, agreement, kappa,
+    precision, recall, f1) for "all" and each backstory condition. The "total" rows
+    hold mean nvc_total per side and the share of rewrites with the same total.
+    """
+    conditions = np.asarray(conditions, dtype=object)
+    present = set(conditions.tolist())
+    groups = ["all"] + [c for c in CONDITIONS if c in present] + sorted(
+        str(c) for c in present - set(CONDITIONS) if isinstance(c, str))
+    rows = []
+    for g in groups:
+        sel = np.ones(len(llm), dtype=bool) if g == "all" else conditions == g
+        if not sel.any():
+            continue
+        ref, got = llm[sel], local[sel]
+        for k, comp in enumerate(NVC_COMPONENTS):
+            rows.append({"backstory_condition": g, "component": comp, **_rates(ref[:, k], got[:, k])})
+        t_ref, t_got = ref.sum(axis=1), got.sum(axis=1)
+        rows.append({"backstory_condition": g, "component": "total", "n": int(sel.sum()),
+                     "llm_rate": t_ref.mean(), "local_rate": t_got.mean(),
+                     "agreement": (t_ref == t_got).mean()})
+    return pd.DataFrame(rows)
+
+
+def load_labelled(path=IN_PATH) -> pd.DataFrame:
+    """Parsed rewrites that carry all five LLM labels."""
+    df = read_frame(path, columns=["row_id", "backstory_condition", "rewrite"] + NVC_COLS)
+    df = df[df[NVC_COLS].notna().all(axis=1)].reset_index(drop=True)
+    if df.empty:
+        raise SystemExit(f"{path} has no rewrites with LLM NVC labels")
+    return df
+
+
+def llm_flags(df: pd.DataFrame) -> np.ndarray:
+    return df[NVC_COLS].to_numpy(dtype=np.int64) > 0
+
+
+def print_agreement(table: pd.DataFrame, title: str):
+    print(f"=== {title} ===")
+    with pd.option_context("display.width", 200):
+        print(table.round(3).to_string(index=False))
+
+
+def no_estimate(method: str, why: str) -> str:
+    return (f"No out-of-sample estimate for {method}: every labelled rewrite is in-sample ({why}).\n"
+            f"Nothing here shows that {method} can replace the LLM self-annotation; label rewrites of\n"
+            f"other items (04 without --nvc) to measure it.")
+
+
+def cmd_scan(args):
+    for text in args.text:
+        hits = SCANNER.scan(_texts([text])[0], spans=True)["spans"]
+        print(text)
+        for comp in NVC_COMPONENTS:
+            found = [text[s:e] for s, e in hits[comp]]
+            print(f"  {comp:12s} {'yes' if found else 'no ':3s}  {', '.join(found)}")
+
+
+def cmd_agree(args):
+    df = load_labelled(args.parsed)
+    model = NvcModel.load(args.model) if args.method == "model" and Path(args.model).exists() else None
+    local = (model.predict if model else detector(args.method, args.model))(df["rewrite"])
+    llm, conds = llm_flags(df), df["backstory_condition"].astype(object).to_numpy()
+    seen = in_sample(df, args.method, model)
+    why = {"rules": "items the lexicon was checked against",
+           "model": "items the model was trained on"}[args.method]
+    if not (~seen).any():
+        print(no_estimate(args.method, why) + "\n")
+    parts = []
+    for sample, sel in (("unseen", ~seen), ("in-sample", seen)):
+        if not sel.any():
+            continue
+        part = agreement(llm[sel], local[sel], conds[sel])
+        parts.append(part.assign(sample=sample)[["sample"] + list(part.columns)])
+        note = f"; {why}, not an estimate" if sample == "in-sample" else ""
+        print_agreement(part[part["backstory_condition"] == "all"],
+                        f"NVC labels: {args.method} vs LLM self-annotation, {sample} "
+                        f"({int(sel.sum()):,} rewrites{note})")
+        print()
+    table = pd.concat(parts, ignore_index=True)
+    print("=== Component rates by backstory condition (LLM / local, all rewrites) ===")
+    rates = agreement(llm, local, conds)
+    by_cond = rates[rates["backstory_condition"] != "all"].pivot_table(
+        index="component", columns="backstory_condition", values=["llm_rate", "local_rate"], sort=False)
+    print(by_cond.round(3).to_string())
+    write_table(table, args.out)
+    print(f"  -> {args.out}")
+
+
+def cmd_train(args):
+    df = load_labelled(args.parsed)
+    y = llm_flags(df)
+    test = held_out(df["row_id"], args.holdout)
+    if test.all():
+        raise SystemExit("every item fell in the hold-out; use more data or --holdout 0")
+    model = NvcModel.fit(df.loc[~test, "rewrite"], y[~test], args.epochs, args.l2)
+    model.holdout = args.holdout if args.holdout > 1 else 0
+    model.save(args.out)
+    print(f"NVC model: {len(model.vocab):,} n-gram features, {int((~test).sum()):,} rewrites -> {args.out}")
+    # the rules were not fitted here, but their dev items are in-sample for them
+    unseen_rules = test & ~in_sample(df, "rules")
+    for method, sel in (("model", test), ("rules", unseen_rules)):
+        print()
+        if not sel.any():
+            print(no_estimate(method, "no held-out rewrites" +
+                              (" outside LEXICON_DEV_IDS" if method == "rules" else "")))
+            continue
+        flags = model.predict(df.loc[sel, "rewrite"]) if method == "model" else rule_flags(df.loc[sel, "rewrite"])
+        table = agreement(y[sel], flags, df.loc[sel, "backstory_condition"].astype(object))
+        print_agreement(table[table["backstory_condition"] == "all"],
+                        f"Held-out {int(sel.sum()):,} rewrites: {method} vs LLM")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local NVC component detector and its agreement with LLM labels.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("scan", help="show the rule hits per component for some texts")
+    p.add_argument("text", nargs="+")
+    p = sub.add_parser("agree", help="compare a detector with the LLM labels of the parsed rewrites")
+    p.add_argument("--method", choices=METHODS, default="rules")
+    p.add_argument("--model", type=Path, default=MODEL_PATH)
+    p.add_argument("--parsed", default=IN_PATH)
+    p.add_argument("--out", default=AGREEMENT_PATH)
+    p = sub.add_parser("train", help="fit the linear model on the LLM labels of the parsed rewrites")
+    p.add_argument("--parsed", default=IN_PATH)
+    p.add_argument("--out", type=Path, default=MODEL_PATH)
+    p.add_argument("--holdout", type=int, default=HOLDOUT, help="hold out 1 in N items (0 = train on all)")
+    p.add_argument("--epochs", type=int, default=EPOCHS)
+    p.add_argument("--l2", type=float, default=L2)
+    args = ap.parse_args()
+    {"scan": cmd_scan, "agree": cmd_agree, "train": cmd_train}[args.cmd](args)
+
+
+if __name__ == "__main__":
+    main()
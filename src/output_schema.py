@@ -0,0 +1,149 @@
+"""
+Schema of one rewrite object (the batch prompt's output format) and a compiled
+validator that sorts objects into valid / repairable / invalid.
+
+SCHEMA is declarative: "int", "bool", "text" (non-empty string), a tuple of
+allowed strings, or a nested dict. Validator compiles it into
+  - a fast path: one generated boolean expression (exec'd once) that accepts an
+    object exactly matching the schema, so the common case costs a handful of
+    type checks and no allocation;
+  - a slow path, only for objects the fast path rejects: walks the schema,
+    applies the safe repairs below and lists every problem.
+
+Repairs (-> "repairable", the object is used in its repaired form):
+  int   integral float or digit string        12.0, "12"          -> 12
+  bool  "true"/"false" (any case), 0/1        "True", 1           -> True
+  enum  different case or surrounding space   " Pos"              -> "pos"
+  dict  unknown keys                          {"comment": ...}    -> dropped
+Anything else (a missing key, a wrong type, an empty rewrite, an unknown
+condition) makes the object "invalid", and its item is re-requested.
+"""
+from prompts import NVC_COMPONENTS
+
+VALID, REPAIRABLE, INVALID = "valid", "repairable", "invalid"
+
+SCHEMA = {
+    "row_id": "int",
+    "mturk_condition": ("positive", "negative"),
+    "backstory_condition": ("none", "pos", "neg"),
+    "rewrite": "text",
+    "nvc": {c: {"present": "bool"} for c in NVC_COMPONENTS},
+}
+# cached single-call rewrites (06 --from-cache) carry no annotation, but a source tag
+CACHED_SCHEMA = {**SCHEMA, "source": "text"}
+CACHED_OPTIONAL = ("nvc", "source")
+# 04 --nvc rules|model labels the rewrites locally (nvc.py), so the annotation may be left out
+UNANNOTATED_OPTIONAL = ("nvc",)
+
+_MISSING = object()
+
+
+def _fast_expr(spec, var: str, consts: dict, depth: int = 0, optional=()) -> str:
+    """Python expression that is True iff `var` matches `spec` exactly."""
+    if spec == "int":
+        return f"type({var}) is int"
+    if spec == "bool":
+        return f"type({var}) is bool"
+    if spec == "text":
+        return f"(type({var}) is str and {var}.strip() != '')"
+    if isinstance(spec, tuple):
+        name = f"_E{len(consts)}"
+        consts[name] = frozenset(spec)
+        return f"(type({var}) is str and {var} in {name})"
+    # dict: exact key count (no unknown keys), then every field bound once with :=
+    n_keys = str(len(spec) - len(optional)) + "".join(f" + ({k!r} in {var})" for k in optional)
+    parts = [f"type({var}) is dict", f"len({var}) == {n_keys}"]
+    for i, (key, sub) in enumerate(spec.items()):
+        v = f"_v{depth}_{i}"
+        present = "is _MISSING or" if key in optional else "is not _MISSING and"
+        parts.append(f"(({v} := {var}.get({key!r}, _MISSING)) {present} "
+                     f"{_fast_expr(sub, v, consts, depth + 1)})")
+    return "(" + " and ".join(parts) + ")"
+
+
+def _repair(spec, value, path: str, problems: list, fixes: list):
+    """Slow path: (possibly repaired) value; appends to problems (fatal) or fixes."""
+    if value is _MISSING:
+        problems.append(f"{path}: missing")
+        return None
+    if spec == "int":
+        if type(value) is int:
+            return value
+        if type(value) is float and value.is_integer():
+            fixes.append(f"{path}: float -> int")
+            return int(value)
+        # isdecimal, not isdigit: "²" is a digit but int() rejects it
+        if type(value) is str and value.strip().removeprefix("-").isdecimal():
+            fixes.append(f"{path}: string -> int")
+            return int(value.strip())
+        problems.append(f"{path}: expected an integer, got {type(value).__name__}")
+        return None
+    if spec == "bool":
+        if type(value) is bool:
+            return value
+        if type(value) is str and value.strip().lower() in ("true", "false"):
+            fixes.append(f"{path}: string -> bool")
+            return value.strip().lower() == "true"
+        if type(value) is int and value in (0, 1):
+            fixes.append(f"{path}: int -> bool")
+            return bool(value)
+        problems.append(f"{path}: expected a boolean, got {type(value).__name__}")
+        return None
+    if spec == "text":
+        if type(value) is not str:
+            problems.append(f"{path}: expected a string, got {type(value).__name__}")
+        elif not value.strip():
+            problems.append(f"{path}: empty")
+        return value
+    if isinstance(spec, tuple):
+        if type(value) is str and value in spec:
+            return value
+        if type(value) is str and value.strip().lower() in spec:
+            fixes.append(f"{path}: {value!r} -> {value.strip().lower()!r}")
+            return value.strip().lower()
+        problems.append(f"{path}: {value!r} not one of {', '.join(spec)}")
+        return None
+    if type(value) is not dict:
+        problems.append(f"{path}: expected an object, got {type(value).__name__}")
+        return None
+    return _repair_fields(spec, value, path, problems, fixes, ())
+
+
+def _repair_fields(spec: dict, obj: dict, path: str, problems: list, fixes: list, optional) -> dict:
+    out = {}
+    for key, sub in spec.items():
+        value = obj.get(key, _MISSING)
+        if value is _MISSING and key in optional:
+            continue
+        out[key] = _repair(sub, value, f"{path}.{key}" if path else key, problems, fixes)
+    extra = [k for k in obj if k not in spec]
+    if extra:
+        fixes.append(f"{path or 'object'}: dropped {', '.join(map(str, extra))}")
+    return out
+
+
+class Validator:
+    """validator(obj) -> (status, object to use or None, [problems or repairs])."""
+
+    def __init__(self, schema: dict = SCHEMA, optional=()):
+        self.schema, self.optional = schema, tuple(optional)
+        consts = {"_MISSING": _MISSING}
+        self.source = f"def fast(obj):\n    return {_fast_expr(schema, 'obj', consts, optional=self.optional)}\n"
+        exec(compile(self.source, "<output_schema>", "exec"), consts)
+        self.fast = consts["fast"]
+
+    def __call__(self, obj):
+        if self.fast(obj):
+            return VALID, obj, []
+        if type(obj) is not dict:
+            return INVALID, None, [f"expected an object, got {type(obj).__name__}"]
+        problems, fixes = [], []
+        out = _repair_fields(self.schema, obj, "", problems, fixes, self.optional)
+        if problems:
+            return INVALID, None, problems
+        return REPAIRABLE, out, fixes
+
+
+validate = Validator()
+validate_cached = Validator(CACHED_SCHEMA, CACHED_OPTIONAL)
+validate_unannotated = Validator(SCHEMA, UNANNOTATED_OPTIONAL)
@@ -0,0 +1,317 @@
+"""
+Incremental runner for the pipeline stages.
+
+Each stage in STAGES declares its script, arguments, input files and output
+files. The code it depends on is the script plus every src/ module it imports,
+found transitively. A stage is re-run only when one of these changed since its
+last successful run, or when an output or its log is missing or was modified.
+Changes are detected by content hash, and hashes are cached by
+(size, mtime) in MANIFEST_PATH so unchanged multi-GB inputs are not re-read.
+
+Stages run as subprocesses in dependency order (an input that is another
+stage's output, or a file it "touches": writes or moves aside without owning
+it). Independent stages run in parallel. Manual stages (API calls, prompts for
+pasting) run only when named, and are never pulled in as another stage's
+upstream. Stdout/stderr of every
+run goes to data/processed/logs/<stage>.log, so a skipped analysis can still
+show its last report.
+
+  python src/pipeline.py                 # run every stale (non-manual) stage
+  python src/pipeline.py --dry-run       # show what would run and why
+  python src/pipeline.py analyze         # analyze + whatever upstream is stale
+  python src/pipeline.py rewrites        # manual stages (API calls) only run when named
+  python src/pipeline.py analyze --force --show
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from storage import input_path, output_path
+
+SRC = Path("src")
+MANIFEST_PATH = Path("data/processed/pipeline_manifest.json")
+LOG_DIR = Path("data/processed/logs")
+JOBS = os.cpu_count() or 1
+
+SEEDS_10IDS = "data/processed/mturk_seeds_10ids.csv"   # curated subset, not produced by a stage
+
+STAGES = {
+    "inspect_dataset": {"script": "src/01_inspect_dataset.py",
+                        "inputs": ["data/raw/dataset_final.csv"], "outputs": []},
+    "inspect_mturk":   {"script": "src/01_inspect_mturk.py",
+                        "inputs": ["data/raw/mturk_aggregate.csv"], "outputs": []},
+    "seeds":           {"script": "src/02_build_mturk_seeds.py",
+                        "inputs": ["data/raw/mturk_aggregate.csv"],
+                        "outputs": [output_path("data/processed/mturk_seeds.csv")]},
+    "turn_index":      {"script": "src/turn_index.py", "args": ["build"],
+                        "inputs": ["data/raw/mturk_aggregate.csv"],
+                        "outputs": ["data/processed/turn_index/meta.json"]},
+    "rewrites":        {"script": "src/03_generate_rewrites.py", "manual": True,
+                        "inputs": [output_path("data/processed/mturk_seeds.csv")],
+                        "outputs": [output_path("data/processed/rewrites.csv")]},
+    "parse":           {"script": "src/04_parse_claude_outputs.py",
+                        "inputs": ["data/processed/claude_outputs.jsonl",
+                                   "data/processed/claude_outputs_retry.jsonl",
+                                   "data/processed/claude_outputs_cached.jsonl",
+                                   "data/processed/batch_prompt.manifest.json"],
+                        "outputs": [output_path("data/processed/claude_outputs_parsed.csv")]},
+    "analyze":         {"script": "src/05_analyze.py",
+                        "inputs": [output_path("data/processed/claude_outputs_parsed.csv"), SEEDS_10IDS],
+                        "outputs": ["data/processed/stats_paired.csv",
+                                    "data/processed/condition_summary.csv"]},
+    "near_dups":       {"script": "src/near_dups.py",
+                        "inputs": [output_path("data/processed/claude_outputs_parsed.csv")],
+                        "outputs": ["data/processed/near_dups.csv",
+                                    "data/processed/condition_distinctness.csv"]},
+    "nvc_agreement":   {"script": "src/nvc.py", "args": ["agree"],
+                        "inputs": [output_path("data/processed/claude_outputs_parsed.csv")],
+                        "outputs": ["data/processed/nvc_agreement.csv"]},
+    "batch_prompt":    {"script": "src/06_generate_batch_prompt.py", "manual": True,
+                        "inputs": [SEEDS_10IDS],
+                        "outputs": ["data/processed/batch_prompt.txt",
+                                    "data/processed/batch_prompt.manifest.json"],
+                        # may write the cached rewrites and move a stale retry response aside
+                        "touches": ["data/processed/claude_outputs_cached.jsonl",
+                                    "data/processed/claude_outputs_retry.jsonl"]},
+}
+
+
+def stage_paths(stage: dict, key: str) -> list:
+    return [str(Path(p)) for p in stage.get(key, [])]
+
+
+def _import_module_call(node) -> bool:
+    """importlib.import_module("name") with a literal name (how numbered scripts are imported)."""
+    return (isinstance(node, ast.Call) and node.args
+            and getattr(node.func, "attr", getattr(node.func, "id", None)) == "import_module"
+            and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str))
+
+
+def local_imports(script, src=SRC) -> list:
+    """The script plus every src/ module it imports, transitively (sorted paths)."""
+    seen, todo = set(), [Path(script)]
+    while todo:
+        path = todo.pop()
+        if str(path) in seen or not path.exists():
+            continue
+        seen.add(str(path))
+        for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+            names = ([a.name for a in node.names] if isinstance(node, ast.Import)
+                     else [node.module] if isinstance(node, ast.ImportFrom) and node.module
+                     else [node.args[0].value] if _import_module_call(node)
+                     else [])
+            for name in names:
+                mod = src / (name.split(".")[0] + ".py")
+                if mod.exists():
+                    todo.append(mod)
+    return sorted(seen)
+
+
+def dependencies(stages: dict = STAGES) -> dict:
+    """stage -> set of stages producing (or touching) one of its inputs."""
+    producers = {p: name for name, st in stages.items()
+                 for p in stage_paths(st, "outputs") + stage_paths(st, "touches")}
+    return {name: {producers[p] for p in stage_paths(st, "inputs") if p in producers} - {name}
+            for name, st in stages.items()}
+
+
+class Manifest:
+    """File hash cache + the component hashes of each stage's last successful run."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = Path(path)
+        data = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.files = data.get("files", {})
+        self.stages = data.get("stages", {})
+        self._lock = threading.Lock()
+
+    def file_hash(self, path) -> str | None:
+        p = Path(path)
+        if not p.exists():
+            return None
+        st = p.stat()
+        with self._lock:
+            rec = self.files.get(str(p))
+        if rec and rec["size"] == st.st_size and rec["mtime_ns"] == st.st_mtime_ns:
+            return rec["sha256"]
+        h = hashlib.sha256()
+        with open(p, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        with self._lock:
+            self.files[str(p)] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                  "sha256": h.hexdigest()}
+        return h.hexdigest()
+
+    def components(self, name: str, stage: dict) -> dict:
+        """Everything a stage's result depends on: code, inputs and arguments."""
+        return {"args": list(stage.get("args", [])),
+                "code": {p: self.file_hash(p) for p in local_imports(stage["script"])},
+                # tables are read Parquet-first (storage.input_path), so hash what is read
+                "inputs": {p: self.file_hash(input_path(p)) for p in stage_paths(stage, "inputs")}}
+
+    def stale_reason(self, name: str, stage: dict) -> str | None:
+        prev = self.stages.get(name)
+        if prev is None:
+            return "never run"
+        cur = self.components(name, stage)
+        if cur["args"] != prev["args"]:
+            return "arguments changed"
+        for kind in ("code", "inputs"):
+            changed = sorted(p for p in cur[kind].keys() | prev[kind].keys()
+                             if cur[kind].get(p) != prev[kind].get(p))
+            if changed:
+                return f"{kind} changed: {', '.join(changed)}"
+        for p in stage_paths(stage, "outputs") + [str(log_path(name))]:
+            if self.file_hash(p) is None:
+                return f"missing: {p}"
+            if p in prev["outputs"] and self.file_hash(p) != prev["outputs"][p]:
+                return f"modified: {p}"
+        return None
+
+    def record(self, name: str, stage: dict, seconds: float):
+        comps = self.components(name, stage)
+        outputs = {p: self.file_hash(p) for p in stage_paths(stage, "outputs") + [str(log_path(name))]}
+        with self._lock:
+            self.stages[name] = {**comps, "outputs": outputs, "seconds": round(seconds, 3),
+                                 "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"files": self.files, "stages": self.stages}, indent=1))
+        os.replace(tmp, self.path)
+
+
+def log_path(name: str) -> Path:
+    return LOG_DIR / f"{name}.log"
+
+
+def select(targets, stages: dict = STAGES) -> list:
+    """
+    Targets (default: all non-manual stages) plus their upstream stages, in a
+    topological order. A manual upstream stage is only included when named.
+    """
+    deps = dependencies(stages)
+    wanted = list(targets) or [n for n, st in stages.items() if not st.get("manual")]
+    order, seen = [], set()
+
+    def visit(n):
+        if n not in seen:
+            seen.add(n)
+            for d in sorted(deps[n]):
+                if not stages[d].get("manual") or d in targets:
+                    visit(d)
+            order.append(n)
+
+    for n in wanted:
+        if n not in stages:
+            raise SystemExit(f"Unknown stage {n!r}; choose from {', '.join(stages)}")
+        visit(n)
+    return order
+
+
+def plan(order, manifest: Manifest, force=(), stages: dict = STAGES) -> dict:
+    """stage -> reason to run (None = up to date), propagating through dependencies."""
+    deps = dependencies(stages)
+    reasons = {}
+    for n in order:
+        upstream = sorted(d for d in deps[n] if reasons.get(d))
+        reasons[n] = ("forced" if n in force else
+                      f"upstream: {', '.join(upstream)}" if upstream else
+                      manifest.stale_reason(n, stages[n]))
+    return reasons
+
+
+def run_stage(name: str, stage: dict) -> tuple:
+    """(returncode, seconds); output goes to the stage log."""
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    with open(log_path(name), "w", encoding="utf-8") as log:
+        proc = subprocess.run([sys.executable, stage["script"], *stage.get("args", [])],
+                              stdout=log, stderr=subprocess.STDOUT,
+                              env={**os.environ, "PYTHONUNBUFFERED": "1"})
+    return proc.returncode, time.perf_counter() - t0
+
+
+def execute(order, reasons, manifest: Manifest, jobs: int = JOBS, stages: dict = STAGES) -> dict:
+    """Run the stale stages, parallel where dependencies allow. Returns stage -> status."""
+    deps = dependencies(stages)
+    status = {n: "skipped" for n in order if not reasons[n]}
+    todo = [n for n in order if reasons[n]]
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while todo or running:
+            for n in list(todo):
+                blockers = [d for d in deps[n] if d in order and status.get(d) not in ("ok", "skipped")]
+                if any(status.get(d) in ("failed", "blocked") for d in blockers):
+                    status[n] = "blocked"
+                    todo.remove(n)
+                elif not blockers and len(running) < jobs:
+                    print(f"▶ {n} ({reasons[n]})")
+                    running[pool.submit(run_stage, n, stages[n])] = n
+                    todo.remove(n)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                n = running.pop(fut)
+                code, seconds = fut.result()
+                if code == 0:
+                    manifest.record(n, stages[n], seconds)
+                    status[n] = "ok"
+                    print(f"✓ {n} {seconds:.1f}s")
+                else:
+                    status[n] = "failed"
+                    print(f"✗ {n} exited with {code} after {seconds:.1f}s; see {log_path(n)}:")
+                    tail = log_path(n).read_text(encoding="utf-8", errors="replace").splitlines()[-15:]
+                    print("\n".join("    " + line for line in tail))
+    return status
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run stale pipeline stages.")
+    ap.add_argument("stages", nargs="*", help=f"targets (default: all but manual); one of {', '.join(STAGES)}")
+    ap.add_argument("--dry-run", action="store_true", help="print what would run and why")
+    ap.add_argument("--force", action="store_true", help="re-run the named targets even if up to date")
+    ap.add_argument("--jobs", "-j", type=int, default=JOBS, help="stages run in parallel")
+    ap.add_argument("--show", action="store_true", help="print the targets' logs afterwards")
+    args = ap.parse_args()
+
+    manifest = Manifest()
+    order = select(args.stages)
+    reasons = plan(order, manifest, force=set(args.stages) if args.force else ())
+    if args.dry_run:
+        for n in order:
+            print(f"{'run ' if reasons[n] else 'skip'}  {n:<16} {reasons[n] or 'up to date'}")
+        manifest.save()    # keep the file hashes computed for the plan
+        return
+
+    t0 = time.perf_counter()
+    status = execute(order, reasons, manifest, args.jobs)
+    manifest.save()
+    print(f"\nPipeline: {time.perf_counter() - t0:.1f}s")
+    for n in order:
+        last = manifest.stages.get(n, {}).get("seconds")
+        timing = f"{last:.1f}s" if last is not None and status[n] == "ok" else ""
+        print(f"  {n:<16} {status[n]:<8} {timing}")
+    if args.show:
+        for n in args.stages or order:
+            if log_path(n).exists():
+                print(f"\n── {n} ({log_path(n)}) ──")
+                print(log_path(n).read_text(encoding="utf-8", errors="replace"), end="")
+    if any(s in ("failed", "blocked") for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
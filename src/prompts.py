@@ -0,0 +1,152 @@
+"""
+Prompt text for the per-call rewrite pipeline (shared by 03 and 06).
+
+Prompts can also be built as segments, [(text, cache_breakpoint), ...] ordered
+from most to least shared, for provider prompt caching (see prompt_cache.py):
+  classic  the original make_prompt text: the backstory comes first but the
+           static requirements come after the utterance, so they are never shared
+  prefix   the same lines as classic, reordered: the requirements every
+           condition shares first, then the condition's own task line (and,
+           with a backstory, its extra requirement and the backstory), then the
+           utterance. Every prompt shares the requirements, and prompts with
+           the same backstory share everything up to the utterance. The none
+           prompt never mentions a backstory, as in classic, so the layouts do
+           not differ in wording between conditions (RQ2)
+A breakpoint closes each segment that other prompts reuse. Backends with
+explicit cache markers (Anthropic cache_control) get the segments; the others
+get the joined text.
+"""
+
+SYSTEM = "You are a careful assistant that rewrites messages using Nonviolent Communication (NVC)."
+
+def make_prompt(backstory: str | None, utterance: str) -> str:
+    if backstory:
+        return f"""Task: Rewrite the message using Nonviolent Communication (NVC), considering the relationship backstory.
+
+Relationship backstory:
+{backstory}
+
+Original utterance:
+{utterance}
+
+Requirements:
+- Preserve the core intent.
+- Remove blame, moral judgment, absolutist language, and demands.
+- Express (when possible): (1) observation (2) feeling (3) need (4) request.
+- Keep it to 1–2 sentences.
+- Do NOT add new facts beyond what is in the utterance and backstory.
+Return only the rewritten text."""
+    else:
+        return f"""Task: Rewrite the message using Nonviolent Communication (NVC).
+
+Original utterance:
+{utterance}
+
+Requirements:
+- Preserve the core intent.
+- Remove blame, moral judgment, absolutist language, and demands.
+- Express (when possible): (1) observation (2) feeling (3) need (4) request.
+- Keep it to 1–2 sentences.
+Return only the rewritten text."""
+
+
+LAYOUTS = ("classic", "prefix")
+
+# the prefix layout's pieces; together they are make_prompt's lines, reordered
+PREFIX_REQUIREMENTS = """Requirements:
+- Preserve the core intent.
+- Remove blame, moral judgment, absolutist language, and demands.
+- Express (when possible): (1) observation (2) feeling (3) need (4) request.
+- Keep it to 1–2 sentences.
+"""
+PREFIX_TASK = {
+    False: """Return only the rewritten text.
+
+Task: Rewrite the message using Nonviolent Communication (NVC).
+
+""",
+    True: """- Do NOT add new facts beyond what is in the utterance and backstory.
+Return only the rewritten text.
+
+Task: Rewrite the message using Nonviolent Communication (NVC), considering the relationship backstory.
+
+""",
+}
+
+MAX_BREAKPOINTS = 4   # Anthropic allows 4 cache_control blocks per request (system included)
+
+
+def prompt_segments(backstory: str | None, utterance: str, layout: str = "classic") -> list:
+    """[(text, cache_breakpoint)]; "".join of the texts is the prompt."""
+    if layout == "prefix":
+        context = f"Relationship backstory:\n{backstory}\n\n" if backstory else ""
+        return [(PREFIX_REQUIREMENTS, True), (PREFIX_TASK[bool(backstory)] + context, True),
+                (f"Original utterance:\n{utterance}", False)]
+    if layout != "classic":
+        raise ValueError(f"Unknown prompt layout {layout!r}; choose from {LAYOUTS}")
+    text = make_prompt(backstory, utterance)
+    cut = text.index("Original utterance:")
+    return [(text[:cut], True), (text[cut:], False)]
+
+
+def build_prompt(backstory: str | None, utterance: str, layout: str = "classic"):
+    """make_prompt text for "classic"; segments (see above) for "prefix"."""
+    if layout == "classic":
+        return make_prompt(backstory, utterance)
+    return prompt_segments(backstory, utterance, layout)
+
+
+def as_text(prompt) -> str:
+    """A prompt given as text or as segments, as plain text."""
+    return prompt if isinstance(prompt, str) else "".join(t for t, _ in prompt)
+
+
+def anthropic_blocks(system: str, prompt) -> tuple:
+    """
+    (system blocks, user content blocks) with cache_control on the system prompt and
+    on each breakpoint segment; only the last MAX_BREAKPOINTS markers are kept.
+    """
+    segs = [(prompt, False)] if isinstance(prompt, str) else list(prompt)
+    marks = [i for i, (_, bp) in enumerate(segs) if bp][-(MAX_BREAKPOINTS - 1):]
+    cache = {"type": "ephemeral"}
+    system_blocks = [{"type": "text", "text": system}
+                     | ({"cache_control": cache} if marks else {})]
+    content = [{"type": "text", "text": t} | ({"cache_control": cache} if i in marks else {})
+               for i, (t, _) in enumerate(segs)]
+    return system_blocks, content
+
+
+NVC_COMPONENTS = ["observation", "feeling", "need", "request", "empathy"]
+
+
+def make_annotated_prompt(backstory: str | None, utterance: str) -> str:
+    """
+    Single-item version of the 06 batch prompt (rewrite + NVC self-annotation),
+    for batch-API requests. The answer is one JSON object in the 04 row shape.
+    """
+    context = f"""
+Relationship backstory:
+{backstory}
+""" if backstory else ""
+    return f"""Task A: Rewrite the message using Nonviolent Communication (NVC){", considering the relationship backstory" if backstory else ""}.
+{context}
+Original utterance:
+{utterance}
+
+Requirements:
+- Preserve the core intent.
+- Remove blame, moral judgment, absolutist language, and demands.
+- Express (when possible): (1) observation (2) feeling (3) need (4) request.
+- Keep it to 1–2 sentences.
+- Do NOT add new facts beyond what is in the utterance{" and backstory" if backstory else ""}.
+
+Task B: Annotate the REWRITE (not the original) for NVC component presence:
+- observation: factual description of what happened, without evaluation
+- feeling: explicit emotional state of the speaker
+- need: underlying value or need being expressed
+- request: a concrete, doable ask (not a demand)
+- empathy: acknowledgment of the other person's feelings or perspective
+Set present=true only if the component is clearly expressed in the rewrite.
+
+Return ONLY one JSON object, no markdown fences:
+{{"rewrite": "<str>", "nvc": {{{", ".join(f'"{c}": {{"present": <bool>}}' for c in NVC_COMPONENTS)}}}}}"""
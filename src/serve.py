@@ -0,0 +1,515 @@
+"""
+Local HTTP scoring service: harmful-marker counts and NVC rewrites for live messages.
+
+  python src/serve.py serve --port 8765 --backend fake
+  curl -s localhost:8765/score -d '{"text": "You never listen to me."}'
+  curl -s localhost:8765/rewrite -d '{"text": "You never listen to me.", "backstory": "..."}'
+  curl -s localhost:8765/metrics
+
+Endpoints (JSON in, JSON out; HTTP/1.1 keep-alive, stdlib asyncio only):
+  POST /score    {"text": str} or {"texts": [str, ...]} -> per-text marker counts
+  POST /rewrite  {"text": str, "backstory": str?}       -> rewrite, its marker counts, usage
+  GET  /metrics  request counts, p50/p95/p99 latency, throughput, batch sizes, queue depth
+  GET  /healthz
+
+The scanner (markers.SCANNER), prompt templates and backend client are created
+once and stay warm. /score requests are micro-batched: the first queued text
+opens a window of `window_ms` (closed early at `max_batch` texts), and the whole
+batch is scored with one count_matrix() scan. Identical /rewrite prompts in
+flight share one upstream call, since none of the backends takes several
+prompts per request. Distinct ones are fanned out concurrently under a
+concurrency cap, the rate limiter and retries of async_llm.
+
+Backpressure: once `max_queue` texts are waiting to be scored, or
+`max_pending` rewrites are in flight, new requests get 503 with Retry-After
+instead of growing the queues. A /score request with more than `max_queue`
+texts gets 413; a long one is queued in `max_batch` slices, so no single scan
+holds the event loop for long. A failed scan fails only its batch's requests
+(500).
+
+  python src/serve.py loadtest --requests 20000 --connections 64 --rewrite-share 0.02
+starts the service in-process against the fake backend (or drives --target
+host:port) and reports client-side latency and throughput next to the
+service's own /metrics.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+import numpy as np
+from dotenv import load_dotenv
+
+from async_llm import RateLimiter, estimate_tokens, limited_call
+from backends import BACKENDS, get_backend
+from llm_cache import make_key
+from markers import SCANNER
+from prompts import LAYOUTS, SYSTEM, as_text, build_prompt
+
+HOST = "127.0.0.1"
+PORT = 8765
+WINDOW_MS = 2.0            # micro-batch window for /score
+MAX_BATCH = 512            # texts per scan
+MAX_QUEUE = 20_000         # texts waiting to be scored before /score answers 503
+MAX_BODY = 1 << 20         # request body bytes
+LATENCY_SAMPLES = 20_000   # recent latencies kept per endpoint for percentiles
+
+BACKEND = "fake"
+MODEL = "gemini-2.0-flash"
+TEMPERATURE = 0.2
+MAX_TOKENS = 200
+PROMPT_LAYOUT = "classic"
+CONCURRENCY = 32           # upstream calls in flight
+MAX_PENDING = 1_000        # rewrites accepted (in flight + waiting) before /rewrite answers 503
+RPM = 1000
+TPM = 1_000_000
+MAX_RETRIES = 3
+
+load_dotenv()
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 502: "Bad Gateway",
+               503: "Service Unavailable"}
+
+
+class Overloaded(Exception):
+    """A queue is at its limit; the client should retry later (503)."""
+
+
+class TooLarge(Exception):
+    """More texts than the service will ever queue at once (413)."""
+
+
+class ScanFailed(Exception):
+    """The marker scan of a /score batch raised (500)."""
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class LatencyStats:
+    def __init__(self, samples: int = LATENCY_SAMPLES):
+        self.recent = deque(maxlen=samples)
+        self.count = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def add(self, seconds: float, status: int):
+        self.count += 1
+        if status == 503:
+            self.rejected += 1
+        elif status >= 400:
+            self.errors += 1
+        else:
+            self.recent.append(seconds)
+
+    def summary(self, uptime: float) -> dict:
+        lat = np.array(self.recent) * 1000
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99]) if len(lat) else (None,) * 3
+        return {"requests": self.count, "errors": self.errors, "rejected": self.rejected,
+                "rps": round(self.count / uptime, 2) if uptime > 0 else None,
+                "p50_ms": _round(p50), "p95_ms": _round(p95), "p99_ms": _round(p99),
+                "max_ms": _round(lat.max()) if len(lat) else None}
+
+
+def _round(v, nd=3):
+    return None if v is None else round(float(v), nd)
+
+
+def marker_dict(row) -> dict:
+    out = dict(zip(SCANNER.names, (int(v) for v in row)))
+    out["total"] = int(sum(row))
+    return out
+
+
+class MarkerBatcher:
+    """Collects /score texts for up to `window_s` and scores each batch with one scan."""
+
+    def __init__(self, window_s: float = WINDOW_MS / 1000, max_batch: int = MAX_BATCH,
+                 max_queue: int = MAX_QUEUE, scanner=SCANNER):
+        self.window_s = window_s
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.scanner = scanner
+        self.pending = deque()         # (texts, future)
+        self.queued = 0                # texts in `pending`
+        self.batches = 0
+        self.failed = 0                # batches whose scan raised
+        self.texts = 0
+        self.largest = 0
+        self.scan_s = 0.0
+        self._wake = asyncio.Event()
+        self._full = asyncio.Event()
+
+    async def score(self, texts: list) -> np.ndarray:
+        """(len(texts), n_categories) counts."""
+        if len(texts) > self.max_queue:
+            raise TooLarge(f"{len(texts)} texts; at most {self.max_queue} per request")
+        if self.queued + len(texts) > self.max_queue:
+            raise Overloaded(f"{self.queued} texts queued for scoring")
+        loop = asyncio.get_running_loop()
+        futs = []
+        for i in range(0, len(texts), self.max_batch) or [0]:
+            futs.append(loop.create_future())
+            self.pending.append((texts[i:i + self.max_batch], futs[-1]))
+        self.queued += len(texts)
+        self._wake.set()
+        if self.queued >= self.max_batch:
+            self._full.set()
+        try:
+            parts = await asyncio.gather(*futs)
+        except BaseException:
+            for f in futs:             # run() skips the slices still queued
+                f.cancel()
+            raise
+        return parts[0] if len(parts) == 1 else np.vstack(parts)
+
+    def _take(self) -> list:
+        batch, n = [], 0
+        while self.pending and (not batch or n + len(self.pending[0][0]) <= self.max_batch):
+            texts, fut = self.pending.popleft()
+            batch.append((texts, fut))
+            n += len(texts)
+        self.queued -= n
+        if self.queued < self.max_batch:
+            self._full.clear()
+        return batch
+
+    async def run(self):
+        while True:
+            await self._wake.wait()
+            if self.window_s > 0 and self.queued < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.window_s)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._take()
+            if not self.pending:
+                self._wake.clear()
+            texts = [t for ts, _ in batch for t in ts]
+            t0 = time.perf_counter()
+            try:
+                counts = self.scanner.count_matrix(texts)    # in-loop: a batch scans in ~ms
+            except Exception as e:
+                # fail this batch's requests, not the batcher, so later /score calls are still served
+                self.failed += 1
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(ScanFailed(f"{type(e).__name__}: {e}"))
+            else:
+                self.scan_s += time.perf_counter() - t0
+                self.batches += 1
+                self.texts += len(texts)
+                self.largest = max(self.largest, len(texts))
+                i = 0
+                for ts, fut in batch:
+                    if not fut.done():
+                        fut.set_result(counts[i:i + len(ts)])
+                    i += len(ts)
+            await asyncio.sleep(0)     # let handlers run between back-to-back full batches
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "failed_batches": self.failed, "texts": self.texts,
+                "queued": self.queued,
+                "mean_batch": round(self.texts / self.batches, 2) if self.batches else None,
+                "largest_batch": self.largest,
+                "scan_us_per_text": round(self.scan_s / self.texts * 1e6, 2) if self.texts else None}
+
+
+class Rewriter:
+    """Concurrent rewrite calls with single-flight sharing of identical prompts."""
+
+    def __init__(self, backend, model: str = MODEL, layout: str = PROMPT_LAYOUT,
+                 concurrency: int = CONCURRENCY, max_pending: int = MAX_PENDING,
+                 rpm: float = RPM, tpm: float = TPM, max_retries: int = MAX_RETRIES):
+        self.backend = backend
+        self.model = model
+        self.layout = layout
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(rpm, tpm)
+        self.sem = asyncio.Semaphore(max(1, concurrency))
+        self.inflight = {}             # prompt key -> future of the shared call
+        self.pending = 0
+        self.upstream_calls = 0
+        self.shared = 0
+        self.retries = 0
+
+    def _on_retry(self, attempt, exc, delay):
+        self.retries += 1
+
+    async def _call(self, prompt):
+        async with self.sem:
+            self.upstream_calls += 1
+            return await limited_call(
+                lambda: self.backend.acomplete(SYSTEM, prompt, model=self.model,
+                                               temperature=TEMPERATURE, max_tokens=MAX_TOKENS),
+                self.limiter, estimate_tokens(SYSTEM + as_text(prompt)) + MAX_TOKENS,
+                max_retries=self.max_retries, on_retry=self._on_retry)
+
+    async def rewrite(self, utterance: str, backstory: str | None = None):
+        """(Completion, shared) where shared means another request's call was reused."""
+        if self.pending >= self.max_pending:
+            raise Overloaded(f"{self.pending} rewrites pending")
+        prompt = build_prompt(backstory or None, utterance, self.layout)
+        key = make_key(self.backend.name, self.model, TEMPERATURE, MAX_TOKENS, SYSTEM, as_text(prompt))
+        self.pending += 1
+        try:
+            fut = self.inflight.get(key)
+            if fut is not None:
+                self.shared += 1
+                return await asyncio.shield(fut), True
+            fut = asyncio.ensure_future(self._call(prompt))
+            self.inflight[key] = fut
+            fut.add_done_callback(lambda _: self.inflight.pop(key, None))
+            return await asyncio.shield(fut), False
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {"backend": self.backend.name, "model": self.model, "pending": self.pending,
+                "upstream_calls": self.upstream_calls, "shared": self.shared, "retries": self.retries}
+
+
+class ScoringService:
+    def __init__(self, batcher: MarkerBatcher, rewriter: Rewriter):
+        self.batcher = batcher
+        self.rewriter = rewriter
+        self.started = time.monotonic()
+        self.endpoints = {}            # route -> LatencyStats
+        self.connections = 0
+        self._tasks = []
+
+    async def start(self, host: str = HOST, port: int = PORT) -> asyncio.AbstractServer:
+        self._tasks.append(asyncio.create_task(self.batcher.run()))
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self, server: asyncio.AbstractServer):
+        server.close()
+        while self.connections:          # let handlers see their clients' EOF
+            await asyncio.sleep(0.01)
+        await server.wait_closed()
+        for t in self._tasks:
+            t.cancel()
+
+    # ---- routes ----
+    async def score(self, req: dict) -> dict:
+        if isinstance(req.get("texts"), list):
+            texts = [str(t) for t in req["texts"]]
+            return {"markers": [marker_dict(row) for row in await self.batcher.score(texts)]}
+        if isinstance(req.get("text"), str):
+            return {"markers": marker_dict((await self.batcher.score([req["text"]]))[0])}
+        raise BadRequest('expected {"text": str} or {"texts": [str, ...]}')
+
+    async def rewrite(self, req: dict) -> dict:
+        text = req.get("text", req.get("utterance"))
+        if not isinstance(text, str) or not text.strip():
+            raise BadRequest('expected {"text": str, "backstory": str (optional)}')
+        backstory = req.get("backstory")
+        completion, shared = await self.rewriter.rewrite(text.strip(), str(backstory).strip() if backstory else None)
+        counts = (await self.batcher.score([completion.text]))[0]
+        return {"rewrite": completion.text, "markers": marker_dict(counts),
+                "prompt_tokens": completion.prompt_tokens, "completion_tokens": completion.completion_tokens,
+                "tokens_estimated": completion.estimated, "finish_reason": completion.finish_reason,
+                "shared_call": shared}
+
+    def metrics(self) -> dict:
+        uptime = time.monotonic() - self.started
+        return {"uptime_s": round(uptime, 3), "connections": self.connections,
+                "endpoints": {k: v.summary(uptime) for k, v in sorted(self.endpoints.items())},
+                "score_batches": self.batcher.stats(), "rewrites": self.rewriter.stats()}
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> tuple:
+        routes = {"/score": ("POST", self.score), "/rewrite": ("POST", self.rewrite),
+                  "/metrics": ("GET", None), "/healthz": ("GET", None)}
+        if path not in routes:
+            return 404, {"error": f"no route {path}"}
+        if method != routes[path][0]:
+            return 405, {"error": f"{path} expects {routes[path][0]}"}
+        if path == "/metrics":
+            return 200, self.metrics()
+        if path == "/healthz":
+            return 200, {"ok": True}
+        try:
+            req = json.loads(body or b"{}")
+            if not isinstance(req, dict):
+                raise BadRequest("body must be a JSON object")
+            return 200, await routes[path][1](req)
+        except (BadRequest, json.JSONDecodeError, UnicodeDecodeError) as e:
+            return 400, {"error": str(e)}
+        except TooLarge as e:
+            return 413, {"error": str(e)}
+        except Overloaded as e:
+            return 503, {"error": f"overloaded: {e}"}
+        except ScanFailed as e:
+            return 500, {"error": f"marker scan failed: {e}"}
+        except Exception as e:             # upstream failure after retries
+            return 502, {"error": f"{type(e).__name__}: {e}"}
+
+    # ---- HTTP/1.1 ----
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                t0 = time.perf_counter()
+                n = int(headers.get("content-length", 0))
+                path = target.split("?", 1)[0]
+                if n > MAX_BODY:
+                    status, payload = 413, {"error": f"body over {MAX_BODY} bytes"}
+                else:
+                    status, payload = await self.dispatch(method, path, await reader.readexactly(n))
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" and n <= MAX_BODY
+                writer.write(http_response(status, payload, keep))
+                await writer.drain()
+                self.endpoints.setdefault(path if status != 404 else "other", LatencyStats()).add(
+                    time.perf_counter() - t0, status)
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+def http_response(status: int, payload: dict, keep_alive: bool = True) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}", "Content-Type: application/json",
+            f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    if status == 503:
+        head.append("Retry-After: 1")
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+
+def build_service(args) -> ScoringService:
+    backend_kwargs = {"latency_ms": args.latency_ms} if args.backend == "fake" else {}
+    backend = get_backend(args.backend, **backend_kwargs)
+    return ScoringService(
+        MarkerBatcher(args.window_ms / 1000, args.max_batch, args.max_queue),
+        Rewriter(backend, args.model, args.layout, args.concurrency, args.max_pending,
+                 args.rpm, args.tpm, args.max_retries))
+
+
+async def serve(args):
+    service = build_service(args)
+    server = await service.start(args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} (backend={args.backend}, "
+          f"window={args.window_ms}ms, max_batch={args.max_batch})")
+    async with server:
+        await server.serve_forever()
+
+
+# ---- load test client ------------------------------------------------------
+
+async def _request(reader, writer, method: str, path: str, payload: dict | None) -> tuple:
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (h := await reader.readline()) not in (b"\r\n", b""):
+        k, _, v = h.decode("latin-1").partition(":")
+        if k.lower() == "content-length":
+            length = int(v)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def loadtest(args):
+    from synth import sample_messages
+    messages = sample_messages(min(args.requests, 5000), args.seed)
+    service = server = None
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+    else:
+        service = build_service(args)
+        server = await service.start(HOST, 0)
+        host, port = HOST, server.sockets[0].getsockname()[1]
+    rng = random.Random(args.seed)
+    plan = ["/rewrite" if rng.random() < args.rewrite_share else "/score" for _ in range(args.requests)]
+    lat = {"/score": [], "/rewrite": []}
+    statuses = {}
+    next_i = 0
+
+    async def client():
+        nonlocal next_i
+        reader, writer = await asyncio.open_connection(host, int(port))
+        try:
+            while next_i < len(plan):
+                i, next_i = next_i, next_i + 1
+                path = plan[i]
+                t0 = time.perf_counter()
+                status, _ = await _request(reader, writer, "POST", path, {"text": messages[i % len(messages)]})
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    lat[path].append(time.perf_counter() - t0)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.connections)))
+    elapsed = time.perf_counter() - t0
+    reader, writer = await asyncio.open_connection(host, int(port))
+    _, metrics = await _request(reader, writer, "GET", "/metrics", None)
+    writer.close()
+    await writer.wait_closed()
+    if service is not None:
+        await service.stop(server)
+
+    print(f"Requests:   {args.requests} over {args.connections} connections in {elapsed:.2f}s "
+          f"({args.requests / elapsed:,.0f} req/s) statuses {dict(sorted(statuses.items()))}")
+    for path, xs in lat.items():
+        if xs:
+            ms = np.array(xs) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            print(f"  {path:<9} {len(xs):>7} ok  p50 {p50:7.2f} ms | p95 {p95:7.2f} ms | p99 {p99:7.2f} ms")
+    print("\nService /metrics:")
+    print(json.dumps(metrics, indent=1))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Marker scoring / NVC rewrite service.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("serve", help="run the HTTP service")
+    lt = sub.add_parser("loadtest", help="drive the service with concurrent keep-alive clients")
+    for p in (s, lt):
+        p.add_argument("--backend", choices=sorted(BACKENDS), default=BACKEND)
+        p.add_argument("--model", default=MODEL)
+        p.add_argument("--layout", choices=LAYOUTS, default=PROMPT_LAYOUT)
+        p.add_argument("--latency-ms", type=float, default=300.0, help="fake backend median latency")
+        p.add_argument("--window-ms", type=float, default=WINDOW_MS, help="/score micro-batch window")
+        p.add_argument("--max-batch", type=int, default=MAX_BATCH)
+        p.add_argument("--max-queue", type=int, default=MAX_QUEUE, help="queued texts before 503")
+        p.add_argument("--concurrency", type=int, default=CONCURRENCY, help="upstream calls in flight")
+        p.add_argument("--max-pending", type=int, default=MAX_PENDING, help="pending rewrites before 503")
+        p.add_argument("--rpm", type=float, default=RPM)
+        p.add_argument("--tpm", type=float, default=TPM)
+        p.add_argument("--max-retries", type=int, default=MAX_RETRIES)
+    s.add_argument("--host", default=HOST)
+    s.add_argument("--port", type=int, default=PORT)
+    lt.add_argument("--target", help="host:port of a running service (default: start one in-process)")
+    lt.add_argument("--requests", type=int, default=20_000)
+    lt.add_argument("--connections", type=int, default=64)
+    lt.add_argument("--rewrite-share", type=float, default=0.02, help="share of requests that are /rewrite")
+    lt.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    try:
+        asyncio.run(serve(args) if args.cmd == "serve" else loadtest(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Deterministic hash partitioning of dialogue ids, for splitting stages 02-05
+across worker processes or machines without coordination.
+
+`--shard i/N` (0 <= i < N) makes a stage handle only the dialogue ids with
+stable_hash(id) % N == i and write its own partition next to the normal output
+(<stem>.shard<i>of<N><suffix>), plus a <partition>.meta.json written last, so
+a partition without one is from a worker that has not finished. The hash is a
+fixed 64-bit mix of the id (splitmix64), not Python's hash(), so every process
+and machine agrees on the assignment; both rows of an id (and all of its
+rewrites) always land in the same shard.
+
+Parquet partitions keep their backstory texts in the worker's own store,
+backstories.shard<i>of<N>.parquet (named in the meta), not in the shared
+storage.BACKSTORY_STORE, so workers on other machines, or at the same time,
+never write one file. `--merge N` on the same stage checks that all N
+partitions are there, were made with the same settings, hold only ids of their
+own shard and do not overlap, folds the shard stores into the shared one, then
+writes the output a single-worker run would have written. Merges read
+partitions as stored (Parquet as written, CSV as strings) so no value is
+re-parsed or re-formatted on the way through.
+
+  python src/02_build_mturk_seeds.py --all --shard 0/4     # ... one per worker, 0..3
+  python src/02_build_mturk_seeds.py --all --merge 4
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from storage import BACKSTORY_STORE, HASH_SUFFIX, TEXT_COLS, add_to_store, load_backstories
+
+_MASK = (1 << 64) - 1
+
+
+def parse_spec(text: str) -> tuple:
+    """argparse type for "i/N"."""
+    try:
+        i, n = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {text!r}")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{n - 1}, got {text!r}")
+    return i, n
+
+
+def add_shard_args(ap: argparse.ArgumentParser):
+    g = ap.add_mutually_exclusive_group()
+    g.add_argument("--shard", type=parse_spec, metavar="i/N",
+                   help="only handle dialogue ids with stable_hash(id) %% N == i; writes a partition")
+    g.add_argument("--merge", type=int, metavar="N",
+                   help="combine the N partitions of --shard runs into the normal output")
+
+
+def _mix(z: np.ndarray) -> np.ndarray:
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _mix_int(z: int) -> int:
+    z = (z + 0x9E3779B97F4A7C15) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+def stable_hash(values, salt: int = 0) -> np.ndarray:
+    """uint64 splitmix64 hash of integer ids; a different salt gives an independent hash."""
+    x = np.asarray(values, dtype=np.int64).reshape(-1).view(np.uint64)
+    return _mix(x ^ np.uint64(_mix_int(salt & _MASK)))
+
+
+def stable_hash_one(value: int, salt: int = 0) -> int:
+    """stable_hash for a single id, in plain Python (per-object use in streams)."""
+    return _mix_int((int(value) & _MASK) ^ _mix_int(salt & _MASK))
+
+
+def shard_one(value: int, n: int) -> int:
+    return stable_hash_one(value) % n
+
+
+def shard_of(ids, n: int) -> np.ndarray:
+    return (stable_hash(ids) % np.uint64(n)).astype(np.int64)
+
+
+def in_shard(ids, shard) -> np.ndarray:
+    """Boolean mask of the ids owned by `shard` ((i, N) or None = all)."""
+    if shard is None:
+        return np.ones(len(ids), dtype=bool)
+    return shard_of(np.asarray(ids, dtype=np.int64), shard[1]) == shard[0]
+
+
+def partition_path(path, shard) -> Path:
+    path = Path(path)
+    i, n = shard
+    return path.with_name(f"{path.stem}.shard{i}of{n}{path.suffix}")
+
+
+def store_partition(shard) -> Path:
+    """A worker's own backstory store (see storage.write_frame)."""
+    return partition_path(BACKSTORY_STORE, shard)
+
+
+def meta_path(partition) -> Path:
+    partition = Path(partition)
+    return partition.with_name(partition.name + ".meta.json")
+
+
+def write_meta(partition, shard, settings: dict, **fields):
+    """Mark a partition complete. `settings` must match across shards for a merge."""
+    meta = {"shard": list(shard), "partition": Path(partition).name, "settings": settings, **fields}
+    meta_path(partition).write_text(json.dumps(meta, indent=1, default=str), encoding="utf-8")
+
+
+def load_metas(path, n: int) -> list:
+    """Meta of every partition of `path` (shard order); exits listing what is missing or inconsistent."""
+    metas, missing = [], []
+    for i in range(n):
+        m = meta_path(partition_path(path, (i, n)))
+        if m.exists():
+            metas.append(json.loads(m.read_text(encoding="utf-8")))
+        else:
+            missing.append(i)
+    if missing:
+        raise SystemExit(f"Cannot merge {path}: shard(s) {', '.join(map(str, missing))} of {n} "
+                         f"not finished (no {meta_path(partition_path(path, (missing[0], n))).name})")
+    for m in metas[1:]:
+        if m["settings"] != metas[0]["settings"]:
+            raise SystemExit(f"Cannot merge {path}: shard {m['shard'][0]} ran with {m['settings']}, "
+                             f"shard 0 with {metas[0]['settings']}")
+    return metas
+
+
+def read_raw(path) -> pd.DataFrame:
+    """A stage table exactly as stored: Parquet as written (backstory hashes unresolved), CSV as strings."""
+    path = Path(path)
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def read_partitions(path, n: int, id_col: str) -> tuple:
+    """
+    (concatenated partitions in shard order with a "_shard" column, metas). Exits if
+    a partition is missing or holds ids that hash to another shard.
+    """
+    metas = load_metas(path, n)
+    frames = []
+    for i in range(n):
+        part = partition_path(path, (i, n))
+        df = read_raw(part) if part.exists() else pd.DataFrame()
+        if len(df):
+            wrong = ~in_shard(df[id_col].astype("int64"), (i, n))
+            if wrong.any():
+                raise SystemExit(f"{part}: {int(wrong.sum())} rows with ids of another shard "
+                                 f"(e.g. {df.loc[wrong, id_col].iloc[0]}); was it written with a different N?")
+            frames.append(df.assign(_shard=i))
+    return (pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()), metas
+
+
+def fold_stores(metas: list, df: pd.DataFrame | None = None):
+    """
+    Add the backstory stores named in `metas` to the shared store; with `df` (raw
+    merged partitions) exit if any of its backstory hashes is still unknown.
+    """
+    for m in metas:
+        if not m.get("backstories"):
+            continue
+        part = BACKSTORY_STORE.with_name(m["backstories"])
+        if not part.exists():
+            raise SystemExit(f"Cannot merge: {part} (backstories of shard {m['shard'][0]}) is missing; "
+                             f"copy it from the worker that ran the shard")
+        add_to_store(pd.read_parquet(part))
+    hashed = [c + HASH_SUFFIX for c in TEXT_COLS if df is not None and c + HASH_SUFFIX in df.columns]
+    if hashed:
+        known = load_backstories().index
+        hashes = pd.unique(pd.concat([df[c] for c in hashed]).dropna())
+        missing = hashes[~pd.Index(hashes).isin(known)]
+        if len(missing):
+            raise SystemExit(f"Cannot merge: {len(missing)} backstory hashes (e.g. {missing[0]}) "
+                             f"are in no shard store nor in {BACKSTORY_STORE}")
+
+
+def check_disjoint(df: pd.DataFrame, key_cols: list, what: str):
+    """Exit if a key occurs in more than one row (after read_partitions, across shards)."""
+    dup = df.duplicated(key_cols, keep=False)
+    if dup.any():
+        sample = df.loc[dup, key_cols + ["_shard"]].head(5).to_dict("records")
+        raise SystemExit(f"Cannot merge {what}: {int(dup.sum())} rows share a key, e.g. {sample}")
+
@@ -0,0 +1,228 @@
+"""
+Paired bootstrap CIs and sign-flip permutation tests for backstory contrasts.
+
+Each item (row_id, mturk_condition) is rewritten under every backstory
+condition, so a contrast like pos − none is a mean of per-item differences.
+For all metrics at once:
+  - bootstrap: resample items with replacement; an index matrix of shape
+    (resamples, items) becomes a count matrix, and count matrix @ differences
+    gives every resampled mean in one BLAS call; percentile CI
+  - sign-flip: under H0 (no effect) each item's difference is symmetric
+    around 0; a random ±1 matrix @ differences gives the null distribution;
+    two-sided p = (1 + #|null| >= |observed|) / (1 + resamples)
+Resamples are processed in chunks of at most MAX_CELLS matrix entries, so
+memory stays bounded for tens of thousands of items. Missing values (e.g.
+unannotated cache-filled rewrites) are dropped per metric.
+
+GroupedWelford and ItemMeans are the online accumulators behind 05's
+streaming mode. GroupedWelford keeps count/mean/variance per group, and
+ItemMeans keeps per-item sums per condition, from which item_means()'s wide
+table is rebuilt.
+"""
+import numpy as np
+import pandas as pd
+
+N_RESAMPLES = 10_000
+ALPHA = 0.05
+SEED = 0
+MAX_CELLS = 20_000_000      # resamples × items per chunk
+ITEM_KEYS = ["row_id", "mturk_condition"]
+
+
+def item_means(df: pd.DataFrame, metrics: list, by: str = "backstory_condition",
+               keys: list = ITEM_KEYS) -> pd.DataFrame:
+    """Wide table: one row per item, (metric, condition) columns of per-item means."""
+    return df.pivot_table(index=keys, columns=by, values=metrics, aggfunc="mean", dropna=False)
+
+
+def paired_differences(wide: pd.DataFrame, metrics: list, condition: str,
+                       baseline: str = "none") -> pd.DataFrame:
+    """Per-item condition − baseline for each metric (NaN unless present in both)."""
+    return (wide.xs(condition, axis=1, level=1) - wide.xs(baseline, axis=1, level=1))[metrics]
+
+
+def _chunks(n_resamples: int, n_items: int):
+    step = max(1, MAX_CELLS // max(n_items, 1))
+    for start in range(0, n_resamples, step):
+        yield min(step, n_resamples - start)
+
+
+def _masked(diffs: np.ndarray) -> tuple:
+    mask = ~np.isnan(diffs)
+    return np.where(mask, diffs, 0.0), mask.astype(np.float64)
+
+
+def bootstrap_means(diffs: np.ndarray, n_resamples: int = N_RESAMPLES, seed: int = SEED) -> np.ndarray:
+    """(n_resamples, n_metrics) bootstrap means of an (n_items, n_metrics) difference matrix."""
+    rng = np.random.default_rng(seed)
+    values, mask = _masked(diffs)
+    n = len(values)
+    out = []
+    for b in _chunks(n_resamples, n):
+        idx = rng.integers(0, n, size=(b, n))
+        # index matrix -> per-resample item counts, then one matmul for all means
+        counts = np.bincount((idx + n * np.arange(b)[:, None]).ravel(),
+                             minlength=b * n).reshape(b, n).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out.append((counts @ values) / (counts @ mask))
+    return np.vstack(out)
+
+
+def signflip_null(diffs: np.ndarray, n_resamples: int = N_RESAMPLES, seed: int = SEED) -> np.ndarray:
+    """(n_resamples, n_metrics) means under random sign flips of each item's difference."""
+    rng = np.random.default_rng(seed + 1)
+    values, mask = _masked(diffs)
+    n_valid = mask.sum(axis=0)
+    out = []
+    for b in _chunks(n_resamples, len(values)):
+        signs = rng.integers(0, 2, size=(b, len(values)), dtype=np.int8) * 2 - 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out.append((signs @ values) / n_valid)
+    return np.vstack(out)
+
+
+def paired_tests(diffs: pd.DataFrame, n_resamples: int = N_RESAMPLES, alpha: float = ALPHA,
+                 seed: int = SEED) -> pd.DataFrame:
+    """One row per metric: n, mean difference, bootstrap CI, sign-flip p-value."""
+    d = diffs.to_numpy(dtype=np.float64, na_value=np.nan)
+    n = (~np.isnan(d)).sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        observed = np.nanmean(d, axis=0) if len(d) else np.full(d.shape[1], np.nan)
+    if len(d):
+        boot = bootstrap_means(d, n_resamples, seed)
+        lo, hi = np.nanquantile(boot, [alpha / 2, 1 - alpha / 2], axis=0)
+        null = signflip_null(d, n_resamples, seed)
+        # small tolerance so exact ties with the observed mean count as extreme
+        extreme = (np.abs(null) >= np.abs(observed) - 1e-12).sum(axis=0)
+        p = (1 + extreme) / (1 + n_resamples)
+    else:
+        lo = hi = p = np.full(d.shape[1], np.nan)
+    return pd.DataFrame({"metric": diffs.columns, "n": n, "mean_diff": observed,
+                         "ci_low": lo, "ci_high": hi, "p_value": np.where(n > 0, p, np.nan)})
+
+
+def contrast_table(wide: pd.DataFrame, metrics: list, conditions=("pos", "neg"),
+                   baseline: str = "none", n_resamples: int = N_RESAMPLES, alpha: float = ALPHA,
+                   seed: int = SEED) -> pd.DataFrame:
+    """
+    Tidy table from an item_means() wide table: one row per (contrast, metric)
+    with n, mean difference, CI and p.
+    """
+    rows = []
+    present = set(wide.columns.get_level_values(1))
+    for cond in conditions:
+        if cond not in present or baseline not in present:
+            continue
+        diffs = paired_differences(wide, metrics, cond, baseline)
+        res = paired_tests(diffs, n_resamples, alpha, seed)
+        res.insert(0, "contrast", f"{cond} - {baseline}")
+        rows.append(res)
+    if not rows:
+        return pd.DataFrame(columns=["contrast", "metric", "n", "mean_diff", "ci_low", "ci_high", "p_value"])
+    return pd.concat(rows, ignore_index=True)
+
+
+class GroupedWelford:
+    """
+    Count, mean and variance per group for several metrics, updated chunk by chunk
+    (Welford / Chan et al. pairwise merge), NaNs skipped per metric.
+    """
+
+    def __init__(self, metrics: list):
+        self.metrics = list(metrics)
+        self.groups = {}                       # group -> row in the arrays
+        self.n = np.zeros((0, len(self.metrics)))
+        self.mean = np.zeros((0, len(self.metrics)))
+        self.m2 = np.zeros((0, len(self.metrics)))
+
+    def _rows(self, groups) -> np.ndarray:
+        for g in groups:
+            if g not in self.groups:
+                self.groups[g] = len(self.groups)
+        grow = len(self.groups) - len(self.n)
+        if grow > 0:
+            pad = np.zeros((grow, len(self.metrics)))
+            self.n, self.mean, self.m2 = (np.vstack([a, pad]) for a in (self.n, self.mean, self.m2))
+        return np.array([self.groups[g] for g in groups], dtype=np.int64)
+
+    def update(self, groups, values: np.ndarray):
+        """groups: length-n labels; values: (n, n_metrics) floats with NaN for missing."""
+        uniq, inv = np.unique(np.asarray(groups, dtype=object), return_inverse=True)
+        rows = self._rows(list(uniq))
+        mask = ~np.isnan(values)
+        x = np.where(mask, values, 0.0)
+        k = len(uniq)
+        n_b = np.zeros((k, x.shape[1]))
+        s_b = np.zeros((k, x.shape[1]))
+        np.add.at(n_b, inv, mask)
+        np.add.at(s_b, inv, x)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_b = np.where(n_b > 0, s_b / n_b, 0.0)
+        m2_b = np.zeros((k, x.shape[1]))
+        np.add.at(m2_b, inv, np.where(mask, (x - mean_b[inv]) ** 2, 0.0))
+        n_a, mean_a = self.n[rows], self.mean[rows]
+        n = n_a + n_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean_b - mean_a
+            self.mean[rows] = np.where(n > 0, mean_a + delta * n_b / n, 0.0)
+            self.m2[rows] += m2_b + np.where(n > 0, delta ** 2 * n_a * n_b / n, 0.0)
+        self.n[rows] = n
+
+    def frame(self, stat: str = "mean") -> pd.DataFrame:
+        """groups × metrics table of "count", "mean", "var" or "std" (sample, ddof=1)."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = {"count": self.n,
+                      "mean": np.where(self.n > 0, self.mean, np.nan),
+                      "var": np.where(self.n > 1, self.m2 / (self.n - 1), np.nan)}
+        values["std"] = np.sqrt(values["var"])
+        order = sorted(self.groups, key=self.groups.get)
+        return pd.DataFrame(values[stat], index=pd.Index(order), columns=self.metrics).sort_index()
+
+
+class ItemMeans:
+    """Per-(item, condition) sums and counts of several metrics, for item_means() without the long table."""
+
+    def __init__(self, metrics: list, conditions=("none", "pos", "neg")):
+        self.metrics = list(metrics)
+        self.items = {}                        # item key -> row
+        self.conditions = {c: i for i, c in enumerate(conditions)}
+        self.sums = np.zeros((0, len(self.conditions), len(self.metrics)))
+        self.counts = np.zeros((0, len(self.conditions), len(self.metrics)), dtype=np.int64)
+
+    def item_rows(self, keys) -> np.ndarray:
+        rows = np.fromiter((self.items.setdefault(k, len(self.items)) for k in keys),
+                           dtype=np.int64, count=len(keys))
+        self._grow(len(self.items), len(self.conditions))
+        return rows
+
+    def _grow(self, n_items, n_conds):
+        i0, c0, m = self.sums.shape
+        if n_items > i0 or n_conds > c0:
+            cap = max(n_items, 2 * i0)
+            sums = np.zeros((cap, max(n_conds, c0), m))
+            counts = np.zeros((cap, max(n_conds, c0), m), dtype=np.int64)
+            sums[:i0, :c0], counts[:i0, :c0] = self.sums, self.counts
+            self.sums, self.counts = sums, counts
+
+    def update(self, keys, conditions, values: np.ndarray):
+        """keys: item keys, conditions: labels, values: (n, n_metrics) with NaN for missing."""
+        rows = self.item_rows(keys)
+        for c in conditions:
+            self.conditions.setdefault(c, len(self.conditions))
+        self._grow(len(self.items), len(self.conditions))
+        cols = np.array([self.conditions[c] for c in conditions], dtype=np.int64)
+        mask = ~np.isnan(values)
+        np.add.at(self.sums, (rows, cols), np.where(mask, values, 0.0))
+        np.add.at(self.counts, (rows, cols), mask)
+
+    def wide(self, keys: list = ITEM_KEYS) -> pd.DataFrame:
+        """Same layout as item_means(): sorted item index, (metric, condition) columns."""
+        n = len(self.items)
+        conds = sorted(self.conditions)
+        ci = [self.conditions[c] for c in conds]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums[:n][:, ci] / self.counts[:n][:, ci]       # NaN where count == 0
+        cols = pd.MultiIndex.from_product([self.metrics, conds], names=[None, "backstory_condition"])
+        data = means.transpose(0, 2, 1).reshape(n, -1)                   # metric-major like pivot_table
+        index = pd.MultiIndex.from_tuples(list(self.items), names=keys)
+        return pd.DataFrame(data, index=index, columns=cols).sort_index()
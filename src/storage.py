@@ -0,0 +1,199 @@
+"""
+Parquet intermediates for the pipeline stages, with backstories stored once.
+
+Seed and rewrite tables repeat the same positive/negative backstory text on
+every row (and paired ids share it). In Parquet output those columns are
+replaced by a short content hash (<col>_hash, dictionary-encoded) and the
+texts live once in BACKSTORY_STORE. read_frame() resolves them back into
+pandas Categoricals, so callers see the usual columns without a copy per row,
+and only reads the columns asked for.
+
+Stages write PIPELINE_FORMAT and read whichever of <name>.parquet / <name>.csv
+exists (Parquet first), so the CSVs already in data/processed keep working. A
+CSV newer than its Parquet sibling (e.g. updated by git) is an error rather
+than a guess: re-run the stage, or say which copy to keep with `use`. The store
+is updated under a file lock (merge on write), so concurrent writers of Parquet
+tables do not lose each other's texts.
+
+  python src/storage.py export data/processed/mturk_seeds.parquet   # -> .csv for inspection
+  python src/storage.py use data/processed/mturk_seeds.csv          # keep the CSV, rewrite the Parquet
+"""
+import argparse
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from tabular import file_lock, iter_csv_chunks, write_table
+
+PIPELINE_FORMAT = "parquet"          # "csv" restores plain CSV intermediates
+BACKSTORY_STORE = Path("data/processed/backstories.parquet")
+TEXT_COLS = ("positive_backstory", "negative_backstory", "backstory_used_in_mturk")
+HASH_SUFFIX = "_hash"
+
+
+def text_hash(text) -> str | None:
+    if text is None or (isinstance(text, float) and pd.isna(text)):
+        return None
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()[:16]
+
+
+def output_path(path) -> Path:
+    return Path(path).with_suffix(f".{PIPELINE_FORMAT}")
+
+
+class StaleTable(RuntimeError):
+    """A stage table's CSV is newer than its Parquet sibling, so it is unclear which one to read."""
+
+
+def input_path(path) -> Path:
+    """The Parquet sibling of `path` if it exists, else `path`; StaleTable if the CSV is newer."""
+    path = Path(path)
+    pq = path.with_suffix(".parquet")
+    if not pq.exists():
+        return path
+    if path != pq and path.exists() and path.stat().st_mtime > pq.stat().st_mtime:
+        raise StaleTable(f"{path} is newer than {pq.name}. Re-run the stage that writes it, or keep one: "
+                         f"python src/storage.py use {path}  (or {pq})")
+    return pq
+
+
+def exists(path) -> bool:
+    return input_path(path).exists()
+
+
+def load_backstories(store=BACKSTORY_STORE) -> pd.Series:
+    """hash -> text."""
+    if not Path(store).exists():
+        return pd.Series(dtype=object)
+    df = pd.read_parquet(store)
+    return pd.Series(df["text"].values, index=df["hash"].values)
+
+
+def add_to_store(entries: pd.DataFrame, store=BACKSTORY_STORE):
+    """Merge (hash, text) rows into a store: re-read, append the new hashes, rewrite, under a lock."""
+    with file_lock(store):
+        old = load_backstories(store)
+        new = entries[~entries["hash"].isin(old.index)].drop_duplicates("hash")
+        if new.empty:
+            return
+        merged = pd.concat([pd.DataFrame({"hash": old.index, "text": old.values}), new[["hash", "text"]]],
+                           ignore_index=True)
+        write_table(merged, store)
+
+
+def _update_store(texts: pd.Series, store=BACKSTORY_STORE):
+    texts = texts.dropna().astype(str).drop_duplicates()
+    add_to_store(pd.DataFrame({"hash": texts.map(text_hash).values, "text": texts.values}), store)
+
+
+def write_frame(df: pd.DataFrame, path, store=BACKSTORY_STORE):
+    """
+    Write a stage table; Parquet output stores backstory columns as hashes, their
+    texts in `store` (a --shard worker passes its own, see sharding.store_partition).
+    """
+    path = Path(path)
+    if path.suffix != ".parquet":
+        write_table(df, path)
+        return
+    df = df.copy()
+    cols = [c for c in TEXT_COLS if c in df.columns]
+    if cols:
+        _update_store(pd.concat([df[c] for c in cols], ignore_index=True), store)
+    for c in cols:
+        df.insert(df.columns.get_loc(c), c + HASH_SUFFIX, df.pop(c).map(text_hash))
+    write_table(df, path)
+
+
+def read_frame(path, columns=None) -> pd.DataFrame:
+    """
+    Read a stage table (Parquet preferred, see input_path) with optional column
+    projection. Hashed backstory columns come back as text Categoricals.
+    """
+    path = input_path(path)
+    if path.suffix != ".parquet":
+        return pd.read_csv(path, usecols=columns)
+    import pyarrow.parquet as pq
+    names = pq.read_schema(path).names
+    want = names if columns is None else [
+        c + HASH_SUFFIX if c in TEXT_COLS and c + HASH_SUFFIX in names else c for c in columns]
+    df = pd.read_parquet(path, columns=want)
+    return _resolve_hashes(df, path)
+
+
+def _resolve_hashes(df: pd.DataFrame, path, lookup: pd.Series | None = None) -> pd.DataFrame:
+    """Replace <col>_hash columns by text Categoricals; KeyError if a hash is not in the store."""
+    hashed = [c for c in df.columns if c.endswith(HASH_SUFFIX) and c[:-len(HASH_SUFFIX)] in TEXT_COLS]
+    if hashed and lookup is None:
+        lookup = load_backstories()
+    for c in hashed:
+        codes = df[c].astype("category")
+        texts = lookup.reindex(codes.cat.categories)
+        if texts.isna().any():
+            raise KeyError(f"{texts.isna().sum()} backstory hashes in {path} "
+                           f"are missing from {BACKSTORY_STORE}")
+        # content hashes are 1:1 with texts, so the categories can simply be renamed
+        df[c] = codes.cat.rename_categories(texts.values)
+        df = df.rename(columns={c: c[:-len(HASH_SUFFIX)]})
+    return df
+
+
+def iter_frames(path, columns=None, batch_rows: int = 100_000):
+    """
+    read_frame() in chunks of about `batch_rows` rows, for tables too large to load.
+    Parquet is streamed by record batch, CSV via tabular.iter_csv_chunks.
+    """
+    path = input_path(path)
+    if path.suffix != ".parquet":
+        yield from iter_csv_chunks(path, usecols=columns, chunksize=batch_rows)
+        return
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(path)
+    names = pf.schema_arrow.names
+    want = None if columns is None else [
+        c + HASH_SUFFIX if c in TEXT_COLS and c + HASH_SUFFIX in names else c for c in columns]
+    hashed = any(n.endswith(HASH_SUFFIX) and n[:-len(HASH_SUFFIX)] in TEXT_COLS for n in want or names)
+    lookup = load_backstories() if hashed else None
+    for batch in pf.iter_batches(batch_size=batch_rows, columns=want):
+        yield _resolve_hashes(batch.to_pandas(), path, lookup)
+
+
+def export_csv(path, out=None) -> Path:
+    out = Path(out) if out else Path(path).with_suffix(".csv")
+    write_table(read_frame(path), out)
+    # an export is a copy, not an update: keep it from shadowing the Parquet (input_path)
+    st = input_path(path).stat()
+    os.utime(out, (st.st_atime, st.st_mtime))
+    return out
+
+
+def use(path) -> Path:
+    """Keep `path` (a table's CSV or Parquet) and rewrite its sibling from it, so the two agree."""
+    path = Path(path)
+    if path.suffix == ".parquet":
+        return export_csv(path)
+    pq = path.with_suffix(".parquet")
+    write_frame(pd.read_csv(path), pq)
+    st = pq.stat()
+    os.utime(path, (st.st_atime, st.st_mtime))
+    return pq
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Pipeline table utilities.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export", help="write a Parquet stage table as CSV (backstories resolved)")
+    ex.add_argument("path")
+    ex.add_argument("--out")
+    us = sub.add_parser("use", help="keep this CSV or Parquet copy of a table and rewrite the other from it")
+    us.add_argument("path")
+    args = ap.parse_args()
+    if args.cmd == "export":
+        print("Written:", export_csv(args.path, args.out))
+    elif args.cmd == "use":
+        print("Written:", use(args.path))
+
+
+if __name__ == "__main__":
+    main()
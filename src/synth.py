@@ -0,0 +1,235 @@
+"""
+Synthetic PersonaConflicts-shaped data for benchmarks and offline runs.
+
+  corpus   mturk_aggregate.csv-shaped rows: one row per dialogue, pairs of rows
+           share an id (positive / negative MTurk condition). transformed_conversation
+           is a JSON list of {turn, speaker, text}; turn_problematic_avg is a JSON list
+           of per-turn scores, turn_vc_union and turn_nvc_union Python-repr lists of
+           per-turn VC / NVC labels. A share of rows exercises 02's fallbacks: missing or wrong-length
+           score lists (falls back to the VC union), no usable lists at all (middle
+           turn), an unparseable conversation, and non-couple relationships.
+  outputs  claude_outputs.jsonl-shaped dumps: one object per (row_id, mturk_condition,
+           backstory_condition) with a rewrite and an nvc annotation, as a JSON array
+           or JSONL, with an optional share of malformed records.
+
+Texts are drawn from a fixed pool mixing neutral phrases and the lexical VC
+markers in markers.py, so the marker scanner has realistic work. Everything is
+seeded and written chunk by chunk, so 1M dialogues need no more memory than 1k.
+
+  python src/synth.py corpus  data/bench/mturk_aggregate_100000.csv --dialogues 100000
+  python src/synth.py outputs data/bench/claude_outputs_100000.jsonl --dialogues 100000
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from prompts import NVC_COMPONENTS
+
+SEED = 0
+CHUNK_ROWS = 10_000
+BACKSTORY_CONDITIONS = ["none", "pos", "neg"]
+VC_LABELS = ["Moralistic Judgment", "Demand", "Comparison", "Denial of Responsibility",
+             "Deserve Thinking"]
+NVC_LABELS = ["Observation", "Feeling", "Need", "Request", "Empathy"]
+SUBTYPES = (["couple"] * 7 + ["family", "friend", "sibling"])
+
+_OPENERS = ["Honestly,", "Look,", "I mean,", "Okay,", "So", "Listen,", "Well,", "Again,", "", ""]
+_CORES = [
+    "you always leave the dishes for me", "you never listen when I talk about work",
+    "you should have called before coming home this late", "that's so selfish of you",
+    "I guess you forgot about dinner again", "whatever, do what you want",
+    "you need to start pulling your fair share of the chores", "it's your fault we missed the train",
+    "you just don't care about my friends", "I felt hurt when plans changed without me",
+    "can we talk about the weekend", "I was waiting for you at the station for an hour",
+    "you better fix this before my parents arrive", "nobody else makes me feel this ignored",
+    "I need some time to think about what happened", "the rent is due on Friday",
+    "you made a promise and broke it", "we agreed to save money this month",
+    "congratulations on ruining another evening", "I would like us to plan the trip together",
+]
+_CLOSERS = [".", "!", "?", ". Seriously?", ". Fine.", "... every time.", ".", "."]
+_BACKSTORY = [
+    "They met at university and moved in together two years ago.",
+    "Money has been tight since one of them lost a job last spring.",
+    "They usually resolve arguments by taking a walk together.",
+    "A recent holiday ended early after a big argument.",
+    "They share household chores but disagree on what counts as clean.",
+    "Both work long shifts and rarely have dinner together.",
+    "They have been planning a wedding for the next summer.",
+    "One partner often visits family on weekends alone.",
+]
+_REWRITES = [
+    "When I saw the dishes in the sink, I felt tired because I need shared care for our home. "
+    "Would you be willing to take turns this week?",
+    "I'm feeling hurt about last night because connection matters to me. Could we plan one evening together?",
+    "I noticed we missed the train and I'm feeling frustrated; reliability matters a lot to me. "
+    "Can we leave ten minutes earlier next time?",
+    "You always say you'll help, and I feel let down. Would you tell me what gets in the way?",
+    "I feel anxious about the rent because I value security. Would you sit down with me on Thursday?",
+    "It sounds like you had a long day. I'd like to hear about it, and then talk about dinner plans.",
+    "You should have called, but I understand things came up. Could you text me next time?",
+    "I'm worried we're drifting apart because I need closeness. Would you be open to a walk tonight?",
+]
+
+
+def _sentence_pool(rng: np.random.Generator, size: int = 4096) -> np.ndarray:
+    o = rng.integers(0, len(_OPENERS), size)
+    c = rng.integers(0, len(_CORES), (size, 2))
+    e = rng.integers(0, len(_CLOSERS), size)
+    two = rng.random(size) < 0.35
+    out = []
+    for i in range(size):
+        s = f"{_OPENERS[o[i]]} {_CORES[c[i, 0]]}".strip()
+        if two[i]:
+            s += f", and {_CORES[c[i, 1]]}"
+        out.append(s[0].upper() + s[1:] + _CLOSERS[e[i]])
+    return np.array(out, dtype=object)
+
+
+def sample_messages(n: int, seed: int = SEED) -> list:
+    """n conflict-style messages from the corpus sentence pool (load tests, demos)."""
+    rng = np.random.default_rng(seed)
+    pool = _sentence_pool(rng)
+    return pool[rng.integers(0, len(pool), n)].tolist()
+
+
+def _backstory_pool(rng: np.random.Generator, size: int = 1024) -> np.ndarray:
+    idx = rng.integers(0, len(_BACKSTORY), (size, 3))
+    return np.array([" ".join(_BACKSTORY[j] for j in row) for row in idx], dtype=object)
+
+
+def corpus_chunk(start: int, n: int, rng: np.random.Generator, sentences, backstories,
+                 nvc_rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Rows start .. start + n - 1 (row i is dialogue i; ids pair up rows 2k and 2k + 1).
+    NVC labels are drawn from nvc_rng, so adding them left the other columns unchanged.
+    """
+    rows = np.arange(start, start + n)
+    ids = rows // 2
+    n_turns = rng.integers(4, 13, n)
+    ends = np.cumsum(n_turns)
+    total = int(ends[-1]) if n else 0
+    kind = rng.random(n)        # which score columns are usable (see module docstring)
+    subtype = np.array(SUBTYPES, dtype=object)[rng.integers(0, len(SUBTYPES), n)]
+    texts = sentences[rng.integers(0, len(sentences), total)]
+    has_label = rng.random((total, len(VC_LABELS))) < 0.08
+    scores = np.round(rng.gamma(2.0, 0.6, total), 3)
+    has_nvc = nvc_rng.random((total, len(NVC_LABELS))) < 0.12
+    conv, tpa, vcu, nvcu = [], [], [], []
+    for i in range(n):
+        lo, hi = int(ends[i] - n_turns[i]), int(ends[i])
+        if kind[i] < 0.01:
+            conv.append('[{"turn": 1, "speaker": ')          # truncated JSON: no usable turns
+        else:
+            conv.append(json.dumps([{"turn": t + 1, "speaker": "AB"[t % 2], "text": texts[lo + t]}
+                                    for t in range(hi - lo)]))
+        if kind[i] < 0.06:
+            tpa.append(None)                                   # -> turn_vc_union
+        elif kind[i] < 0.09:
+            tpa.append(json.dumps(scores[lo:hi - 1].tolist()))  # wrong length -> turn_vc_union
+        else:
+            tpa.append(json.dumps(scores[lo:hi].tolist()))
+        if 0.06 <= kind[i] < 0.075:
+            vcu.append(None)                                   # nothing usable -> middle turn
+        else:
+            vcu.append(repr([[VC_LABELS[j] for j in np.flatnonzero(row)] for row in has_label[lo:hi]]))
+        nvcu.append(repr([[NVC_LABELS[j] for j in np.flatnonzero(row)] for row in has_nvc[lo:hi]]))
+    # both rows of an id share its backstories
+    pos_bs = backstories[(ids * 7919) % len(backstories)]
+    neg_bs = backstories[(ids * 104729 + 13) % len(backstories)]
+    condition = np.where(rows % 2 == 0, "positive", "negative")
+    return pd.DataFrame({
+        "id": ids,
+        "condition": condition,
+        "relationship_subtype": subtype,
+        "relationship_tag": np.where(subtype == "couple", "romantic partners", subtype),
+        "backstory": np.where(condition == "positive", pos_bs, neg_bs),
+        "positive_backstory": pos_bs,
+        "negative_backstory": neg_bs,
+        "transformed_conversation": conv,
+        "turn_problematic_avg": tpa,
+        "turn_vc_union": vcu,
+        "turn_nvc_union": nvcu,
+    })
+
+
+def write_corpus(path, dialogues: int, seed: int = SEED, chunk_rows: int = CHUNK_ROWS) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    nvc_rng = np.random.default_rng(seed + 3)
+    sentences, backstories = _sentence_pool(rng), _backstory_pool(rng)
+    tmp = path.with_name(path.name + ".tmp")
+    for start in range(0, dialogues, chunk_rows):
+        chunk = corpus_chunk(start, min(chunk_rows, dialogues - start), rng, sentences, backstories, nvc_rng)
+        chunk.to_csv(tmp, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    tmp.replace(path)
+    return path
+
+
+def output_objects(dialogues: int, seed: int = SEED):
+    """One rewrite object per (dialogue row, backstory condition), in corpus order."""
+    rng = np.random.default_rng(seed + 1)
+    for start in range(0, dialogues, CHUNK_ROWS):
+        rows = np.arange(start, min(start + CHUNK_ROWS, dialogues))
+        m = len(rows) * len(BACKSTORY_CONDITIONS)
+        texts = rng.integers(0, len(_REWRITES), m)
+        present = rng.random((m, len(NVC_COMPONENTS))) < 0.55
+        unannotated = rng.random(m) < 0.02
+        for j in range(m):
+            r = int(rows[j // len(BACKSTORY_CONDITIONS)])
+            obj = {"row_id": r // 2, "mturk_condition": "positive" if r % 2 == 0 else "negative",
+                   "backstory_condition": BACKSTORY_CONDITIONS[j % len(BACKSTORY_CONDITIONS)],
+                   "rewrite": _REWRITES[texts[j]]}
+            if not unannotated[j]:
+                obj["nvc"] = {c: {"present": bool(present[j, k])} for k, c in enumerate(NVC_COMPONENTS)}
+            yield obj
+
+
+def write_outputs(path, dialogues: int, seed: int = SEED, fmt: str = "jsonl",
+                  malformed: float = 0.0) -> Path:
+    """claude_outputs dump as "jsonl" or a pretty-printed JSON "array" like a pasted response."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed + 2)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        if fmt == "array":
+            f.write("[\n")
+        for i, obj in enumerate(output_objects(dialogues, seed)):
+            text = json.dumps(obj, ensure_ascii=False, indent=2 if fmt == "array" else None)
+            if malformed and rng.random() < malformed:
+                text = text[: len(text) // 2]
+            if fmt == "array":
+                f.write(("" if i == 0 else ",\n") + text)
+            else:
+                f.write(text + "\n")
+        if fmt == "array":
+            f.write("\n]\n")
+    tmp.replace(path)
+    return path
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate synthetic corpus / LLM output files.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("corpus", help="mturk_aggregate.csv-shaped corpus")
+    o = sub.add_parser("outputs", help="claude_outputs.jsonl-shaped dump (3 objects per dialogue)")
+    for p in (c, o):
+        p.add_argument("out", type=Path)
+        p.add_argument("--dialogues", type=int, default=1000)
+        p.add_argument("--seed", type=int, default=SEED)
+    o.add_argument("--format", choices=["jsonl", "array"], default="jsonl")
+    o.add_argument("--malformed", type=float, default=0.0, help="share of truncated records")
+    args = ap.parse_args()
+    if args.cmd == "corpus":
+        write_corpus(args.out, args.dialogues, args.seed)
+    else:
+        write_outputs(args.out, args.dialogues, args.seed, args.format, args.malformed)
+    print(f"Written: {args.out} ({args.out.stat().st_size / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Table output helpers shared by the pipeline stages (CSV or Parquet, chosen by suffix).
+
+Files are written under a temp name unique to the writing process and thread
+(temp_path) and renamed into place, so concurrent writers never share a temp
+file; file_lock() serialises read-modify-write updates of one shared file.
+"""
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:      # not POSIX: file_lock() does not lock
+    fcntl = None
+
+import pandas as pd
+
+
+def temp_path(path) -> Path:
+    """A temp name next to `path` (same filesystem, so os.replace is atomic), unique per writer."""
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp")
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock on <path>.lock, across processes, for a read-modify-write of `path`."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_table(df: pd.DataFrame, path):
+    """Write CSV or Parquet atomically via a temp file + rename."""
+    path = Path(path)
+    tmp = temp_path(path)
+    try:
+        if path.suffix == ".parquet":
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_csv(tmp, index=False)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class ChunkedTableWriter:
+    """
+    Append DataFrame chunks to one CSV or Parquet file without holding the whole
+    table. `dtypes` pins column types so every chunk serializes the same way
+    (e.g. "Int64" keeps 0/1 flags as integers even when a chunk has missing values).
+    The file is written under a temp name and renamed on close().
+    """
+
+    def __init__(self, path, dtypes: dict | None = None):
+        self.path = Path(path)
+        self.tmp = temp_path(self.path)
+        self.dtypes = dtypes or {}
+        self.rows = 0
+        self._pq = None
+        self._header = True
+
+    def write(self, rows):
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        if df.empty:
+            return
+        df = df.astype({k: v for k, v in self.dtypes.items() if k in df.columns})
+        if self.path.suffix == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._pq is None:
+                self._pq = pq.ParquetWriter(self.tmp, table.schema)
+            self._pq.write_table(table.cast(self._pq.schema))
+        else:
+            df.to_csv(self.tmp, mode="w" if self._header else "a", header=self._header, index=False)
+            self._header = False
+        self.rows += len(df)
+
+    def close(self):
+        if self._pq is not None:
+            self._pq.close()
+        if self.tmp.exists():
+            os.replace(self.tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+            return
+        if self._pq is not None:
+            self._pq.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+def iter_csv_chunks(path, usecols=None, chunksize: int = 100_000, engine: str = "c"):
+    """
+    Yield DataFrame chunks of a CSV reading only `usecols`. engine="pyarrow" streams
+    record batches through pyarrow.csv (multi-threaded parsing); otherwise pandas'
+    C parser with chunksize.
+    """
+    if engine == "pyarrow":
+        import pyarrow.csv as pacsv
+        reader = pacsv.open_csv(
+            path,
+            read_options=pacsv.ReadOptions(block_size=8 << 20),
+            parse_options=pacsv.ParseOptions(newlines_in_values=True),
+            convert_options=pacsv.ConvertOptions(include_columns=usecols, strings_can_be_null=True))
+        buf, n = [], 0
+        for batch in reader:
+            buf.append(batch)
+            n += batch.num_rows
+            if n >= chunksize:
+                yield _batches_to_pandas(buf)
+                buf, n = [], 0
+        if buf:
+            yield _batches_to_pandas(buf)
+    else:
+        yield from pd.read_csv(path, usecols=usecols, chunksize=chunksize)
+
+
+def _batches_to_pandas(batches):
+    import pyarrow as pa
+    return pa.Table.from_batches(batches).to_pandas()
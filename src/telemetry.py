@@ -0,0 +1,321 @@
+"""
+Per-call LLM metrics and stage profiling.
+
+Each backend call in 03 is measured by a CallMeter and written as one JSON line
+to METRICS_PATH. A line records:
+  queue_wait_s   time before the call got a concurrency slot, plus rate-limiter waits
+  wall_s         from the slot to the final result, including retries and backoff
+  latency_s      duration of the last (successful) backend attempt
+  attempts       backend attempts (1 + retries)
+  prompt_tokens / completion_tokens / cached_tokens   provider usage, or estimates
+                 when tokens_estimated is true
+  finish_reason  as reported by the provider
+  status         ok | cache_hit (served from llm_cache, nothing billed) | error
+Lines of one invocation share a run id, so a file can hold many runs.
+
+    python src/telemetry.py summary                  # latest run
+    python src/telemetry.py summary --run all --top 20
+
+prints p50/p95 latency, tokens/s, cost per 1k rewrites and the slowest prompts,
+overall and by backstory condition. Cost uses PRICES (list prices in USD per
+1M tokens; update them when providers change pricing).
+
+profiled() is the hook used by 02/04/05 (--profile, --trace-memory). It runs a
+stage under cProfile and/or tracemalloc, saves PROFILE_DIR/<stage>.prof, prints
+the top functions and allocation sites, and writes a "stage" line with wall
+time, CPU time and peak traced memory to the same metrics file.
+"""
+import argparse
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from json_stream import iter_json_file
+from prompts import as_text
+
+METRICS_PATH = Path("data/processed/metrics/calls.jsonl")
+PROFILE_DIR = Path("data/processed/metrics")
+PROFILE_TOP = 25           # functions / allocation sites printed
+COUNT_ROWS = ["calls", "ok", "cache_hits", "errors", "retries", "prompt_tokens", "completion_tokens"]
+
+# USD per 1M tokens: (input, cached input, output)
+PRICES = {
+    "gemini-2.0-flash":          (0.10, 0.025, 0.40),
+    "gemini-2.0-flash-lite":     (0.075, 0.01875, 0.30),
+    "claude-3-5-haiku-latest":   (0.80, 0.08, 4.00),
+    "claude-3-5-sonnet-latest":  (3.00, 0.30, 15.00),
+    "fake-nvc":                  (0.0, 0.0, 0.0),
+}
+
+
+def new_run_id(stage: str) -> str:
+    return f"{stage}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+
+
+class MetricsLog:
+    """Append-only JSONL of metric records; every record gets the run id, stage and a timestamp."""
+
+    def __init__(self, path=METRICS_PATH, stage: str = "", run: str | None = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stage = stage
+        self.run = run or new_run_id(stage)
+        self.records = 0
+        self._fh = open(self.path, "a", encoding="utf-8")
+
+    def write(self, kind: str, **fields):
+        rec = {"kind": kind, "run": self.run, "stage": self.stage, "ts": round(time.time(), 3), **fields}
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.records += 1
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CallMeter:
+    """
+    Timing and usage of one logical call. Create it when the call is queued,
+    call started() when it gets a slot, attempt() around each backend attempt,
+    then finish() once.
+    """
+
+    def __init__(self, log: MetricsLog | None, key: tuple, prompt, backend: str, model: str,
+                 queued: float | None = None):
+        self.log = log
+        self.key = key
+        self.prompt = prompt
+        self.backend = backend
+        self.model = model
+        self.queued = time.perf_counter() if queued is None else queued
+        self.start = None
+        self.wait = 0.0            # rate-limiter waits after the slot was acquired
+        self.attempts = 0
+        self.latency = None
+        self.completion = None
+        self.cache_hit = False
+
+    def started(self):
+        self.start = time.perf_counter()
+
+    def waited(self, seconds: float):
+        self.wait += seconds
+
+    @contextmanager
+    def attempt(self):
+        t0 = time.perf_counter()
+        self.attempts += 1
+        try:
+            yield
+        finally:
+            self.latency = time.perf_counter() - t0
+
+    def finish(self, error: BaseException | None = None):
+        if self.log is None:
+            return
+        now = time.perf_counter()
+        start = self.start if self.start is not None else self.queued
+        c = self.completion
+        status = "error" if error is not None else "cache_hit" if self.cache_hit else "ok"
+        self.log.write(
+            "call", backend=self.backend, model=self.model,
+            row_id=self.key[0], mturk_condition=self.key[1], backstory_condition=self.key[2],
+            status=status, queue_wait_s=round(start - self.queued + self.wait, 6),
+            wall_s=round(now - start, 6),
+            latency_s=None if self.latency is None or self.cache_hit else round(self.latency, 6),
+            attempts=self.attempts,
+            prompt_tokens=c.prompt_tokens if c else None,
+            completion_tokens=c.completion_tokens if c else None,
+            cached_tokens=c.cached_tokens if c else None,
+            tokens_estimated=c.estimated if c else None,
+            finish_reason=c.finish_reason if c else None,
+            prompt_sha1=hashlib.sha1(as_text(self.prompt).encode("utf-8")).hexdigest()[:12],
+            error=f"{type(error).__name__}: {error}" if error is not None else None)
+
+
+# ---- profiling hooks -------------------------------------------------------
+
+def add_profile_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--profile", action="store_true",
+                    help=f"run under cProfile; stats -> {PROFILE_DIR}/<stage>.prof")
+    ap.add_argument("--trace-memory", action="store_true",
+                    help="trace Python allocations (tracemalloc): peak and top allocation sites")
+    ap.add_argument("--metrics", type=Path, default=METRICS_PATH,
+                    help="metrics file for the --profile / --trace-memory stage record")
+
+
+@contextmanager
+def profiled(stage: str, args=None, *, profile: bool | None = None, trace_memory: bool | None = None,
+             metrics_path=None):
+    """Run the body under cProfile / tracemalloc as requested by add_profile_args() flags."""
+    profile = getattr(args, "profile", False) if profile is None else profile
+    trace_memory = getattr(args, "trace_memory", False) if trace_memory is None else trace_memory
+    if not (profile or trace_memory):
+        yield
+        return
+    metrics_path = metrics_path or getattr(args, "metrics", None) or METRICS_PATH
+    prof = cProfile.Profile() if profile else None
+    if trace_memory:
+        tracemalloc.start()
+    t0, c0 = time.perf_counter(), time.process_time()
+    if prof:
+        prof.enable()
+    try:
+        yield
+    finally:
+        if prof:
+            prof.disable()
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        if trace_memory:     # before printing the profile, which allocates itself
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP]
+            tracemalloc.stop()
+        fields = {"wall_s": round(wall, 3), "cpu_s": round(cpu, 3)}
+        print(f"\n=== {stage}: {wall:.2f}s wall, {cpu:.2f}s CPU ===")
+        if prof:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            prof_path = PROFILE_DIR / f"{stage}.prof"
+            prof.dump_stats(prof_path)
+            out = io.StringIO()
+            pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            print(out.getvalue().strip())
+            print(f"  -> {prof_path} (python -m pstats {prof_path})")
+            fields["profile"] = str(prof_path)
+        if trace_memory:
+            print(f"\nTraced memory: peak {peak / 2**20:.1f} MiB, {current / 2**20:.1f} MiB still allocated at exit")
+            for st in top:
+                print(f"  {st.size / 2**20:8.2f} MiB  {st.count:>8} blocks  {st.traceback[0]}")
+            fields.update(peak_mib=round(peak / 2**20, 2), live_mib=round(current / 2**20, 2))
+        with MetricsLog(metrics_path, stage) as log:
+            log.write("stage", **fields)
+
+
+# ---- summary ---------------------------------------------------------------
+
+def load_records(path=METRICS_PATH, kind: str = "call", run: str | None = "latest") -> pd.DataFrame:
+    """Records of one kind; run = a run id, "latest" (last call run in the file) or "all"/None."""
+    errors = []
+    df = pd.DataFrame([rec for _, rec in iter_json_file(path, errors) if rec.get("kind") == kind])
+    if errors:
+        print(f"Skipped {len(errors)} malformed metric record(s) in {path}")
+    if df.empty or run in (None, "all"):
+        return df
+    if run == "latest":
+        run = df["run"].iloc[-1]
+    return df[df["run"] == run].reset_index(drop=True)
+
+
+def call_cost(df: pd.DataFrame) -> pd.Series:
+    """USD per call record (NaN for models without a PRICES entry; 0 for cache hits, errors and the fake backend)."""
+    prices = pd.DataFrame([PRICES.get(m, (np.nan,) * 3) for m in df["model"]],
+                          columns=["input", "cached", "output"], index=df.index)
+    cached = df["cached_tokens"].fillna(0)
+    usd = ((df["prompt_tokens"].fillna(0) - cached) * prices["input"]
+           + cached * prices["cached"] + df["completion_tokens"].fillna(0) * prices["output"]) / 1e6
+    return usd.where((df["status"] == "ok") & (df["backend"] != "fake"), 0.0)
+
+
+def _quantile(s: pd.Series, q: float) -> float:
+    s = s.dropna()
+    return float(s.quantile(q)) if len(s) else np.nan
+
+
+def call_summary(df: pd.DataFrame) -> pd.Series:
+    api = df[df["status"] != "cache_hit"]
+    ok = df[df["status"] == "ok"]
+    rewrites = int((df["status"] != "error").sum())
+    cost = call_cost(df).sum(min_count=1)
+    lat = ok["latency_s"].sum()
+    return pd.Series({
+        "calls": len(df), "ok": len(ok), "cache_hits": int((df["status"] == "cache_hit").sum()),
+        "errors": int((df["status"] == "error").sum()),
+        "retries": int((api["attempts"] - 1).clip(lower=0).sum()),
+        "p50_latency_s": _quantile(ok["latency_s"], 0.50),
+        "p95_latency_s": _quantile(ok["latency_s"], 0.95),
+        "p50_wall_s": _quantile(df["wall_s"], 0.50),
+        "p95_wall_s": _quantile(df["wall_s"], 0.95),
+        "mean_queue_s": df["queue_wait_s"].mean(),
+        "prompt_tokens": ok["prompt_tokens"].sum(),
+        "completion_tokens": ok["completion_tokens"].sum(),
+        "out_tokens_per_s": ok["completion_tokens"].sum() / lat if lat > 0 else np.nan,
+        "cost_usd": cost,
+        "usd_per_1k_rewrites": cost / rewrites * 1000 if rewrites else np.nan,
+        "estimated_share": ok["tokens_estimated"].astype(float).mean() if len(ok) else np.nan,
+    })
+
+
+def summarize(df: pd.DataFrame, top: int = 10) -> dict:
+    """{"by_condition": table incl. an "all" row, "slowest": top calls by latency, "span_s": run span}."""
+    by = df.groupby("backstory_condition").apply(call_summary, include_groups=False)
+    by.loc["all"] = call_summary(df)
+    ok = df[df["status"] == "ok"]
+    slowest = ok.sort_values("latency_s", ascending=False).head(top)[
+        ["row_id", "mturk_condition", "backstory_condition", "latency_s", "wall_s", "attempts",
+         "prompt_tokens", "completion_tokens", "finish_reason", "prompt_sha1"]].astype(
+        {"prompt_tokens": "Int64", "completion_tokens": "Int64"})
+    # ts is written at the end of each call; the run starts when the first call was queued
+    span = float(df["ts"].max() - (df["ts"] - df["wall_s"] - df["queue_wait_s"]).min()) if len(df) else 0.0
+    return {"by_condition": by, "slowest": slowest, "span_s": span}
+
+
+def print_summary(path=METRICS_PATH, run: str | None = "latest", top: int = 10):
+    df = load_records(path, "call", run)
+    if df.empty:
+        print(f"No call records in {path}" + (f" for run {run}" if run not in (None, "all", "latest") else ""))
+    else:
+        s = summarize(df, top)
+        runs = df["run"].unique()
+        label = runs[0] if len(runs) == 1 else f"{len(runs)} runs"
+        models = ", ".join(sorted(df["model"].dropna().unique()))
+        print(f"=== LLM calls: {label} ({models}) ===")
+        done = int((df["status"] != "error").sum())
+        if s["span_s"] > 0:
+            print(f"  {done} rewrites in {s['span_s']:.1f}s ({done / s['span_s']:.2f} rewrites/s)")
+        unpriced = sorted(set(df.loc[df["backend"] != "fake", "model"].dropna()) - set(PRICES))
+        if unpriced:
+            print(f"  no price for {', '.join(unpriced)}; add it to telemetry.PRICES")
+        with pd.option_context("display.width", 200, "display.max_columns", 30):
+            table = s["by_condition"].T.round(4).astype(object)
+            table.loc[COUNT_ROWS] = s["by_condition"][COUNT_ROWS].T.fillna(0).astype("int64")
+            print(table.to_string())
+            print(f"\n=== Slowest {len(s['slowest'])} prompts ===")
+            print(s["slowest"].round(3).to_string(index=False))
+    stages = load_records(path, "stage", None)
+    if not stages.empty:
+        print("\n=== Profiled stage runs (latest per stage) ===")
+        cols = [c for c in ("stage", "wall_s", "cpu_s", "peak_mib", "profile", "run") if c in stages]
+        print(stages.groupby("stage").tail(1)[cols].fillna("").to_string(index=False))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="LLM call metrics and stage profiles.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sm = sub.add_parser("summary", help="latency / tokens / cost report for a metrics file")
+    sm.add_argument("path", nargs="?", type=Path, default=METRICS_PATH)
+    sm.add_argument("--run", default="latest", help='run id, "latest" or "all"')
+    sm.add_argument("--top", type=int, default=10, help="slowest prompts listed")
+    args = ap.parse_args()
+    if args.cmd == "summary":
+        if not args.path.exists():
+            raise SystemExit(f"Missing {args.path}; run 03_generate_rewrites.py first.")
+        print_summary(args.path, args.run, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""
+Turn-level index over the MTurk corpus: one pass over the raw CSV, then every
+slice ("all Demand turns in romantic couples with score >= 3") is answered from
+memory-mapped NumPy columns without re-parsing a single conversation string.
+
+INDEX_DIR holds
+  meta.json           vocabularies (conditions, subtypes, tags, speakers, labels),
+                      posting keys, counts and the corpus size / mtime it was built from
+  d_*.npy             per dialogue (= corpus row): id, condition, subtype, tag,
+                      selection method (02's METHODS) and turn_start (CSR offsets)
+  t_*.npy             per turn: dialogue, turn index, speaker, score
+                      (turn_problematic_avg, NaN if missing), rank key (02's
+                      turn_matrices key), n_vc, labels (uint64 bitmask, one bit
+                      per VC / NVC label in meta["labels"])
+  <blob>.bin/.off.npy utf-8 strings + offsets: turn text, the turn's VC labels as
+                      02 writes them ("A|B"), and the three backstories per dialogue
+  postings.npy        sorted turn ids per key ("vc:Demand", "nvc:Request",
+                      "subtype:couple", "tag:romantic partners", "condition:positive"),
+                      concatenated; postings_off.npy holds each key's offsets
+
+Turns are parsed with 02's turn_matrices, so turn indices, scores and the
+seed ranking key mean exactly what they mean in 02. A query intersects posting
+lists (smallest first, by binary search into the larger one) and then filters
+the numeric columns of the survivors.
+
+  python src/turn_index.py build
+  python src/turn_index.py query --vc Demand --tag "romantic partners" --min-score 3
+  python src/turn_index.py info
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from tabular import iter_csv_chunks
+
+INDEX_DIR = "data/processed/turn_index"
+CHUNKSIZE = 20_000
+VERSION = 1
+
+DIALOGUE_COLS = {"id": np.int64, "condition": np.int8, "subtype": np.int16, "tag": np.int16,
+                 "method": np.int8}
+TURN_COLS = {"dialogue": np.int32, "turn": np.int16, "speaker": np.int16, "score": np.float64,
+             "key": np.float64, "n_vc": np.int16, "labels": np.uint64}
+TURN_BLOBS = ["text", "vc_labels"]
+DIALOGUE_BLOBS = ["backstory", "positive_backstory", "negative_backstory"]
+MAX_LABELS = 64
+
+
+class Vocab:
+    """Value -> small int code, in first-seen order; missing values get -1."""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {v: i for i, v in enumerate(self.values)}
+
+    def encode(self, values) -> np.ndarray:
+        out = np.empty(len(values), dtype=np.int64)
+        for i, v in enumerate(values):
+            if v is None or (isinstance(v, float) and np.isnan(v)):
+                out[i] = -1
+                continue
+            code = self.codes.get(v)
+            if code is None:
+                code = self.codes[v] = len(self.values)
+                self.values.append(v)
+            out[i] = code
+        return out
+
+    def code(self, value) -> int:
+        if value not in self.codes:
+            raise KeyError(f"{value!r} not in the index (known: {', '.join(map(str, self.values))})")
+        return self.codes[value]
+
+
+class BlobWriter:
+    """Append-only utf-8 string column: <name>.bin plus <name>.off.npy (and .null.npy)."""
+
+    def __init__(self, root: Path, name: str):
+        self.root, self.name = root, name
+        self.f = open(root / f"{name}.bin", "wb")
+        self.ends, self.nulls, self.pos = [], [], 0
+
+    def extend(self, values):
+        nulls = pd.isna(pd.Series(values, dtype=object)).to_numpy()
+        data = [b"" if null else str(v).encode("utf-8") for v, null in zip(values, nulls)]
+        self.nulls.append(nulls)
+        ends = self.pos + np.cumsum([len(b) for b in data], dtype=np.int64)
+        self.f.write(b"".join(data))
+        self.pos = int(ends[-1]) if len(ends) else self.pos
+        self.ends.append(ends)
+
+    def close(self):
+        self.f.close()
+        np.save(self.root / f"{self.name}.off.npy", np.concatenate([np.zeros(1, np.int64)] + self.ends))
+        nulls = np.concatenate(self.nulls) if self.nulls else np.zeros(0, bool)
+        if nulls.any():
+            np.save(self.root / f"{self.name}.null.npy", nulls)
+
+
+class Blob:
+    """Memory-mapped string column written by BlobWriter."""
+
+    def __init__(self, root: Path, name: str):
+        self.off = np.load(root / f"{name}.off.npy", mmap_mode="r")
+        size = int(self.off[-1])
+        self.data = np.memmap(root / f"{name}.bin", dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+        null = root / f"{name}.null.npy"
+        self.null = np.load(null, mmap_mode="r") if null.exists() else None
+
+    def take(self, ids) -> list:
+        ids = np.asarray(ids, dtype=np.int64)
+        lo, hi = self.off[ids], self.off[ids + 1]
+        out = [self.data[a:b].tobytes().decode("utf-8") for a, b in zip(lo.tolist(), hi.tolist())]
+        if self.null is not None:
+            for j in np.flatnonzero(self.null[ids]):
+                out[j] = None
+        return out
+
+
+def _seeds_module():
+    # 02 imports this module for --from-index, so its parser is imported lazily
+    return importlib.import_module("02_build_mturk_seeds")
+
+
+def _label_lists(values, n: int) -> list:
+    """Per-turn label lists of a parsed turn_*_union value, indexed like 02's seed_record."""
+    if not isinstance(values, list):
+        return [[] for _ in range(n)]
+    return [values[j] if j < len(values) and isinstance(values[j], list) else [] for j in range(n)]
+
+
+def build(corpus: str = None, out: str = INDEX_DIR, chunksize: int = CHUNKSIZE) -> Path:
+    seeds = _seeds_module()
+    corpus = corpus or seeds.IN_PATH
+    header = set(pd.read_csv(corpus, nrows=0).columns)
+    has_nvc = "turn_nvc_union" in header
+    cols = seeds.SEED_COLS + (["turn_nvc_union"] if has_nvc else [])
+
+    out = Path(out)
+    tmp = out.with_name(out.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    conditions, subtypes, tags, speakers = Vocab(), Vocab(), Vocab(), Vocab()
+    labels = Vocab()                      # ("vc" | "nvc", name) -> bit
+    blobs = {name: BlobWriter(tmp, name) for name in TURN_BLOBS + DIALOGUE_BLOBS}
+    dcols = {c: [] for c in DIALOGUE_COLS}
+    tcols = {c: [] for c in TURN_COLS}
+    n_turns, n_rows = [], 0
+
+    for chunk in iter_csv_chunks(corpus, usecols=cols, chunksize=chunksize):
+        parsed, key, score, n_labels, method = seeds.turn_matrices(chunk)
+        lengths = np.array([len(p[1]) for p in parsed], dtype=np.int64)
+        cell = np.arange(key.shape[1]) < lengths[:, None]
+
+        dcols["id"].append(chunk["id"].to_numpy(dtype=np.int64))
+        dcols["condition"].append(conditions.encode(chunk["condition"].tolist()))
+        dcols["subtype"].append(subtypes.encode(chunk["relationship_subtype"].tolist()))
+        dcols["tag"].append(tags.encode(chunk["relationship_tag"].tolist()))
+        dcols["method"].append(method)
+        for name in DIALOGUE_BLOBS:
+            blobs[name].extend(chunk[name].tolist())
+
+        nvc = chunk["turn_nvc_union"].tolist() if has_nvc else [None] * len(chunk)
+        texts, spk, vc_text, bits = [], [], [], []
+        for (_, turns, _, vcu), nvcu in zip(parsed, nvc):
+            vc_lists = _label_lists(vcu, len(turns))
+            nvc_lists = _label_lists(seeds.try_parse_list(nvcu), len(turns))
+            for (text, speaker), vc_l, nvc_l in zip(turns, vc_lists, nvc_lists):
+                texts.append(text)
+                spk.append(str(speaker))
+                vc_text.append("|".join(vc_l))
+                mask = 0
+                for kind, names in (("vc", vc_l), ("nvc", nvc_l)):
+                    for name in names:
+                        bit = labels.codes.get((kind, str(name)))
+                        mask |= 1 << (int(labels.encode([(kind, str(name))])[0]) if bit is None else bit)
+                bits.append(mask)
+        if len(labels.values) > MAX_LABELS:
+            raise SystemExit(f"more than {MAX_LABELS} distinct VC/NVC labels; the bitmask cannot hold them")
+
+        tcols["dialogue"].append(np.repeat(np.arange(n_rows, n_rows + len(chunk)), lengths))
+        tcols["turn"].append(np.nonzero(cell)[1])
+        tcols["speaker"].append(speakers.encode(spk))
+        tcols["score"].append(score[cell])
+        tcols["key"].append(key[cell])
+        tcols["n_vc"].append(n_labels[cell])
+        tcols["labels"].append(np.array(bits, dtype=np.uint64))
+        blobs["text"].extend(texts)
+        blobs["vc_labels"].extend(vc_text)
+        n_turns.append(lengths)
+        n_rows += len(chunk)
+
+    for b in blobs.values():
+        b.close()
+    for vocab, limit in ((conditions, np.int8), (subtypes, np.int16), (tags, np.int16), (speakers, np.int16)):
+        if len(vocab.values) > np.iinfo(limit).max:
+            raise SystemExit(f"too many distinct values for {limit.__name__}: {vocab.values[:5]} ...")
+
+    cat = lambda parts, dtype: np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype)
+    d = {c: cat(dcols[c], dt) for c, dt in DIALOGUE_COLS.items()}
+    t = {c: cat(tcols[c], dt) for c, dt in TURN_COLS.items()}
+    d["turn_start"] = np.concatenate([np.zeros(1, np.int64), np.cumsum(cat(n_turns, np.int64))])
+    for c, arr in d.items():
+        np.save(tmp / f"d_{c}.npy", arr)
+    for c, arr in t.items():
+        np.save(tmp / f"t_{c}.npy", arr)
+
+    # posting lists: label bits from the bitmask, dialogue-level codes broadcast to turns
+    keys, lists = [], []
+    for bit, (kind, name) in enumerate(labels.values):
+        keys.append(f"{kind}:{name}")
+        lists.append(np.flatnonzero(t["labels"] & np.uint64(1 << bit)))
+    for field, vocab in (("subtype", subtypes), ("tag", tags), ("condition", conditions)):
+        codes = d[field][t["dialogue"]]
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(vocab.values) + 1))
+        for code, value in enumerate(vocab.values):
+            keys.append(f"{field}:{value}")
+            lists.append(order[bounds[code]:bounds[code + 1]])
+    id_dtype = np.int32 if len(t["dialogue"]) < 2 ** 31 else np.int64
+    np.save(tmp / "postings.npy", cat(lists, id_dtype))
+    np.save(tmp / "postings_off.npy", np.concatenate([np.zeros(1, np.int64),
+                                                      np.cumsum([len(p) for p in lists], dtype=np.int64)]))
+
+    stat = os.stat(corpus)
+    meta = {
+        "version": VERSION,
+        "source": {"path": str(corpus), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        "dialogues": n_rows, "turns": int(len(t["dialogue"])), "has_nvc": has_nvc,
+        "conditions": conditions.values, "subtypes": subtypes.values, "tags": tags.values,
+        "speakers": speakers.values, "methods": seeds.METHODS,
+        "labels": [list(kv) for kv in labels.values], "postings": keys,
+    }
+    (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=1), encoding="utf-8")
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    return out
+
+
+class TurnIndex:
+    """Read side of an index directory; every column is memory-mapped."""
+
+    def __init__(self, path: str = INDEX_DIR):
+        self.path = Path(path)
+        if not (self.path / "meta.json").exists():
+            raise FileNotFoundError(f"no turn index at {self.path}; run: python src/turn_index.py build")
+        self.meta = json.loads((self.path / "meta.json").read_text(encoding="utf-8"))
+        if self.meta.get("version") != VERSION:
+            raise ValueError(f"{self.path} is index version {self.meta.get('version')}, expected {VERSION}; rebuild it")
+        load = lambda name: np.load(self.path / f"{name}.npy", mmap_mode="r")
+        self.d = {c: load(f"d_{c}") for c in list(DIALOGUE_COLS) + ["turn_start"]}
+        self.t = {c: load(f"t_{c}") for c in TURN_COLS}
+        self.blobs = {name: Blob(self.path, name) for name in TURN_BLOBS + DIALOGUE_BLOBS}
+        self.postings, self.postings_off = load("postings"), load("postings_off")
+        self.keys = {k: i for i, k in enumerate(self.meta["postings"])}
+        self.vocab = {f: Vocab(self.meta[f + "s"]) for f in ("condition", "subtype", "tag", "speaker")}
+        self.labels = [tuple(kv) for kv in self.meta["labels"]]
+
+    def __len__(self):
+        return self.meta["turns"]
+
+    def stale(self) -> bool:
+        """True if the corpus the index was built from has changed since (or is gone)."""
+        src = self.meta["source"]
+        try:
+            stat = os.stat(src["path"])
+        except OSError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns) != (src["size"], src["mtime_ns"])
+
+    def posting(self, key: str) -> np.ndarray:
+        if key not in self.keys:
+            raise KeyError(f"no posting list {key!r} (known: {', '.join(self.keys)})")
+        i = self.keys[key]
+        return self.postings[self.postings_off[i]:self.postings_off[i + 1]]
+
+    def query(self, vc=(), nvc=(), subtype=None, tag=None, condition=None,
+              min_score=None, min_vc=None) -> np.ndarray:
+        """
+        Sorted turn ids with every label in `vc` and `nvc`, the given subtype / tag /
+        condition (a value or a list of values, any of which matches) and
+        score >= min_score, n_vc >= min_vc. Unknown values raise KeyError.
+        """
+        groups = [[f"vc:{v}"] for v in vc] + [[f"nvc:{v}"] for v in nvc]
+        for field, value in (("subtype", subtype), ("tag", tag), ("condition", condition)):
+            if value is not None:
+                values = [value] if isinstance(value, str) else list(value)
+                groups.append([f"{field}:{v}" for v in values])
+        lists = []
+        for keys in groups:
+            parts = [self.posting(k) for k in keys]
+            if not parts:
+                return np.zeros(0, dtype=np.int64)
+            lists.append(parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts)))
+        lists.sort(key=len)
+        ids = None
+        for p in lists:
+            ids = np.asarray(p) if ids is None else _intersect(ids, p)
+            if not len(ids):
+                break
+
+        filters = [(self.t["score"], min_score), (self.t["n_vc"], min_vc)]
+        filters = [(col, x) for col, x in filters if x is not None]
+        if ids is None:
+            if not filters:
+                return np.arange(len(self))
+            keep = np.ones(len(self), dtype=bool)
+            for col, x in filters:
+                keep &= col >= x
+            return np.flatnonzero(keep)
+        for col, x in filters:
+            ids = ids[col[ids] >= x]
+        return ids.astype(np.int64)
+
+    def label_names(self, masks) -> tuple:
+        """("A|B" VC names, "C|D" NVC names) per bitmask, in index label order."""
+        masks = np.asarray(masks, dtype=np.uint64)
+        out = {"vc": [[] for _ in masks], "nvc": [[] for _ in masks]}
+        for bit, (kind, name) in enumerate(self.labels):
+            for j in np.flatnonzero(masks & np.uint64(1 << bit)):
+                out[kind][j].append(name)
+        return tuple(["|".join(x) for x in out[kind]] for kind in ("vc", "nvc"))
+
+    def frame(self, ids, text: bool = True) -> pd.DataFrame:
+        """One row per turn id with its dialogue fields, labels and (optionally) text."""
+        ids = np.asarray(ids, dtype=np.int64)
+        dia = np.asarray(self.t["dialogue"][ids], dtype=np.int64)
+        decode = lambda field, codes: [self.vocab[field].values[c] if c >= 0 else None for c in codes.tolist()]
+        vc, nvc = self.label_names(self.t["labels"][ids])
+        out = pd.DataFrame({
+            "row": dia,
+            "id": self.d["id"][dia],
+            "condition": decode("condition", self.d["condition"][dia]),
+            "relationship_subtype": decode("subtype", self.d["subtype"][dia]),
+            "relationship_tag": decode("tag", self.d["tag"][dia]),
+            "turn": self.t["turn"][ids].astype(np.int64),
+            "speaker": decode("speaker", self.t["speaker"][ids]),
+            "score": self.t["score"][ids],
+            "n_vc": self.t["n_vc"][ids].astype(np.int64),
+            "vc_labels": vc,
+            "nvc_labels": nvc,
+        })
+        if text:
+            out["text"] = self.blobs["text"].take(ids)
+        return out
+
+
+def _intersect(small: np.ndarray, big: np.ndarray) -> np.ndarray:
+    """Sorted unique `small` ∩ sorted unique `big`: binary search, so `big` is barely touched."""
+    if len(small) > len(big):
+        small, big = big, small
+    small = np.asarray(small)
+    if not len(big):
+        return small[:0]
+    pos = np.searchsorted(big, small)
+    hit = np.asarray(big[np.minimum(pos, len(big) - 1)]) == small
+    return small[hit]
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Build or query the turn-level corpus index.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="one pass over the raw corpus")
+    b.add_argument("--corpus", help="default: 02's IN_PATH")
+    b.add_argument("--out", default=INDEX_DIR)
+    b.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    q = sub.add_parser("query", help="matching turns")
+    q.add_argument("--index", default=INDEX_DIR)
+    q.add_argument("--vc", action="append", default=[], help="VC label (repeat for AND)")
+    q.add_argument("--nvc", action="append", default=[], help="NVC label (repeat for AND)")
+    q.add_argument("--subtype", action="append", help="relationship_subtype (repeat for OR)")
+    q.add_argument("--tag", action="append", help="relationship_tag (repeat for OR)")
+    q.add_argument("--condition", action="append", help="MTurk condition (repeat for OR)")
+    q.add_argument("--min-score", type=float)
+    q.add_argument("--min-vc", type=int)
+    q.add_argument("--limit", type=int, default=20, help="rows to print")
+    q.add_argument("--out", help="write all matches (without text) to this CSV")
+    i = sub.add_parser("info", help="sizes and posting list lengths")
+    i.add_argument("--index", default=INDEX_DIR)
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.cmd == "build":
+        t0 = time.perf_counter()
+        out = build(args.corpus, args.out, args.chunksize)
+        meta = json.loads((out / "meta.json").read_text(encoding="utf-8"))
+        print(f"Indexed {meta['turns']:,} turns of {meta['dialogues']:,} dialogues "
+              f"({len(meta['labels'])} labels) in {time.perf_counter() - t0:.1f}s -> {out}")
+        if not meta["has_nvc"]:
+            print("Note: corpus has no turn_nvc_union column; no NVC postings.")
+        return
+
+    idx = TurnIndex(args.index)
+    if idx.stale():
+        print(f"Warning: {idx.meta['source']['path']} changed since the index was built; rebuild it.")
+    if args.cmd == "info":
+        print(f"{idx.path}: {idx.meta['turns']:,} turns, {idx.meta['dialogues']:,} dialogues")
+        for key in idx.keys:
+            print(f"  {key:<40} {len(idx.posting(key)):>12,}")
+        return
+
+    t0 = time.perf_counter()
+    ids = idx.query(args.vc, args.nvc, args.subtype, args.tag, args.condition, args.min_score, args.min_vc)
+    ms = (time.perf_counter() - t0) * 1000
+    print(f"{len(ids):,} turns ({ms:.1f} ms)")
+    if args.out:
+        idx.frame(ids, text=False).to_csv(args.out, index=False)
+        print("Saved ->", args.out)
+    if len(ids) and args.limit:
+        with pd.option_context("display.max_columns", None, "display.max_colwidth", 50, "display.width", 200):
+            print(idx.frame(ids[:args.limit]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Batch-API round trip, offline: 06 --batch-export writes the requests for a
+two-seed fixture, and 04 ingests fixture result files (tests/fixtures/batch_api)
+that mix succeeded, fenced, errored, expired, malformed and cut-off lines.
+"""
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "batch_api"
+sys.path.insert(0, str(SRC))
+
+from batch_api import requested_keys  # noqa: E402
+
+CONDITIONS = ("positive", "negative")
+PARSED = {(8, "positive", "none"), (8, "positive", "pos"), (8, "negative", "pos")}
+RETRY = {(8, "positive", "neg"), (8, "negative", "none"), (8, "negative", "neg")}
+
+
+def stage(root: Path, script: str, *args) -> str:
+    proc = subprocess.run([sys.executable, str(SRC / script), *args], cwd=root,
+                          capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    return proc.stdout
+
+
+@pytest.mark.parametrize("provider", ["anthropic", "gemini"])
+def test_export_ingest_round_trip(tmp_path, monkeypatch, provider):
+    (tmp_path / "data/processed").mkdir(parents=True)
+    shutil.copy(FIXTURES / "seeds.csv", tmp_path / "data/processed/mturk_seeds_10ids.csv")
+    stage(tmp_path, "06_generate_batch_prompt.py", "--batch-export", provider)
+    requests = tmp_path / f"data/processed/batch_api/requests_{provider}.jsonl"
+    assert set(requested_keys(requests)) == {(8, m, c) for m in CONDITIONS for c in ("none", "pos", "neg")}
+
+    out = stage(tmp_path, "04_parse_claude_outputs.py", "--batch-results",
+                str(FIXTURES / f"results_{provider}.jsonl"), "--batch-requests", str(requests))
+    assert "Skipped 4 failed or malformed record(s)" in out
+
+    monkeypatch.chdir(tmp_path)
+    from storage import read_frame
+    parsed = read_frame("data/processed/claude_outputs_parsed.csv")
+    keys = set(zip(parsed["row_id"].astype(int), parsed["mturk_condition"], parsed["backstory_condition"]))
+    assert keys == PARSED and len(parsed) == len(PARSED)
+    assert parsed["rewrite"].str.len().gt(0).all()
+    assert not parsed["rewrite"].str.contains("```").any()
+    assert parsed["nvc_total"].notna().all()
+
+    lines = (tmp_path / "data/processed/retry_items.jsonl").read_text().splitlines()
+    retry = {(r["row_id"], r["mturk_condition"], r["backstory_condition"]) for r in map(json.loads, lines)}
+    assert retry == RETRY
@@ -0,0 +1,23 @@
+"""
+Stage selection of the pipeline runner: manual stages stay out of a default
+run, and a stage that touches another's inputs is ordered before it.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import pipeline  # noqa: E402
+
+
+def test_default_run_leaves_manual_stages_out():
+    order = pipeline.select([])
+    assert "batch_prompt" not in order and "rewrites" not in order
+    assert "parse" in order
+    assert "batch_prompt" not in pipeline.select(["analyze"])
+
+
+def test_named_batch_prompt_runs_before_parse():
+    assert "batch_prompt" in pipeline.dependencies()["parse"]
+    order = pipeline.select(["parse", "batch_prompt"])
+    assert order.index("batch_prompt") < order.index("parse")
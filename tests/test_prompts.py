@@ -0,0 +1,32 @@
+"""
+The prefix layout is the classic prompt reordered: the same lines for every
+condition, so a --layout prefix run does not change the none baseline (RQ2).
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from prompts import as_text, make_prompt, prompt_segments  # noqa: E402
+
+UTTERANCE = "You never listen to me!"
+
+
+@pytest.mark.parametrize("backstory", [None, "We met at university.\n\nNow we share a flat."],
+                         ids=["none", "backstory"])
+def test_prefix_layout_has_the_classic_lines(backstory):
+    classic = make_prompt(backstory, UTTERANCE)
+    prefix = as_text(prompt_segments(backstory, UTTERANCE, "prefix"))
+    assert sorted(prefix.splitlines()) == sorted(classic.splitlines())
+
+
+def test_none_prompt_never_mentions_a_backstory():
+    assert "backstory" not in as_text(prompt_segments(None, UTTERANCE, "prefix")).lower()
+
+
+def test_segments_share_the_requirements():
+    none = prompt_segments(None, UTTERANCE, "prefix")
+    pos = prompt_segments("We met at university.", UTTERANCE, "prefix")
+    assert none[0] == pos[0] and none[0][1]
@@ -0,0 +1,79 @@
+"""
+03 --backend fake --async end to end: injected 429s, timeouts and malformed
+responses are retried, every cell lands in the journal, the table is compacted,
+and reruns are served from the journal and then from the response cache.
+loadtest.py drives the same path in-process.
+"""
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+SEEDS = Path(__file__).resolve().parents[1] / "data/processed/mturk_seeds_10ids.csv"
+sys.path.insert(0, str(SRC))
+
+JOURNAL = Path("data/processed/rewrites.journal.jsonl")
+TABLE = Path("data/processed/rewrites.parquet")
+METRICS = Path("data/processed/metrics/calls.jsonl")
+FAKE = ["--backend", "fake", "--async", "--base-delay", "0.01", "--max-retries", "8",
+        "--fake-latency-ms", "5", "--fake-rate-429", "0.2", "--fake-rate-timeout", "0.05",
+        "--fake-timeout-s", "0.01", "--fake-rate-malformed", "0.1", "--fake-seed", "3"]
+
+
+def run(root: Path, script: str, *args, code: int = 0) -> str:
+    proc = subprocess.run([sys.executable, str(SRC / script), *args], cwd=root,
+                          capture_output=True, text=True)
+    assert proc.returncode == code, proc.stderr
+    return proc.stdout
+
+
+def calls(root: Path) -> pd.DataFrame:
+    recs = [json.loads(line) for line in (root / METRICS).read_text().splitlines()]
+    df = pd.DataFrame([r for r in recs if r["kind"] == "call"])
+    return df[df["run"] == df["run"].iloc[-1]]
+
+
+def test_fake_backend_run_resumes_from_journal_and_cache(tmp_path, monkeypatch):
+    (tmp_path / "data/processed").mkdir(parents=True)
+    shutil.copy(SEEDS, tmp_path / "data/processed/mturk_seeds.csv")
+    seeds = pd.read_csv(SEEDS)
+
+    run(tmp_path, "03_generate_rewrites.py", *FAKE)
+    first = calls(tmp_path)
+    assert len(first) == 3 * len(seeds)
+    assert first["status"].isin(["ok", "cache_hit"]).all()   # rows of one id share the "none" prompt
+    assert first["attempts"].max() > 1, "the injected failures should have been retried"
+    assert len((tmp_path / JOURNAL).read_text().splitlines()) == 3 * len(seeds)
+
+    monkeypatch.chdir(tmp_path)
+    from storage import read_frame
+    table = read_frame(TABLE)
+    assert list(table["id"]) == list(seeds["id"])
+    for c in ("rewrite_none", "rewrite_pos", "rewrite_neg"):
+        assert table[c].str.len().gt(0).all()
+
+    assert "Nothing new to generate" in run(tmp_path, "03_generate_rewrites.py", *FAKE)
+
+    (tmp_path / JOURNAL).unlink()
+    (tmp_path / TABLE).unlink()
+    run(tmp_path, "03_generate_rewrites.py", *FAKE)
+    assert (calls(tmp_path)["status"] == "cache_hit").all()
+    pd.testing.assert_frame_equal(read_frame(TABLE), table)
+
+
+def test_fake_flags_need_fake_backend(tmp_path):
+    run(tmp_path, "03_generate_rewrites.py", "--backend", "gemini", "--fake-rate-429", "0.1", code=2)
+
+
+def test_loadtest_drives_03(tmp_path):
+    out = run(tmp_path, "loadtest.py", "--seeds", str(SEEDS), "--repeat", "2", "--work-dir", "work",
+              "--latency-ms", "5", "--rate-429", "0.2", "--base-delay", "0.01", "--max-retries", "8")
+    n = 3 * 2 * len(pd.read_csv(SEEDS))
+    assert f"Completed:   {n} cells" in out
+    assert len((tmp_path / "work/rewrites.journal.jsonl").read_text().splitlines()) == n
+    assert f"0 pending of {n}" in run(tmp_path, "loadtest.py", "--seeds", str(SEEDS), "--repeat", "2",
+                                      "--work-dir", "work")
@@ -0,0 +1,74 @@
+"""
+/score micro-batching: a long texts list is scanned in max_batch slices, a list
+longer than max_queue gets 413, and a scan that raises fails only its batch.
+"""
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+
+from markers import SCANNER  # noqa: E402
+from serve import MarkerBatcher, ScoringService  # noqa: E402
+from synth import sample_messages  # noqa: E402
+
+
+class RecordingScanner:
+    """SCANNER that records batch sizes and raises on the scans listed in `fail`."""
+
+    def __init__(self, fail=()):
+        self.names = SCANNER.names
+        self.sizes = []
+        self.fail = set(fail)
+
+    def count_matrix(self, texts):
+        self.sizes.append(len(texts))
+        if len(self.sizes) in self.fail:
+            raise RuntimeError("scan exploded")
+        return SCANNER.count_matrix(texts)
+
+
+def with_service(scanner, body, max_batch=8, max_queue=100):
+    async def main():
+        service = ScoringService(MarkerBatcher(0.001, max_batch, max_queue, scanner), rewriter=None)
+        task = asyncio.create_task(service.batcher.run())
+        try:
+            return await body(service)
+        finally:
+            task.cancel()
+    return asyncio.run(main())
+
+
+async def post(service, payload):
+    return await service.dispatch("POST", "/score", json.dumps(payload).encode())
+
+
+def test_long_request_is_scanned_in_slices():
+    scanner = RecordingScanner()
+    texts = sample_messages(30)
+    status, payload = with_service(scanner, lambda s: post(s, {"texts": texts}))
+    assert status == 200
+    got = np.array([[m[n] for n in SCANNER.names] for m in payload["markers"]])
+    assert np.array_equal(got, SCANNER.count_matrix(texts))
+    assert max(scanner.sizes) <= 8 and sum(scanner.sizes) == 30
+
+
+def test_request_over_max_queue_is_413():
+    status, _ = with_service(RecordingScanner(), lambda s: post(s, {"texts": ["a"] * 101}))
+    assert status == 413
+
+
+def test_failed_scan_fails_its_batch_only():
+    async def body(service):
+        first = await post(service, {"text": "You never listen."})
+        second = await post(service, {"texts": ["You always do this.", "Thanks."]})
+        return first, second, service.batcher.stats()
+
+    (s1, p1), (s2, p2), stats = with_service(RecordingScanner(fail={1}), body)
+    assert s1 == 500 and "scan exploded" in p1["error"]
+    assert s2 == 200 and len(p2["markers"]) == 2
+    assert stats["failed_batches"] == 1
@@ -0,0 +1,81 @@
+"""
+Concurrent `02 --shard i/N` workers + `--merge N` write the single-worker seeds.
+
+Each case builds a synthetic corpus whose backstories are unique per dialogue
+(so every shard has texts no other shard writes), runs the N workers at the
+same time in one directory and merges, next to a single run in another. Sharded
+runs sample ids by hash ranking, so the single run uses --sampler hash; --all
+does not sample.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+
+from synth import write_corpus  # noqa: E402
+
+DIALOGUES = 3000
+SHARDS = 4
+SEEDS = Path("data/processed/mturk_seeds.parquet")
+STORE = Path("data/processed/backstories.parquet")
+
+
+def make_corpus(root: Path):
+    path = root / "data/raw/mturk_aggregate.csv"
+    path.parent.mkdir(parents=True)
+    (root / "data/processed").mkdir(parents=True)
+    write_corpus(path, DIALOGUES)
+    df = pd.read_csv(path)
+    tag = " #" + df["id"].astype(str)
+    for c in ("backstory", "positive_backstory", "negative_backstory"):
+        df[c] = df[c] + tag
+    df.to_csv(path, index=False)
+
+
+def seeds(root: Path, *args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, str(SRC / "02_build_mturk_seeds.py"), *args], cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+def finish(proc: subprocess.Popen):
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+
+@pytest.mark.parametrize("mode", [["--sampler", "hash"], ["--all"]], ids=["sample", "all"])
+def test_concurrent_shards_merge_to_single_run(tmp_path, monkeypatch, mode):
+    single, sharded = tmp_path / "single", tmp_path / "sharded"
+    for root in (single, sharded):
+        make_corpus(root)
+    finish(seeds(single, *mode))
+
+    mode = [a for a in mode if a not in ("--sampler", "hash")]    # the default when sharded
+    workers = [seeds(sharded, *mode, "--shard", f"{i}/{SHARDS}") for i in range(SHARDS)]
+    for proc in workers:
+        finish(proc)
+    assert not (sharded / STORE).exists(), "shard workers must not write the shared store"
+    finish(seeds(sharded, *mode, "--merge", str(SHARDS)))
+
+    assert (sharded / SEEDS).read_bytes() == (single / SEEDS).read_bytes()
+    assert not list((sharded / "data/processed").glob("*.tmp"))
+    monkeypatch.chdir(sharded)
+    from storage import read_frame
+    got = read_frame(SEEDS)
+    assert all(str(text).endswith(f" #{i}") for text, i in zip(got["positive_backstory"], got["id"]))
+    assert len(got) > 0
+
+
+def test_merge_reports_missing_shard_store(tmp_path):
+    make_corpus(tmp_path)
+    for i in range(2):
+        finish(seeds(tmp_path, "--all", "--shard", f"{i}/2"))
+    (tmp_path / "data/processed/backstories.shard1of2.parquet").unlink()
+    proc = seeds(tmp_path, "--all", "--merge", "2")
+    _, err = proc.communicate()
+    assert proc.returncode != 0
+    assert "backstories.shard1of2.parquet" in err
@@ -0,0 +1,55 @@
+"""
+Parquet tables with hashed backstories: a hash missing from the store is an
+error for streamed reads too, and a CSV newer than its Parquet is never read
+silently; `use` settles which copy wins.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+
+import storage  # noqa: E402
+
+TABLE = Path("data/processed/seeds.parquet")
+
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    TABLE.parent.mkdir(parents=True)
+    df = pd.DataFrame({"id": [1, 2, 3], "positive_backstory": ["a", "b", "a"]})
+    storage.write_frame(df, TABLE)
+    return df
+
+
+def test_streamed_read_resolves_and_checks_hashes(table):
+    got = pd.concat(storage.iter_frames(TABLE, batch_rows=2), ignore_index=True)
+    assert list(got["positive_backstory"].astype(str)) == ["a", "b", "a"]
+
+    storage.write_table(pd.DataFrame({"hash": [storage.text_hash("a")], "text": ["a"]}),
+                        storage.BACKSTORY_STORE)
+    with pytest.raises(KeyError):
+        list(storage.iter_frames(TABLE, batch_rows=2))
+    with pytest.raises(KeyError):
+        storage.read_frame(TABLE)
+
+
+def test_newer_csv_is_an_error_until_one_copy_is_kept(table):
+    csv = TABLE.with_suffix(".csv")
+    table.assign(positive_backstory=["c", "c", "c"]).to_csv(csv, index=False)
+    st = TABLE.stat()
+    os.utime(csv, (st.st_atime, st.st_mtime + 10))
+    with pytest.raises(storage.StaleTable):
+        storage.read_frame(csv)
+
+    storage.use(csv)
+    assert list(storage.read_frame(csv)["positive_backstory"].astype(str)) == ["c", "c", "c"]
+    assert storage.input_path(csv) == TABLE
+
+    storage.export_csv(TABLE)   # an export is not newer than its source
+    assert storage.input_path(csv) == TABLE
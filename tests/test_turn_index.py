@@ -0,0 +1,86 @@
+"""
+NVC posting lists of the turn index on a hand-written corpus: label queries
+alone and combined with VC / subtype filters, 02 --from-index --nvc, and the
+exit for a label the index does not know.
+"""
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+
+from turn_index import TurnIndex, build  # noqa: E402
+
+# (id, condition, subtype, per-turn VC labels, per-turn NVC labels or None)
+ROWS = [
+    (1, "positive", "couple", [[], ["Demand"], []], [["Request"], [], ["Feeling", "Request"]]),
+    (1, "negative", "couple", [[], []], [[], ["Request"]]),
+    (2, "positive", "friend", [[], []], [["Request"], []]),
+    (2, "negative", "couple", [["Demand"], []], None),
+]
+# turn ids follow corpus order: row 0 -> 0..2, row 1 -> 3..4, row 2 -> 5..6, row 3 -> 7..8
+
+
+def write_corpus(path: Path):
+    rows = []
+    for i, (id_, cond, subtype, vc, nvc) in enumerate(ROWS):
+        turns = [{"turn": t + 1, "speaker": "AB"[t % 2], "text": f"row {i} turn {t}"} for t in range(len(vc))]
+        rows.append({
+            "id": id_, "condition": cond, "relationship_subtype": subtype,
+            "relationship_tag": "romantic partners" if subtype == "couple" else subtype,
+            "backstory": f"backstory {i}", "positive_backstory": f"pos {id_}", "negative_backstory": f"neg {id_}",
+            "transformed_conversation": json.dumps(turns),
+            "turn_problematic_avg": json.dumps([1.0 + t for t in range(len(vc))]),
+            "turn_vc_union": repr(vc),
+            "turn_nvc_union": None if nvc is None else repr(nvc),
+        })
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+@pytest.fixture
+def index(tmp_path):
+    corpus = tmp_path / "corpus.csv"
+    write_corpus(corpus)
+    return build(str(corpus), tmp_path / "turn_index")
+
+
+def test_nvc_postings(index):
+    idx = TurnIndex(index)
+    assert idx.meta["has_nvc"]
+    assert idx.query(nvc=["Request"]).tolist() == [0, 2, 4, 5]
+    assert idx.query(nvc=["Request", "Feeling"]).tolist() == [2]
+    assert idx.query(nvc=["Request"], subtype="couple").tolist() == [0, 2, 4]
+    assert idx.query(nvc=["Request"], vc=["Demand"]).tolist() == []
+    assert idx.query(nvc=["Request"], min_score=2.0).tolist() == [2, 4]
+    assert sorted(idx.label_names(idx.t["labels"][[2]])[1][0].split("|")) == ["Feeling", "Request"]
+    with pytest.raises(KeyError):
+        idx.query(nvc=["Observation"])
+
+
+def seeds(root: Path, *args) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, str(SRC / "02_build_mturk_seeds.py"), "--from-index", "turn_index",
+                           "--out", "seeds.csv", *args], cwd=root, capture_output=True, text=True)
+
+
+def test_seeds_from_nvc_slice(index, tmp_path, monkeypatch):
+    proc = seeds(tmp_path, "--all", "--nvc", "Request")
+    assert proc.returncode == 0, proc.stderr
+    monkeypatch.chdir(tmp_path)
+    from storage import read_frame
+    got = read_frame("seeds.csv")
+    # best Request turn per couple row by score: row 0 -> turn 2, row 1 -> turn 1
+    assert list(zip(got["id"], got["condition"], got["seed_turn_index"])) == [(1, "positive", 2), (1, "negative", 1)]
+    assert np.array_equal(got["orig_vc_count"], [0, 0])
+
+
+def test_unknown_nvc_label_exits_with_known_labels(index, tmp_path):
+    proc = seeds(tmp_path, "--all", "--nvc", "Observation")
+    assert proc.returncode == 1
+    assert "--nvc 'Observation'" in proc.stderr
+    assert "known: " in proc.stderr and "Request" in proc.stderr and "Feeling" in proc.stderr